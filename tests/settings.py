@@ -12,6 +12,8 @@ USE_L10N = True
 
 DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": "test.db"}}
 
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
 INSTALLED_APPS = (
     "django.contrib.admin",
     "django.contrib.auth",
@@ -30,8 +32,7 @@ MIDDLEWARE = [
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
-    "visitors.middleware.VisitorRequestMiddleware",
-    "visitors.middleware.VisitorSessionMiddleware",
+    "visitors.middleware.VisitorMiddleware",
     "visitors.middleware.VisitorDebugMiddleware",
 ]
 
@@ -0,0 +1,161 @@
+import datetime
+import uuid
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import localtime
+
+from visitors import admin
+from visitors.models import Visitor, VisitorLog
+
+CHANGELIST = "/admin/visitors/visitorlog/"
+
+
+@pytest.fixture
+def client(client):
+    user = User.objects.create_superuser("admin", "admin@example.com", "secret")
+    client.force_login(user)
+    return client
+
+
+def logs(count: int) -> None:
+    VisitorLog.objects.bulk_create(
+        VisitorLog(
+            visitor=Visitor.objects.create(email=f"{i}@example.com", scope="foo"),
+            request_uri="/",
+        )
+        for i in range(count)
+    )
+
+
+def month() -> str:
+    today = localtime()
+    return f"?timestamp__year={today.year}&timestamp__month={today.month}"
+
+
+@pytest.mark.django_db
+class TestEstimatedCountPaginator:
+    def test_count(self) -> None:
+        logs(3)
+        paginator = admin.EstimatedCountPaginator(VisitorLog.objects.order_by("id"), 2)
+        assert paginator.count == 3
+        assert paginator.num_pages == 2
+
+    def test_count__capped(self) -> None:
+        logs(3)
+        paginator = admin.EstimatedCountPaginator(VisitorLog.objects.order_by("id"), 1)
+        with mock.patch.object(admin, "MAX_COUNT", 2):
+            with CaptureQueriesContext(connection) as ctx:
+                assert paginator.count == 2
+        assert "LIMIT 3" in ctx.captured_queries[0]["sql"]
+
+
+@pytest.mark.django_db
+class TestVisitorLogAdmin:
+    def test_changelist__redirect(self, client) -> None:
+        response = client.get(CHANGELIST)
+        assert response.status_code == 302
+        assert response.url == CHANGELIST + month()
+
+    def test_changelist__queries(self, client) -> None:
+        logs(1)
+        with CaptureQueriesContext(connection) as one:
+            assert client.get(CHANGELIST + month()).status_code == 200
+        logs(5)
+        with CaptureQueriesContext(connection) as six:
+            response = client.get(CHANGELIST + month())
+        assert response.status_code == 200
+        assert "1@example.com" in response.content.decode()
+        # no query per row
+        assert len(six) == len(one)
+        # no unbounded COUNT(*)
+        counts = [q["sql"] for q in six.captured_queries if "COUNT(*)" in q["sql"]]
+        assert all("LIMIT" in sql for sql in counts)
+
+
+@pytest.mark.django_db
+class TestVisitorsAdmin:
+    def test_deactivate(self, client) -> None:
+        visitors = [Visitor.objects.create(email="foo@bar.com") for _ in range(2)]
+        response = client.post(
+            "/admin/visitors/visitor/",
+            {"action": "deactivate", "_selected_action": [v.id for v in visitors]},
+        )
+        assert response.status_code == 302
+        assert not Visitor.objects.filter(is_active=True).exists()
+
+    def test_change__counters(self, client) -> None:
+        visitor = Visitor.objects.create(email="foo@bar.com", scope="foo")
+        # counted after the change form is loaded
+        stale = Visitor.objects.get(pk=visitor.pk)
+        Visitor.objects.record_visits({visitor.id: (2, visitor.created_at)})
+        with mock.patch.object(admin.VisitorsAdmin, "get_object", return_value=stale):
+            response = client.post(
+                f"/admin/visitors/visitor/{visitor.pk}/change/",
+                {"email": "fred@example.com", "scope": "foo", "context": "{}"},
+            )
+        assert response.status_code == 302
+        visitor.refresh_from_db()
+        assert visitor.email == "fred@example.com"
+        assert visitor.visit_count == 2
+
+
+@pytest.mark.parametrize(
+    "term,query",
+    (
+        (
+            "68201321-9dd2-4fb3-92b1-24367f38a7d6",
+            Q(uuid=uuid.UUID("68201321-9dd2-4fb3-92b1-24367f38a7d6")),
+        ),
+        ("fred@example.com", Q(email="fred@example.com")),
+        ("fred*", Q(email__startswith="fred")),
+        ("scope:foo", Q(scope="foo")),
+        ("fred", Q(first_name__icontains="fred") | Q(last_name__icontains="fred")),
+        # not a valid date
+        (
+            "2024-02-30",
+            Q(first_name__icontains="2024-02-30")
+            | Q(last_name__icontains="2024-02-30"),
+        ),
+    ),
+)
+def test_search_filter(term: str, query: Q) -> None:
+    assert admin.search_filter(term) == query
+
+
+@pytest.mark.django_db
+class TestVisitorSearch:
+    @pytest.fixture
+    def visitors(self) -> list:
+        return [
+            Visitor.objects.create(
+                first_name="Fred", last_name="Bloggs", email="fred@example.com"
+            ),
+            Visitor.objects.create(
+                first_name="Jane", last_name="Doe", email="jane@example.com"
+            ),
+        ]
+
+    def search(self, term: str) -> list:
+        return list(Visitor.objects.filter(admin.search_filter(term)).order_by("email"))
+
+    def test_names(self, visitors: list) -> None:
+        assert self.search("fred bloggs") == visitors[:1]
+        assert self.search("fred doe") == []
+
+    def test_dates(self, visitors: list) -> None:
+        today = localtime().date()
+        assert self.search(today.isoformat()) == visitors
+        yesterday = today - datetime.timedelta(days=1)
+        assert self.search(f"{yesterday}..{today}") == visitors
+        assert self.search(yesterday.isoformat()) == []
+
+    def test_changelist(self, client, visitors: list) -> None:
+        response = client.get("/admin/visitors/visitor/", {"q": "jane*"})
+        assert response.status_code == 200
+        assert "jane@example.com" in response.content.decode()
+        assert "fred@example.com" not in response.content.decode()
@@ -0,0 +1,162 @@
+import csv
+import datetime
+import gzip
+import json
+import os
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.utils.timezone import now as tz_now
+
+from visitors import archive
+from visitors.models import Visitor, VisitorLog
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+def logs(visitor: Visitor, *days_ago: int) -> None:
+    now = tz_now().replace(hour=12)
+    VisitorLog.objects.bulk_create(
+        VisitorLog(visitor=visitor, timestamp=now - days * ONE_DAY, request_uri="/")
+        for days in days_ago
+    )
+
+
+def day(days_ago: int) -> str:
+    return (tz_now() - days_ago * ONE_DAY).date().isoformat()
+
+
+def read_lines(path: str) -> list:
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.django_db
+class TestArchive:
+    def test_iter_logs(self, visitor: Visitor) -> None:
+        logs(visitor, 10, 9, 10, 1, 8)
+        exported = list(archive.iter_logs(tz_now() - 5 * ONE_DAY, batch_size=2))
+        assert [log.id for log in exported] == sorted(
+            VisitorLog.objects.filter(timestamp__lt=tz_now() - 5 * ONE_DAY).values_list(
+                "id", flat=True
+            )
+        )
+
+    def test_iter_batches(self, visitor: Visitor) -> None:
+        logs(visitor, 10, 1, 9, 10, 8, 1)
+        batches = list(archive.iter_batches(tz_now() - 5 * ONE_DAY, batch_size=3))
+        assert [len(batch) for batch in batches] == [3, 1]
+
+    def test_iter_batches__none(self, visitor: Visitor) -> None:
+        logs(visitor, 1)
+        assert list(archive.iter_batches(tz_now() - 5 * ONE_DAY, batch_size=3)) == []
+
+    def test_export(self, visitor: Visitor, tmp_path) -> None:
+        logs(visitor, 10, 10, 9, 1)
+        cutoff = tz_now() - 5 * ONE_DAY
+        entries = list(archive.export(cutoff, str(tmp_path), "jsonl", batch_size=2))
+        assert [e["rows"] for e in entries] == [2, 1]
+        with open(tmp_path / archive.MANIFEST) as f:
+            manifest = json.load(f)
+        assert manifest["rows"] == 3
+        assert manifest["max_id"] == max(e["max_id"] for e in entries)
+        for entry in manifest["files"]:
+            path = tmp_path / entry["file"]
+            assert entry["file"] == f"visitorlog-{entry['date']}.jsonl.gz"
+            assert archive.checksum(str(path)) == entry["sha256"]
+            lines = read_lines(str(path))
+            assert len(lines) == entry["rows"]
+            assert lines[0]["visitor"] == str(visitor.uuid)
+            assert lines[0]["scope"] == "foo"
+
+    def test_export__id_order(self, visitor: Visitor, tmp_path) -> None:
+        # logs for a day stay in one file until logs two days later are read
+        logs(visitor, 10, 9, 10, 7, 10)
+        cutoff = tz_now() - 5 * ONE_DAY
+        entries = list(archive.export(cutoff, str(tmp_path), "jsonl", batch_size=2))
+        assert [(e["date"], e["rows"]) for e in entries] == [
+            (day(10), 2),
+            (day(9), 1),
+            (day(10), 1),
+            (day(7), 1),
+        ]
+        assert entries[2]["file"] == f"visitorlog-{day(10)}.1.jsonl.gz"
+        manifest = archive.load_manifest(str(tmp_path))
+        ids = list(VisitorLog.objects.order_by("id").values_list("id", flat=True))
+        assert manifest["id_ranges"] == [
+            [ids[0], ids[1], 2],
+            [ids[2], ids[3], 2],
+            [ids[4], ids[4], 1],
+        ]
+
+    def test_export__csv(self, visitor: Visitor, tmp_path) -> None:
+        logs(visitor, 10)
+        entries = list(archive.export(tz_now(), str(tmp_path), "csv", batch_size=2))
+        with gzip.open(tmp_path / entries[0]["file"], "rt") as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]["visitor"] == str(visitor.uuid)
+        assert rows[0]["request_uri"] == "/"
+
+    def test_export__none(self, tmp_path) -> None:
+        assert list(archive.export(tz_now(), str(tmp_path), "jsonl", 10)) == []
+        with open(tmp_path / archive.MANIFEST) as f:
+            assert json.load(f)["files"] == []
+
+
+@pytest.mark.django_db
+class TestArchiveCommand:
+    def test_archive(self, visitor: Visitor, tmp_path) -> None:
+        logs(visitor, 10, 9, 1)
+        out = StringIO()
+        call_command(
+            "visitor_log_archive", str(tmp_path), log_retention_days=5, stdout=out
+        )
+        assert "Exported 2 rows" in out.getvalue()
+        assert len(os.listdir(tmp_path)) == 3
+        assert VisitorLog.objects.count() == 3
+
+    def test_archive__delete(self, visitor: Visitor, tmp_path) -> None:
+        logs(visitor, 10, 9, 1)
+        out = StringIO()
+        call_command(
+            "visitor_log_archive",
+            str(tmp_path),
+            log_retention_days=5,
+            delete=True,
+            sleep=0,
+            stdout=out,
+        )
+        assert "Deleted 2 rows" in out.getvalue()
+        assert VisitorLog.objects.count() == 1
+
+    def test_archive__delete__exported_only(self, visitor: Visitor, tmp_path) -> None:
+        logs(visitor, 10, 9, 1)
+        export = archive.export
+
+        def export_then_log(*args):
+            yield from export(*args)
+            # written with an old timestamp during the export
+            logs(visitor, 10)
+
+        with mock.patch.object(archive, "export", export_then_log):
+            call_command(
+                "visitor_log_archive",
+                str(tmp_path),
+                log_retention_days=5,
+                delete=True,
+                sleep=0,
+                stdout=StringIO(),
+            )
+        assert VisitorLog.objects.count() == 2
+
+    def test_archive__no_retention(self, tmp_path) -> None:
+        with pytest.raises(CommandError):
+            call_command("visitor_log_archive", str(tmp_path))
@@ -0,0 +1,185 @@
+import datetime
+import uuid
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.utils.timezone import now as tz_now
+
+from visitors import cache
+from visitors.models import Visitor
+
+
+@pytest.fixture(autouse=True)
+def pass_cache(monkeypatch):
+    monkeypatch.setattr(cache, "VISITOR_CACHE_ALIAS", "default")
+    caches["default"].clear()
+    cache.stats.reset()
+    cache.local.clear()
+    yield caches["default"]
+    caches["default"].clear()
+    cache.local.clear()
+
+
+@pytest.fixture
+def local_cache(monkeypatch):
+    monkeypatch.setattr(cache.local, "max_entries", 2)
+    return cache.local
+
+
+@pytest.fixture
+def visitor(django_capture_on_commit_callbacks) -> Visitor:
+    with django_capture_on_commit_callbacks(execute=True):
+        return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+@pytest.mark.parametrize(
+    "expires_in,timeout",
+    (
+        (None, cache.VISITOR_CACHE_TIMEOUT),
+        (datetime.timedelta(days=1), cache.VISITOR_CACHE_TIMEOUT),
+        (datetime.timedelta(seconds=30), 29),
+        (datetime.timedelta(seconds=-30), cache.VISITOR_CACHE_NEGATIVE_TIMEOUT),
+    ),
+)
+def test_pass_timeout(expires_in, timeout):
+    expires_at = tz_now() + expires_in if expires_in else None
+    assert cache.pass_timeout(expires_at) == timeout
+
+
+class TestLocalPassCache:
+    def test_lru(self):
+        local = cache.LocalPassCache(max_entries=2, ttl=10)
+        local.set("a", "A", 60)
+        local.set("b", "B", 60)
+        assert local.get("a") == "A"
+        local.set("c", "C", 60)
+        assert local.get("b") is None
+        assert local.get("a") == "A"
+        assert local.get("c") == "C"
+        assert local.get_stats() == {
+            "size": 2,
+            "max_entries": 2,
+            "hits": 3,
+            "misses": 1,
+            "evictions": 1,
+            "expirations": 0,
+        }
+
+    @pytest.mark.parametrize("timeout,ttl", ((60, 10), (10, 60)))
+    def test_expiry(self, timeout, ttl):
+        local = cache.LocalPassCache(max_entries=2, ttl=ttl)
+        with mock.patch("time.monotonic", return_value=0):
+            local.set("a", "A", timeout)
+        with mock.patch("time.monotonic", return_value=9):
+            assert local.get("a") == "A"
+        with mock.patch("time.monotonic", return_value=10):
+            assert local.get("a") is None
+        assert local.get_stats()["expirations"] == 1
+
+    def test_disabled(self):
+        local = cache.LocalPassCache(max_entries=0, ttl=10)
+        local.set("a", "A", 60)
+        assert local.get("a") is None
+
+    def test_get_copies_record(self):
+        local = cache.LocalPassCache(max_entries=2, ttl=10)
+        local.set("a", {"context": {"foo": "bar"}}, 60)
+        local.get("a")["context"]["foo"] = "baz"
+        assert local.get("a") == {"context": {"foo": "bar"}}
+
+    def test_set_copies_record(self):
+        local = cache.LocalPassCache(max_entries=2, ttl=10)
+        record = {"context": {"foo": "bar"}}
+        local.set("a", record, 60)
+        record["context"]["foo"] = "baz"
+        assert local.get("a") == {"context": {"foo": "bar"}}
+
+
+@pytest.mark.django_db
+class TestVisitorCache:
+    def test_write_through(self, visitor, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            cached = Visitor.objects.get_by_uuid(visitor.uuid)
+        assert cached == visitor
+        assert cached.serialize() == visitor.serialize()
+        assert cache.get_stats() == {"hits": 1, "negative_hits": 0, "misses": 0}
+
+    def test_read_through(self, visitor, pass_cache, django_assert_num_queries):
+        pass_cache.clear()
+        with django_assert_num_queries(1):
+            Visitor.objects.get_by_uuid(str(visitor.uuid))
+        with django_assert_num_queries(0):
+            Visitor.objects.get_by_uuid(str(visitor.uuid))
+        assert cache.get_stats() == {"hits": 1, "negative_hits": 0, "misses": 1}
+
+    def test_async(self, visitor, pass_cache, django_assert_num_queries):
+        pass_cache.clear()
+        with django_assert_num_queries(1):
+            async_to_sync(Visitor.objects.aget_by_uuid)(visitor.uuid)
+        with django_assert_num_queries(0):
+            assert async_to_sync(Visitor.objects.aget_by_uuid)(visitor.uuid) == visitor
+        with pytest.raises(Visitor.DoesNotExist):
+            async_to_sync(Visitor.objects.aget_by_uuid)(uuid.uuid4())
+
+    def test_negative_cache(self, django_assert_num_queries):
+        visitor_uuid = uuid.uuid4()
+        with django_assert_num_queries(1):
+            with pytest.raises(Visitor.DoesNotExist):
+                Visitor.objects.get_by_uuid(visitor_uuid)
+        with django_assert_num_queries(0):
+            with pytest.raises(Visitor.DoesNotExist):
+                Visitor.objects.get_by_uuid(visitor_uuid)
+        assert cache.get_stats() == {"hits": 0, "negative_hits": 1, "misses": 1}
+
+    def test_malformed_uuid(self, django_assert_num_queries):
+        with django_assert_num_queries(0):
+            with pytest.raises(Visitor.DoesNotExist):
+                Visitor.objects.get_by_uuid("not-a-uuid")
+
+    def test_deactivate(self, visitor, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.deactivate()
+        assert not Visitor.objects.get_by_uuid(visitor.uuid).is_active
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.reactivate()
+        assert Visitor.objects.get_by_uuid(visitor.uuid).is_valid
+
+    def test_delete(self, visitor, pass_cache):
+        Visitor.objects.filter(id=visitor.id).delete()
+        assert pass_cache.get(cache.cache_key(visitor.uuid)) is None
+        with pytest.raises(Visitor.DoesNotExist):
+            Visitor.objects.get_by_uuid(visitor.uuid)
+
+    def test_delete__recached(
+        self, visitor, pass_cache, django_capture_on_commit_callbacks
+    ):
+        with django_capture_on_commit_callbacks(execute=True):
+            Visitor.objects.filter(id=visitor.id).delete()
+            # read by a concurrent request before the delete is committed
+            cache.set_record(cache.to_record(visitor))
+        assert pass_cache.get(cache.cache_key(visitor.uuid)) is None
+
+    def test_disabled(self, visitor, monkeypatch, django_assert_num_queries):
+        monkeypatch.setattr(cache, "VISITOR_CACHE_ALIAS", None)
+        with django_assert_num_queries(1):
+            Visitor.objects.get_by_uuid(visitor.uuid)
+
+    def test_local_cache(
+        self, visitor, monkeypatch, local_cache, django_assert_num_queries
+    ):
+        monkeypatch.setattr(cache, "VISITOR_CACHE_ALIAS", None)
+        local_cache.clear()
+        with django_assert_num_queries(1):
+            Visitor.objects.get_by_uuid(visitor.uuid)
+        with django_assert_num_queries(0):
+            assert Visitor.objects.get_by_uuid(visitor.uuid) == visitor
+        assert local_cache.get_stats()["hits"] == 1
+
+    def test_local_cache__populated_from_shared(self, visitor, local_cache):
+        local_cache.clear()
+        Visitor.objects.get_by_uuid(visitor.uuid)
+        Visitor.objects.get_by_uuid(visitor.uuid)
+        assert cache.get_stats()["hits"] == 1
+        assert cache.get_local_stats()["hits"] == 1
@@ -0,0 +1,22 @@
+from asgiref.sync import async_to_sync
+
+from visitors.compat import acall
+
+
+class SyncOnly:
+    def get(self, key, default=None):
+        return f"sync {key}"
+
+
+class SyncAndAsync(SyncOnly):
+    async def aget(self, key, default=None):
+        return f"async {key}"
+
+
+def test_acall() -> None:
+    assert async_to_sync(acall)(SyncAndAsync(), "get", "foo") == "async foo"
+
+
+def test_acall__fallback() -> None:
+    # e.g. the cache before Django 4.0, or the ORM before 4.1
+    assert async_to_sync(acall)(SyncOnly(), "get", "foo") == "sync foo"
@@ -3,12 +3,14 @@ from __future__ import annotations
 from typing import Optional
 
 import pytest
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.sessions.backends.base import SessionBase
 from django.core.exceptions import PermissionDenied
 from django.http import HttpRequest, HttpResponse
 from django.test import RequestFactory
 
+from visitors.compat import iscoroutinefunction
 from visitors.decorators import user_is_visitor
 from visitors.models import Visitor, VisitorLog
 
@@ -121,3 +123,74 @@ class TestDecorators:
 
         _ = view(request)
         assert VisitorLog.objects.count() == 0
+
+
+@pytest.mark.django_db
+class TestAsyncDecorators:
+    _request = TestDecorators._request
+
+    def test_no_access(self) -> None:
+        request = self._request()
+
+        @user_is_visitor(scope="foo")
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        assert iscoroutinefunction(view)
+        with pytest.raises(PermissionDenied):
+            _ = async_to_sync(view)(request)
+
+    def test_incorrect_scope(self, visitor: Visitor) -> None:
+        request = self._request(visitor=visitor)
+
+        @user_is_visitor(scope="bar")
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        with pytest.raises(PermissionDenied):
+            _ = async_to_sync(view)(request)
+
+    def test_correct_scope(self, visitor: Visitor) -> None:
+        request = self._request(visitor=visitor)
+
+        @user_is_visitor(scope="foo")
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        response = async_to_sync(view)(request)
+        assert response.status_code == 200
+        assert VisitorLog.objects.get().status_code == 200
+
+    def test_avisitor(self, visitor: Visitor) -> None:
+        """Check that request.avisitor is preferred if set."""
+        request = self._request()
+
+        async def avisitor() -> Visitor:
+            return visitor
+
+        request.avisitor = avisitor
+
+        @user_is_visitor(scope="foo", log_visit=False)
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        assert async_to_sync(view)(request).status_code == 200
+
+    def test_bypass__True(self, user: User) -> None:
+        request = self._request(user=user)
+
+        @user_is_visitor(scope="foo", bypass_func=lambda r: True)
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        assert async_to_sync(view)(request).status_code == 200
+
+    def test_logging__False(self, visitor: Visitor) -> None:
+        request = self._request(visitor=visitor)
+
+        @user_is_visitor(scope="foo", log_visit=False)
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        _ = async_to_sync(view)(request)
+        assert VisitorLog.objects.count() == 0
@@ -0,0 +1,64 @@
+import pytest
+
+from visitors import dimensions
+from visitors.models import UserAgent, Visitor, VisitorLog
+
+
+@pytest.fixture(autouse=True)
+def clear_memo():
+    dimensions.memo.clear()
+    yield
+    dimensions.memo.clear()
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+def log(visitor: Visitor, **kwargs) -> VisitorLog:
+    kwargs.setdefault("http_user_agent", "Mozilla/5.0")
+    kwargs.setdefault("remote_addr", "127.0.0.1")
+    return VisitorLog(visitor=visitor, request_uri="/", **kwargs)
+
+
+def test_memo() -> None:
+    memo = dimensions.Memo(2)
+    memo.set((UserAgent, "a"), 1)
+    memo.set((UserAgent, "b"), 2)
+    assert memo.get((UserAgent, "a")) == 1
+    memo.set((UserAgent, "c"), 3)
+    assert memo.get((UserAgent, "b")) is None
+    assert memo.get((UserAgent, "a")) == 1
+
+
+@pytest.mark.django_db
+class TestDimensions:
+    def test_get_ids(self, django_assert_num_queries) -> None:
+        existing = UserAgent.objects.create(hash=UserAgent.get_hash("a"), value="a")
+        with django_assert_num_queries(3):
+            ids = dimensions.get_ids(UserAgent, ["a", "b", "b", ""])
+        assert ids == {"a": existing.id, "b": UserAgent.objects.get(value="b").id}
+        # memoized
+        with django_assert_num_queries(0):
+            assert dimensions.get_ids(UserAgent, ["a", "b"]) == ids
+
+    def test_normalize(self, visitor: Visitor) -> None:
+        logs = [log(visitor), log(visitor, query_string="page=2")]
+        normalized = dimensions.normalize(logs)
+        assert logs[0].http_user_agent == "Mozilla/5.0"
+        assert normalized[0].http_user_agent == ""
+        assert (
+            normalized[0].http_user_agent_ref_id == normalized[1].http_user_agent_ref_id
+        )
+        assert normalized[0].query_string_ref_id is None
+        assert normalized[1].query_string_ref_id is not None
+        assert normalized[0].http_referer_ref_id is None
+
+    def test_get_value(self, visitor: Visitor) -> None:
+        VisitorLog.objects.bulk_create(dimensions.normalize([log(visitor)]))
+        saved = VisitorLog.objects.with_dimensions().get()
+        assert saved.http_user_agent == ""
+        assert saved.get_value("http_user_agent") == "Mozilla/5.0"
+        assert saved.get_value("remote_addr") == "127.0.0.1"
+        assert saved.get_value("http_referer") == ""
@@ -0,0 +1,157 @@
+"""
+Query plan tests for the VisitorLog and Visitor indexes.
+
+These use SQLite's EXPLAIN QUERY PLAN (via QuerySet.explain), and check that
+each access pattern - the admin changelists, a visitor's timeline, retention
+by date - is served by its index rather than a table scan. On PostgreSQL the
+timestamp index is BRIN, which serves date ranges but not ordering - so
+nothing may rely on it for ORDER BY (the archive pages on id), which the
+SQLite plans can't show, hence the tests of the PostgreSQL SQL itself.
+
+"""
+
+import datetime
+import importlib
+import re
+from unittest import mock
+
+import pytest
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import RequestFactory
+from django.utils.timezone import now as tz_now
+
+from visitors import purge
+from visitors.models import Visitor, VisitorLog
+
+pytestmark = pytest.mark.django_db
+
+
+def plan(queryset: QuerySet) -> str:
+    if connection.vendor != "sqlite":
+        pytest.skip("SQLite query plans")
+    return queryset.explain()
+
+
+def changelist_queryset(model: type, **params: str) -> QuerySet:
+    request = RequestFactory().get("/", params)
+    request.user = User(is_superuser=True, is_staff=True)
+    model_admin = admin.site._registry[model]
+    return model_admin.get_changelist_instance(request).get_queryset(request)
+
+
+def test_visitor_timeline() -> None:
+    visitor = Visitor.objects.create(scope="foo")
+    queryset = visitor.visits.order_by("-timestamp")
+    assert "USING INDEX visitors_log_visitor_ts_idx" in plan(queryset)
+    # no separate sort step
+    assert "TEMP B-TREE" not in plan(queryset)
+
+
+def test_logs_by_date() -> None:
+    cutoff = tz_now() - datetime.timedelta(days=30)
+    assert "USING INDEX visitors_log_timestamp_idx" in plan(purge.expired_logs(cutoff))
+
+
+def test_archive_batches() -> None:
+    # ordered by the primary key, not the timestamp (BRIN on PostgreSQL)
+    queryset = VisitorLog.objects.filter(
+        timestamp__lt=tz_now(), id__gt=100, id__lte=1000
+    ).order_by("id")
+    assert "USING INTEGER PRIMARY KEY" in plan(queryset)
+    assert "TEMP B-TREE" not in plan(queryset)
+
+
+def test_timestamp_index__postgresql() -> None:
+    index = next(
+        i for i in VisitorLog._meta.indexes if i.name == "visitors_log_timestamp_idx"
+    )
+    # not entered, as the SQL is only generated - and the SQLite template has
+    # no USING clause, so check the part the PostgreSQL template includes
+    editor = connection.schema_editor()
+    with mock.patch.object(editor.connection, "vendor", "postgresql"):
+        assert index.create_sql(VisitorLog, editor).parts["using"] == " USING brin"
+    assert index.create_sql(VisitorLog, editor).parts["using"] == ""
+
+
+@pytest.mark.parametrize(
+    "name,count",
+    (("0010_log_and_pass_indexes", 4), ("0011_visitor_search_indexes", 2)),
+)
+def test_migration__concurrent_indexes(name: str, count: int) -> None:
+    migration = importlib.import_module(f"visitors.migrations.{name}").Migration
+    assert not migration.atomic
+    editor = mock.Mock(connection=mock.Mock(vendor="postgresql", alias="default"))
+    state = mock.Mock()
+    state.apps.get_model.return_value = VisitorLog
+    operations = [op for op in migration.operations if hasattr(op, "index")]
+    assert len(operations) == count
+    for operation in operations:
+        editor.reset_mock()
+        operation.database_forwards("visitors", editor, state, state)
+        editor.add_index.assert_called_once_with(
+            VisitorLog, operation.index, concurrently=True
+        )
+
+
+def test_migration__trigram_indexes() -> None:
+    """Check the name indexes match icontains - UPPER("name"::text) LIKE ..."""
+    migration = importlib.import_module(
+        "visitors.migrations.0011_visitor_search_indexes"
+    )
+    editor = mock.Mock(connection=mock.Mock(vendor="postgresql"))
+    editor.quote_name = connection.ops.quote_name
+    migration.create_trigram_indexes(apps, editor)
+    statements = [c.args[0] for c in editor.execute.call_args_list]
+    for column in ("first_name", "last_name"):
+        assert any(
+            f'USING gin (UPPER("{column}"::text) gin_trgm_ops)' in sql
+            for sql in statements
+        )
+
+
+def test_logs_by_status_code() -> None:
+    assert "USING INDEX visitors_log_status_code_idx" in plan(
+        VisitorLog.objects.filter(status_code=404)
+    )
+
+
+def test_log_changelist__visitor() -> None:
+    queryset = changelist_queryset(VisitorLog, visitor__id__exact="1")
+    assert "USING INDEX visitors_log_visitor_ts_idx" in plan(queryset)
+
+
+def test_log_changelist__status_code() -> None:
+    queryset = changelist_queryset(VisitorLog, status_code__exact="500")
+    assert "USING INDEX visitors_log_status_code_idx" in plan(queryset)
+
+
+def test_visitor_changelist__active() -> None:
+    queryset = changelist_queryset(Visitor, scope="foo", is_active__exact="1")
+    assert re.search(r"USING INDEX visitors_visitor_(active|scope)_idx", plan(queryset))
+
+
+@pytest.mark.parametrize(
+    "term,search",
+    (
+        # the unique constraint is an automatic index
+        ("68201321-9dd2-4fb3-92b1-24367f38a7d6", "(uuid=?)"),
+        ("fred@example.com", "visitors_visitor_email"),
+        ("scope:foo", "visitors_visitor_scope_idx"),
+        ("2024-01-01..2024-01-31", "visitors_visitor_created_idx"),
+    ),
+)
+def test_visitor_changelist__search(term: str, search: str) -> None:
+    queryset = changelist_queryset(Visitor, q=term)
+    assert "SEARCH visitors_visitor USING INDEX" in plan(queryset)
+    assert search in plan(queryset)
+
+
+def test_active_passes() -> None:
+    queryset = Visitor.objects.filter(
+        scope="foo", is_active=True, expires_at__gt=tz_now()
+    )
+    assert "USING INDEX visitors_visitor_active_idx" in plan(queryset)
@@ -1,12 +1,21 @@
+import datetime
 import uuid
 from typing import Optional
+from unittest import mock
 
 import pytest
+from asgiref.sync import async_to_sync, iscoroutinefunction
 from django.contrib.auth.models import AnonymousUser, User
 from django.http.request import HttpRequest
 from django.test import RequestFactory
+from django.utils.functional import SimpleLazyObject
+from django.utils.timezone import now as tz_now
 
-from visitors.middleware import VisitorRequestMiddleware, VisitorSessionMiddleware
+from visitors.middleware import (
+    VisitorMiddleware,
+    VisitorRequestMiddleware,
+    VisitorSessionMiddleware,
+)
 from visitors.models import Visitor
 from visitors.settings import VISITOR_SESSION_KEY
 
@@ -45,6 +54,21 @@ class TestVisitorRequestMiddleware(TestVisitorMiddlewareBase):
         assert not request.user.is_visitor
         assert not request.visitor
 
+    def test_user_not_evaluated(self, visitor: Visitor) -> None:
+        """Check that the lazy request.user is left alone."""
+        get_user = mock.Mock(return_value=AnonymousUser())
+        request = self.request(visitor.tokenise("/"))
+        request.user = SimpleLazyObject(get_user)
+
+        def view(request: HttpRequest) -> HttpRequest:
+            assert request.visitor == visitor
+            get_user.assert_not_called()
+            assert request.user.is_visitor
+            get_user.assert_called_once()
+            return request
+
+        VisitorRequestMiddleware(view)(request)
+
     def test_token_does_not_exist(self) -> None:
         request = self.request(f"/?vuid={uuid.uuid4()}")
         middleware = VisitorRequestMiddleware(lambda r: r)
@@ -52,6 +76,13 @@ class TestVisitorRequestMiddleware(TestVisitorMiddlewareBase):
         assert not request.user.is_visitor
         assert not request.visitor
 
+    def test_token_is_malformed(self) -> None:
+        request = self.request("/?vuid=not-a-uuid")
+        middleware = VisitorRequestMiddleware(lambda r: r)
+        middleware(request)
+        assert not request.user.is_visitor
+        assert not request.visitor
+
     def test_token_is_invalid(self, visitor: Visitor) -> None:
         visitor.deactivate()
         request = self.request(visitor.tokenise("/"))
@@ -116,3 +147,177 @@ class TestVisitorSessionMiddleware(TestVisitorMiddlewareBase):
         assert not request.user.is_visitor
         assert not request.visitor
         assert not request.session.get(VISITOR_SESSION_KEY)
+
+
+@pytest.mark.django_db
+class TestLazyVisitor(TestVisitorMiddlewareBase):
+    def middleware(self, view=lambda r: r) -> VisitorRequestMiddleware:
+        return VisitorRequestMiddleware(VisitorSessionMiddleware(view))
+
+    def test_not_resolved(self, visitor: Visitor, django_assert_num_queries) -> None:
+        """Check that nothing is looked up until request.visitor is accessed."""
+        request = self.request("/")
+        request.session = mock.MagicMock(spec=Session)
+        with django_assert_num_queries(0):
+            self.middleware()(request)
+        assert not request.session.mock_calls
+
+    def test_token_stashed(self, visitor: Visitor) -> None:
+        """Check that a token is stashed even if request.visitor is not used."""
+        request = self.request(visitor.tokenise("/"))
+        self.middleware()(request)
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+    def test_resolved_once(self, visitor: Visitor, django_assert_num_queries) -> None:
+        def view(request: HttpRequest) -> HttpRequest:
+            assert request.visitor == visitor
+            assert request.visitor.scope == "foo"
+            assert request.user.is_visitor
+            return request
+
+        request = self.request(visitor.tokenise("/"))
+        with django_assert_num_queries(1):
+            self.middleware(view)(request)
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+    def test_session_visitor(self, visitor: Visitor) -> None:
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        self.middleware()(request)
+        assert request.visitor == visitor
+
+
+@pytest.mark.django_db
+class TestVisitorMiddleware(TestVisitorMiddlewareBase):
+    def test_token(self, visitor: Visitor, django_assert_num_queries) -> None:
+        request = self.request(visitor.tokenise("/"))
+        VisitorMiddleware(lambda r: bool(r.visitor))(request)
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+    def test_session(self, visitor: Visitor, django_assert_num_queries) -> None:
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        request.session.set_expiry = mock.Mock()
+        with django_assert_num_queries(1):
+            VisitorMiddleware(lambda r: bool(r.visitor))(request)
+        assert request.visitor == visitor
+        # the session is not re-stashed
+        request.session.set_expiry.assert_not_called()
+
+    def test_session__expired(self, visitor: Visitor) -> None:
+        """Check that session passes are validated as for tokens."""
+        visitor.expires_at = tz_now() - datetime.timedelta(seconds=1)
+        visitor.save()
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        VisitorMiddleware(lambda r: r)(request)
+        assert not request.visitor
+        assert not request.session.get(VISITOR_SESSION_KEY)
+
+    def test_token_precedence(self, visitor: Visitor, django_assert_num_queries):
+        """Check that a token is preferred, and only one pass is looked up."""
+        other = Visitor.objects.create(email="ginger@example.com", scope="foo")
+        request = self.request(other.tokenise("/"))
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        with django_assert_num_queries(1):
+            VisitorMiddleware(lambda r: bool(r.visitor))(request)
+        assert request.visitor == other
+        assert request.session[VISITOR_SESSION_KEY] == other.session_data
+
+    def test_token_invalid__session(self, visitor: Visitor) -> None:
+        """Check that a stale token falls back to the pass in the session."""
+        other = Visitor.objects.create(email="ginger@example.com", scope="foo")
+        other.deactivate()
+        request = self.request(other.tokenise("/"))
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        VisitorMiddleware(lambda r: bool(r.visitor))(request)
+        assert request.visitor == visitor
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+    def test_shims(self, visitor: Visitor, django_assert_num_queries) -> None:
+        """Check that the deprecated pair of middleware do a single lookup."""
+        request = self.request(visitor.tokenise("/"))
+        middleware = VisitorRequestMiddleware(
+            VisitorSessionMiddleware(lambda r: bool(r.visitor))
+        )
+        with django_assert_num_queries(1):
+            middleware(request)
+        assert request.visitor == visitor
+
+
+@pytest.mark.django_db
+class TestAsyncVisitorMiddleware(TestVisitorMiddlewareBase):
+    def middleware(self, view) -> VisitorMiddleware:
+        middleware = VisitorMiddleware(view)
+        assert iscoroutinefunction(middleware)
+        return middleware
+
+    def test_token(self, visitor: Visitor) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            assert await request.avisitor() == visitor
+            return request
+
+        request = self.request(visitor.tokenise("/"))
+        async_to_sync(self.middleware(view))(request)
+        assert request.visitor == visitor
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+    def test_session(self, visitor: Visitor) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            assert await request.avisitor() == visitor
+            return request
+
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        async_to_sync(self.middleware(view))(request)
+        assert request.visitor == visitor
+
+    def test_token_invalid__session(self, visitor: Visitor) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            assert await request.avisitor() == visitor
+            return request
+
+        request = self.request(f"/?vuid={uuid.uuid4()}")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        async_to_sync(self.middleware(view))(request)
+        assert request.visitor == visitor
+
+    def test_session__invalid(self) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            assert await request.avisitor() is None
+            return request
+
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = str(uuid.uuid4())
+        async_to_sync(self.middleware(view))(request)
+        assert not request.session.get(VISITOR_SESSION_KEY)
+
+    def test_not_resolved(self, visitor: Visitor, django_assert_num_queries) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            return request
+
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = visitor.session_data
+        with django_assert_num_queries(0):
+            async_to_sync(self.middleware(view))(request)
+
+    def test_token_stashed(self, visitor: Visitor) -> None:
+        async def view(request: HttpRequest) -> HttpRequest:
+            return request
+
+        request = self.request(visitor.tokenise("/"))
+        async_to_sync(self.middleware(view))(request)
+        assert request.session[VISITOR_SESSION_KEY] == visitor.session_data
+
+
+@pytest.mark.django_db
+def test_landing_page(client, settings, visitor: Visitor) -> None:
+    """Check that a pass is stashed by a page that does not use it."""
+    # the debug middleware would resolve request.visitor on every request
+    settings.MIDDLEWARE = [
+        m
+        for m in settings.MIDDLEWARE
+        if m != "visitors.middleware.VisitorDebugMiddleware"
+    ]
+    assert client.get(visitor.tokenise("/landing/")).status_code == 200
+    assert client.get("/foo/").status_code == 200
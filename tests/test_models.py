@@ -1,10 +1,15 @@
 import datetime
 import uuid
+from unittest import mock
 
+import django
 import pytest
+from django.db import IntegrityError, connection
+from django.db.models.query import QuerySet
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now as tz_now
 
-from visitors.models import InvalidVisitorPass, Visitor
+from visitors.models import InvalidVisitorPass, Visitor, VisitorLog, VisitorLogRollup
 
 TEST_UUID: str = "68201321-9dd2-4fb3-92b1-24367f38a7d6"
 
@@ -26,6 +31,13 @@ def test_visitor_tokenise(url_in, url_out):
     assert visitor.tokenise(url_in) == url_out
 
 
+@pytest.mark.django_db
+def test_uuid_unique():
+    visitor = Visitor.objects.create(email="foo@bar.com")
+    with pytest.raises(IntegrityError):
+        Visitor.objects.create(email="bar@foo.com", uuid=visitor.uuid)
+
+
 @pytest.mark.django_db
 def test_deactivate():
     visitor = Visitor.objects.create(email="foo@bar.com")
@@ -54,6 +66,80 @@ def test_reactivate():
     assert visitor.is_valid
 
 
+@pytest.mark.django_db
+class TestVisitorQuerySet:
+    def test_deactivate(self) -> None:
+        active = Visitor.objects.create(email="foo@bar.com")
+        inactive = Visitor.objects.create(email="bar@bar.com", is_active=False)
+        Visitor.objects.update(last_updated_at=YESTERDAY)
+        # SQLite's Now() has one second precision before Django 4.0
+        start = tz_now().replace(microsecond=0)
+        with mock.patch("visitors.models.passes_updated.send") as send:
+            with CaptureQueriesContext(connection) as ctx:
+                assert Visitor.objects.all().deactivate() == 1
+        updates = [q for q in ctx.captured_queries if q["sql"].startswith("UPDATE")]
+        assert len(updates) == 1
+        send.assert_called_once_with(
+            sender=Visitor, uuids=[active.uuid], is_active=False
+        )
+        active.refresh_from_db()
+        assert not active.is_active
+        assert active.last_updated_at >= start
+        inactive.refresh_from_db()
+        assert inactive.last_updated_at == YESTERDAY
+
+    def test_deactivate__none(self) -> None:
+        with mock.patch("visitors.models.passes_updated.send") as send:
+            assert Visitor.objects.all().deactivate() == 0
+        send.assert_not_called()
+
+    def test_record_visits(self) -> None:
+        visitor = Visitor.objects.create(email="foo@bar.com")
+        Visitor.objects.record_visits({visitor.id: (2, YESTERDAY)})
+        Visitor.objects.record_visits({visitor.id: (3, TODAY)})
+        # an older batch does not move last_visited_at back
+        Visitor.objects.record_visits({visitor.id: (1, YESTERDAY)})
+        visitor.refresh_from_db()
+        assert visitor.visit_count == 6
+        assert visitor.last_visited_at == TODAY
+
+    def test_deactivate__counters(self) -> None:
+        visitor = Visitor.objects.create(email="foo@bar.com")
+        Visitor.objects.record_visits({visitor.id: (2, TODAY)})
+        visitor.deactivate()
+        visitor.reactivate()
+        visitor.refresh_from_db()
+        assert visitor.is_active
+        assert visitor.visit_count == 2
+
+    def test_save__clone(self) -> None:
+        visitor = Visitor.objects.create(email="foo@bar.com")
+        visitor.pk = None
+        visitor.uuid = uuid.uuid4()
+        visitor.save()
+        assert Visitor.objects.count() == 2
+
+    def test_save__deleted(self) -> None:
+        visitor = Visitor.objects.create(email="foo@bar.com")
+        Visitor.objects.filter(pk=visitor.pk).delete()
+        visitor.save()
+        assert Visitor.objects.get() == visitor
+
+    def test_reactivate(self) -> None:
+        visitor = Visitor.objects.create(
+            email="foo@bar.com", is_active=False, expires_at=YESTERDAY
+        )
+        with mock.patch("visitors.models.passes_updated.send") as send:
+            assert Visitor.objects.filter(id=visitor.id).reactivate() == 1
+        send.assert_called_once_with(
+            sender=Visitor, uuids=[visitor.uuid], is_active=True
+        )
+        visitor.refresh_from_db()
+        assert visitor.is_valid
+        expected = tz_now() + Visitor.DEFAULT_TOKEN_EXPIRY
+        assert abs(visitor.expires_at - expected) < datetime.timedelta(seconds=10)
+
+
 @pytest.mark.parametrize(
     "is_active,expires_at,is_valid",
     (
@@ -108,3 +194,97 @@ def test_has_expired(expires_at, has_expired):
     visitor = Visitor()
     visitor.expires_at = expires_at
     assert visitor.has_expired == has_expired
+
+
+def _log(visitor: Visitor, timestamp: datetime.datetime, **kwargs) -> VisitorLog:
+    kwargs.setdefault("request_uri", "/")
+    kwargs.setdefault("status_code", 200)
+    return VisitorLog(visitor=visitor, timestamp=timestamp, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "timestamp,bucket",
+    (
+        ("2021-02-13 15:38:12", "2021-02-13 15:00:00"),
+        ("2021-02-13 15:00:00", "2021-02-13 15:00:00"),
+        ("2021-02-13 16:00:00", "2021-02-13 16:00:00"),
+    ),
+)
+def test_rollup_get_bucket(timestamp: str, bucket: str) -> None:
+    utc = datetime.timezone.utc
+    timestamp = datetime.datetime.fromisoformat(timestamp).replace(tzinfo=utc)
+    assert VisitorLogRollup.get_bucket(timestamp, 3600) == (
+        datetime.datetime.fromisoformat(bucket).replace(tzinfo=utc)
+    )
+
+
+@pytest.mark.django_db
+class TestVisitorLogRollup:
+    @pytest.fixture
+    def visitor(self) -> Visitor:
+        return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+    def _record(self, visitor: Visitor) -> None:
+        start = VisitorLogRollup.get_bucket(TODAY, 3600)
+        VisitorLogRollup.objects.record(
+            [
+                _log(visitor, start + datetime.timedelta(minutes=2)),
+                _log(visitor, start + datetime.timedelta(minutes=1), sample_weight=3),
+                _log(visitor, start + datetime.timedelta(minutes=3), status_code=404),
+                _log(visitor, start + datetime.timedelta(minutes=61)),
+            ],
+            interval=3600,
+        )
+        VisitorLogRollup.objects.record(
+            [_log(visitor, start + datetime.timedelta(minutes=4))], interval=3600
+        )
+
+    def _assert_rollups(self, visitor: Visitor) -> None:
+        start = VisitorLogRollup.get_bucket(TODAY, 3600)
+        rollups = VisitorLogRollup.objects.order_by("bucket", "status_code")
+        assert [(r.status_code, r.bucket, r.hits) for r in rollups] == [
+            (200, start, 5),
+            (404, start, 1),
+            (200, start + datetime.timedelta(hours=1), 1),
+        ]
+        assert rollups[0].visitor == visitor
+        assert rollups[0].first_seen_at == start + datetime.timedelta(minutes=1)
+        assert rollups[0].last_seen_at == start + datetime.timedelta(minutes=4)
+
+    # bulk_create(update_conflicts=True) was added in Django 4.1
+    requires_upsert = pytest.mark.skipif(
+        django.VERSION < (4, 1), reason="upsert requires Django 4.1"
+    )
+
+    @requires_upsert
+    def test_record__upsert(self, visitor: Visitor, django_assert_num_queries) -> None:
+        with django_assert_num_queries(2):
+            self._record(visitor)
+        self._assert_rollups(visitor)
+
+    @requires_upsert
+    def test_record__upsert__batches(
+        self, visitor: Visitor, django_assert_num_queries
+    ) -> None:
+        with mock.patch.object(VisitorLogRollup.objects, "upsert_batch_size", 2):
+            with django_assert_num_queries(3):
+                self._record(visitor)
+        self._assert_rollups(visitor)
+
+    def test_record__update_or_create(self, visitor: Visitor) -> None:
+        with mock.patch.object(
+            connection.features,
+            "supports_update_conflicts_with_target",
+            False,
+            create=True,
+        ):
+            self._record(visitor)
+        self._assert_rollups(visitor)
+
+    def test_record__update_or_create__race(self, visitor: Visitor) -> None:
+        rollup = VisitorLogRollup.from_log(_log(visitor, TODAY), TODAY)
+        VisitorLogRollup.from_log(_log(visitor, YESTERDAY), TODAY).save()
+        # simulate the rollup being created between the update and the insert
+        with mock.patch.object(QuerySet, "update", side_effect=[0, 1]) as update:
+            VisitorLogRollup.objects._update_or_create(rollup)
+        assert update.call_count == 2
@@ -0,0 +1,147 @@
+import datetime
+import re
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+
+from visitors import partitions
+
+UTC = datetime.timezone.utc
+CET = datetime.timezone(datetime.timedelta(hours=1))
+
+
+def dt(*args) -> datetime.datetime:
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+@pytest.mark.parametrize(
+    "timestamp,interval,start",
+    (
+        (dt(2021, 2, 13, 15, 38), "month", dt(2021, 2, 1)),
+        (dt(2021, 2, 1), "month", dt(2021, 2, 1)),
+        # Saturday -> Monday
+        (dt(2021, 2, 13, 15, 38), "week", dt(2021, 2, 8)),
+        (dt(2021, 2, 8), "week", dt(2021, 2, 8)),
+        # converted to UTC first
+        (datetime.datetime(2021, 3, 1, tzinfo=CET), "month", dt(2021, 2, 1)),
+    ),
+)
+def test_interval_start(timestamp, interval, start) -> None:
+    assert partitions.interval_start(timestamp, interval) == start
+
+
+def test_get_ranges() -> None:
+    assert partitions.get_ranges(dt(2020, 11, 1), 3, "month") == [
+        (dt(2020, 11, 1), dt(2020, 12, 1)),
+        (dt(2020, 12, 1), dt(2021, 1, 1)),
+        (dt(2021, 1, 1), dt(2021, 2, 1)),
+    ]
+    assert partitions.get_ranges(dt(2021, 2, 8), 2, "week") == [
+        (dt(2021, 2, 8), dt(2021, 2, 15)),
+        (dt(2021, 2, 15), dt(2021, 2, 22)),
+    ]
+
+
+@pytest.mark.parametrize(
+    "value,bound",
+    (
+        ("2021-02-01 00:00:00+00", dt(2021, 2, 1)),
+        ("2021-02-01 01:00:00+01", dt(2021, 2, 1)),
+        ("2021-02-01 05:30:00+05:30", dt(2021, 2, 1)),
+    ),
+)
+def test_parse_bound(value: str, bound: datetime.datetime) -> None:
+    assert partitions.parse_bound(value) == bound
+
+
+class TestLogPartitions:
+    def test_create_sql(self) -> None:
+        sql = partitions.LogPartitions(connection, "month").create_sql(
+            dt(2021, 2, 13), ahead=2, after=dt(2021, 3, 1)
+        )
+        # February is skipped as it would overlap an existing partition
+        assert sql == [
+            'CREATE TABLE IF NOT EXISTS "visitors_visitorlog_p20210301" '
+            'PARTITION OF "visitors_visitorlog" FOR VALUES '
+            "FROM ('2021-03-01T00:00:00+00:00') TO ('2021-04-01T00:00:00+00:00')",
+            'CREATE TABLE IF NOT EXISTS "visitors_visitorlog_p20210401" '
+            'PARTITION OF "visitors_visitorlog" FOR VALUES '
+            "FROM ('2021-04-01T00:00:00+00:00') TO ('2021-05-01T00:00:00+00:00')",
+        ]
+
+    def test_prepare_sql(self) -> None:
+        sql = partitions.LogPartitions(connection, "month").prepare_sql(dt(2021, 2, 13))
+        assert sql[-3:] == [
+            'ALTER TABLE "visitors_visitorlog" ADD CONSTRAINT '
+            '"visitors_visitorlog_legacy_timestamp_check" '
+            "CHECK (\"timestamp\" < '2021-03-01T00:00:00+00:00') NOT VALID",
+            'ALTER TABLE "visitors_visitorlog" VALIDATE CONSTRAINT '
+            '"visitors_visitorlog_legacy_timestamp_check"',
+            'CREATE UNIQUE INDEX CONCURRENTLY "visitors_visitorlog_legacy_id_timestamp_key" '
+            'ON "visitors_visitorlog" ("id", "timestamp")',
+        ]
+
+    def test_setup_sql(self) -> None:
+        sql = partitions.LogPartitions(connection, "month").setup_sql(dt(2021, 2, 13))
+        assert sql[0] == (
+            'ALTER TABLE "visitors_visitorlog" RENAME TO "visitors_visitorlog_legacy"'
+        )
+        # legacy table holds everything up to the end of the current interval
+        assert sql[-3].endswith("FROM (MINVALUE) TO ('2021-03-01T00:00:00+00:00')")
+        assert sql[-2] == (
+            'ALTER TABLE "visitors_visitorlog_legacy" '
+            'DROP CONSTRAINT "visitors_visitorlog_legacy_timestamp_check"'
+        )
+        assert sql[-1].endswith('PARTITION OF "visitors_visitorlog" DEFAULT')
+        # nothing that scans or rewrites the table
+        assert not [s for s in sql if "VALIDATE" in s or "UNIQUE INDEX" in s]
+
+    def test_drop_sql(self) -> None:
+        log_partitions = partitions.LogPartitions(connection, "month")
+        with mock.patch.object(
+            log_partitions,
+            "get_partitions",
+            return_value=[
+                ("visitors_visitorlog_default", None),
+                ("visitors_visitorlog_p20210201", dt(2021, 3, 1)),
+                ("visitors_visitorlog_p20210101", dt(2021, 2, 1)),
+                ("visitors_visitorlog_legacy", dt(2021, 1, 1)),
+            ],
+        ):
+            assert log_partitions.drop_sql(dt(2021, 2, 1)) == [
+                'DROP TABLE "visitors_visitorlog_legacy"',
+                'DROP TABLE "visitors_visitorlog_p20210101"',
+            ]
+
+
+def test_command__not_postgresql() -> None:
+    out = StringIO()
+    call_command("visitor_log_partitions", stdout=out)
+    assert "requires PostgreSQL" in out.getvalue()
+
+
+def test_command__setup(db) -> None:
+    out = StringIO()
+    with mock.patch.object(connection, "vendor", "postgresql"), mock.patch.object(
+        partitions.LogPartitions, "is_partitioned", return_value=False
+    ), mock.patch.object(partitions.LogPartitions, "get_partitions", return_value=[]):
+        call_command("visitor_log_partitions", setup=True, dry_run=True, stdout=out)
+    statements = out.getvalue().splitlines()
+    # the concurrent steps are run first, outside the setup transaction
+    assert statements[-1].startswith("CREATE TABLE IF NOT EXISTS")
+    assert statements.index(
+        next(s for s in statements if "CONCURRENTLY" in s)
+    ) < statements.index(next(s for s in statements if "RENAME" in s))
+    # the partitions created start where the legacy partition ends
+    attach = next(s for s in statements if "ATTACH PARTITION" in s)
+    legacy_end = re.search(r"TO \('([^']+)'\)", attach).group(1)
+    starts = [
+        re.search(r"FROM \('([^']+)'\)", s).group(1)
+        for s in statements
+        if s.startswith("CREATE TABLE IF NOT EXISTS")
+    ]
+    assert starts
+    assert min(starts) == legacy_end
@@ -0,0 +1,147 @@
+import datetime
+import uuid
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now as tz_now
+
+from visitors import purge
+from visitors.models import DeletedVisitor, Visitor, VisitorLog, VisitorLogRollup
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def visitor(**kwargs) -> Visitor:
+    kwargs.setdefault("expires_at", tz_now() + ONE_DAY)
+    return Visitor.objects.create(email="fred@example.com", scope="foo", **kwargs)
+
+
+def logs(visitor: Visitor, *days_ago: int) -> None:
+    VisitorLog.objects.bulk_create(
+        VisitorLog(visitor=visitor, timestamp=tz_now() - days * ONE_DAY)
+        for days in days_ago
+    )
+
+
+@pytest.mark.django_db
+class TestPurge:
+    def test_purge_logs(self) -> None:
+        logs(visitor(), 10, 10, 9, 1, 0, 10)
+        progress = list(purge.purge_logs(tz_now() - 5 * ONE_DAY, chunk_size=2))
+        assert [p.deleted for p in progress] == [2, 1, 1]
+        assert progress[-1].next_id > progress[-1].max_id
+        assert VisitorLog.objects.count() == 2
+
+    def test_purge_logs__resume(self) -> None:
+        logs(visitor(), 10, 10, 10)
+        first = VisitorLog.objects.order_by("id").first()
+        progress = list(
+            purge.purge_logs(
+                tz_now() - 5 * ONE_DAY, chunk_size=10, start_id=first.id + 1
+            )
+        )
+        assert [p.deleted for p in progress] == [2]
+        assert VisitorLog.objects.get() == first
+
+    def test_purge_exported(self) -> None:
+        logs(visitor(), 10, 10, 1, 10, 10)
+        ids = list(VisitorLog.objects.order_by("id").values_list("id", flat=True))
+        id_ranges = [(ids[0], ids[2], 2), (ids[3], ids[3], 1)]
+        progress = list(purge.purge_exported(tz_now() - 5 * ONE_DAY, id_ranges))
+        assert [p.deleted for p in progress] == [2, 1]
+        # the last log was not exported, nor the recent one in the first range
+        assert list(VisitorLog.objects.values_list("id", flat=True)) == [
+            ids[2],
+            ids[4],
+        ]
+
+    def test_purge_exported__written_since(self) -> None:
+        logs(visitor(), 10, 10)
+        ids = list(VisitorLog.objects.order_by("id").values_list("id", flat=True))
+        # the second log was written after the range was exported
+        progress = list(
+            purge.purge_exported(tz_now() - 5 * ONE_DAY, [(ids[0], ids[1], 1)])
+        )
+        assert [p.deleted for p in progress] == [0]
+        assert VisitorLog.objects.count() == 2
+
+    def test_purge_logs__none(self) -> None:
+        logs(visitor(), 1)
+        assert list(purge.purge_logs(tz_now() - 5 * ONE_DAY, chunk_size=2)) == []
+
+    def test_purge_visitors(self) -> None:
+        active = visitor()
+        expired = visitor(expires_at=tz_now() - 10 * ONE_DAY)
+        recently_expired = visitor(expires_at=tz_now() - ONE_DAY)
+        inactive = visitor(is_active=False)
+        Visitor.objects.filter(id=inactive.id).update(
+            last_updated_at=tz_now() - 10 * ONE_DAY
+        )
+        logs(expired, 1, 2)
+        logs(active, 1)
+        VisitorLogRollup.objects.record(VisitorLog.objects.all(), interval=60)
+        with mock.patch("visitors.purge.revocation.publish") as publish:
+            progress = list(purge.purge_visitors(tz_now() - 5 * ONE_DAY, chunk_size=2))
+        assert sum(p.deleted for p in progress) == 2
+        assert set(Visitor.objects.all()) == {active, recently_expired}
+        assert VisitorLog.objects.get().visitor == active
+        assert VisitorLogRollup.objects.get().visitor == active
+        # inactive passes that have not expired must stay revoked
+        publish.assert_called_once_with()
+        assert DeletedVisitor.objects.get().uuid == inactive.uuid
+
+    def test_purge_visitors__log_chunks(self) -> None:
+        expired = visitor(expires_at=tz_now() - 10 * ONE_DAY)
+        logs(expired, 1, 2, 3, 4, 5)
+        with CaptureQueriesContext(connection) as queries:
+            list(purge.purge_visitors(tz_now() - 5 * ONE_DAY, chunk_size=2))
+        table = VisitorLog._meta.db_table
+        deletes = [
+            q["sql"] for q in queries if q["sql"].startswith(f'DELETE FROM "{table}"')
+        ]
+        # three chunks of at most 2 logs, then the (empty) final delete
+        assert len(deletes) == 4
+        assert not VisitorLog.objects.exists()
+        assert not Visitor.objects.exists()
+
+    def test_purge_visitors__expired_tombstones(self) -> None:
+        DeletedVisitor.objects.create(uuid=uuid.uuid4(), expires_at=tz_now() - ONE_DAY)
+        visitor(expires_at=tz_now() - 10 * ONE_DAY)
+        with mock.patch("visitors.purge.revocation.publish") as publish:
+            list(purge.purge_visitors(tz_now() - 5 * ONE_DAY, chunk_size=2))
+        publish.assert_not_called()
+        assert not DeletedVisitor.objects.exists()
+
+
+@pytest.mark.django_db
+class TestPurgeCommand:
+    def test_no_retention(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("visitor_purge")
+
+    def test_dry_run(self) -> None:
+        logs(visitor(), 10, 1)
+        out = StringIO()
+        call_command("visitor_purge", "--log-retention-days=5", "--dry-run", stdout=out)
+        assert "VisitorLog: 1 rows" in out.getvalue()
+        assert VisitorLog.objects.count() == 2
+
+    def test_purge(self) -> None:
+        logs(visitor(), 10, 1)
+        visitor(expires_at=tz_now() - 10 * ONE_DAY)
+        out = StringIO()
+        call_command(
+            "visitor_purge",
+            "--log-retention-days=5",
+            "--visitor-retention-days=5",
+            "--sleep=0",
+            stdout=out,
+        )
+        assert "VisitorLog: deleted 1 rows." in out.getvalue()
+        assert "Visitor: deleted 1 rows." in out.getvalue()
+        assert VisitorLog.objects.count() == 1
+        assert Visitor.objects.count() == 1
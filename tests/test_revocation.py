@@ -0,0 +1,204 @@
+import datetime
+import time
+import uuid
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.timezone import now as tz_now
+
+from visitors import cache, revocation, tokens
+from visitors.middleware import VisitorMiddleware
+from visitors.models import DeletedVisitor, Visitor
+
+
+@pytest.fixture
+def pass_cache(monkeypatch):
+    monkeypatch.setattr(cache, "VISITOR_CACHE_ALIAS", "default")
+    caches["default"].clear()
+    revocation.revoked.clear()
+    yield caches["default"]
+    caches["default"].clear()
+    revocation.revoked.clear()
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+class TestBloomFilter:
+    def test_add(self) -> None:
+        bloom = revocation.BloomFilter.for_capacity(100, 0.01)
+        uuids = [uuid.uuid4() for _ in range(100)]
+        for u in uuids:
+            bloom.add(u)
+        assert all(u in bloom for u in uuids)
+        assert str(uuids[0]) in bloom
+
+    def test_error_rate(self) -> None:
+        bloom = revocation.BloomFilter.for_capacity(1000, 0.01)
+        for _ in range(1000):
+            bloom.add(uuid.uuid4())
+        false_positives = sum(uuid.uuid4() in bloom for _ in range(10000))
+        assert false_positives < 300
+
+    def test_to_dict(self) -> None:
+        bloom = revocation.BloomFilter.for_capacity(10, 0.01)
+        bloom.add(u := uuid.uuid4())
+        copy = revocation.BloomFilter.from_dict(bloom.to_dict())
+        assert (copy.size, copy.hashes, copy.bits) == (
+            bloom.size,
+            bloom.hashes,
+            bloom.bits,
+        )
+        assert u in copy
+
+
+@pytest.mark.django_db
+class TestRevocationList:
+    def test_no_cache(self, visitor: Visitor, django_assert_num_queries) -> None:
+        # without a cache every check goes to the database
+        with django_assert_num_queries(1):
+            assert not revocation.is_revoked(visitor.uuid)
+        visitor.deactivate()
+        assert revocation.is_revoked(visitor.uuid)
+
+    def test_publish__no_cache(self) -> None:
+        assert revocation.publish() is None
+
+    def test_is_revoked(
+        self, pass_cache, visitor: Visitor, django_assert_num_queries
+    ) -> None:
+        # first check fetches (and as there is none, builds) the filter, from
+        # inactive passes and tombstones
+        with django_assert_num_queries(2):
+            assert not revocation.is_revoked(visitor.uuid)
+        assert pass_cache.get(revocation.FILTER_KEY)
+        with django_assert_num_queries(0):
+            assert not revocation.is_revoked(visitor.uuid)
+
+    def test_deactivate(
+        self, pass_cache, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        revocation.publish()
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.deactivate()
+        assert visitor.uuid in revocation.revoked
+        assert revocation.is_revoked(visitor.uuid)
+
+    def test_deactivate__bulk(
+        self, pass_cache, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        revocation.publish()
+        Visitor.objects.get_by_uuid(visitor.uuid)
+        assert pass_cache.get(cache.cache_key(visitor.uuid))
+        with django_capture_on_commit_callbacks(execute=True):
+            Visitor.objects.filter(scope="foo").deactivate()
+        assert pass_cache.get(cache.cache_key(visitor.uuid)) is None
+        assert visitor.uuid in revocation.revoked
+        assert revocation.is_revoked(visitor.uuid)
+
+    def test_deactivate__expired(self, pass_cache, visitor: Visitor) -> None:
+        visitor.is_active = False
+        visitor.expires_at = tz_now() - datetime.timedelta(seconds=1)
+        visitor.save()
+        assert list(revocation.get_revoked_uuids()) == []
+
+    def test_delete(
+        self, pass_cache, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        revocation.publish()
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.delete()
+        assert DeletedVisitor.objects.get().uuid == visitor.uuid
+        # deleted passes survive a rebuild
+        revocation.publish()
+        assert visitor.uuid in revocation.revoked
+        assert revocation.is_revoked(visitor.uuid)
+
+    def test_delete__cache_cleared(
+        self, pass_cache, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        token = tokens.dumps(visitor)
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.delete()
+        # the published filter is lost - it is rebuilt from the tombstones
+        pass_cache.clear()
+        revocation.revoked.clear()
+        middleware = VisitorMiddleware(lambda r: None)
+        assert middleware.get_valid_visitor(token) is None
+
+    def test_publish__newer(self, pass_cache, visitor: Visitor) -> None:
+        """Check that an older build doesn't replace a newer published filter."""
+        visitor.deactivate()
+        newer = revocation.BloomFilter.for_capacity(10, 0.01)
+        data = dict(newer.to_dict(), built_at=time.time() + 60)
+        pass_cache.set(revocation.FILTER_KEY, data)
+        assert revocation.publish().bits == newer.bits
+        assert pass_cache.get(revocation.FILTER_KEY) == data
+        # whereas an older one is replaced
+        pass_cache.set(revocation.FILTER_KEY, dict(data, built_at=0))
+        assert visitor.uuid in revocation.publish()
+        assert pass_cache.get(revocation.FILTER_KEY)["built_at"] > 0
+
+    def test_delete__published_once(
+        self, pass_cache, django_capture_on_commit_callbacks
+    ) -> None:
+        for i in range(5):
+            Visitor.objects.create(email=f"{i}@example.com", scope="foo")
+        with mock.patch.object(revocation, "publish") as publish:
+            with django_capture_on_commit_callbacks(execute=True):
+                Visitor.objects.all().delete()
+        publish.assert_called_once_with()
+        assert DeletedVisitor.objects.count() == 5
+
+    def test_publish_on_commit__rollback(
+        self, pass_cache, django_capture_on_commit_callbacks
+    ) -> None:
+        with mock.patch.object(revocation, "publish") as publish:
+            with django_capture_on_commit_callbacks(execute=True):
+                with pytest.raises(ValueError), transaction.atomic():
+                    revocation.publish_on_commit()
+                    raise ValueError
+                # discarded along with the savepoint, so registered again
+                revocation.publish_on_commit()
+        publish.assert_called_once_with()
+
+    def test_delete__expired(self, pass_cache, visitor: Visitor) -> None:
+        visitor.expires_at = tz_now() - datetime.timedelta(seconds=1)
+        visitor.save()
+        visitor.delete()
+        assert not DeletedVisitor.objects.exists()
+
+    def test_reactivate(
+        self, pass_cache, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.deactivate()
+        with django_capture_on_commit_callbacks(execute=True):
+            visitor.reactivate()
+        # still in the filter, but the pass store has the final word
+        assert visitor.uuid in revocation.revoked
+        assert not revocation.is_revoked(visitor.uuid)
+
+    def test_refresh(self, pass_cache, visitor: Visitor) -> None:
+        revocation.publish()
+        # another process deactivates the pass
+        visitor.deactivate()
+        bloom = revocation.BloomFilter.for_capacity(1, 0.01)
+        bloom.add(visitor.uuid)
+        pass_cache.set(revocation.FILTER_KEY, bloom.to_dict())
+        # not seen until this process refreshes
+        assert not revocation.is_revoked(visitor.uuid)
+        revocation.revoked.expires = 0
+        assert revocation.is_revoked(visitor.uuid)
+
+    def test_ais_revoked(self, pass_cache, visitor: Visitor) -> None:
+        assert not async_to_sync(revocation.ais_revoked)(visitor.uuid)
+        assert revocation.revoked.filter is not None
+        visitor.deactivate()
+        revocation.publish()
+        assert async_to_sync(revocation.ais_revoked)(visitor.uuid)
@@ -0,0 +1,97 @@
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.http import HttpRequest, HttpResponse
+from django.test import RequestFactory
+
+from visitors import sampling
+from visitors.decorators import user_is_visitor
+from visitors.models import Visitor, VisitorLog
+
+
+@pytest.fixture(autouse=True)
+def log_cache():
+    caches["default"].clear()
+    yield
+    caches["default"].clear()
+
+
+@pytest.fixture
+def policies(monkeypatch):
+    policies = {}
+    monkeypatch.setattr(sampling, "policies", policies)
+    return policies
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+def request(visitor: Visitor, path: str = "/") -> HttpRequest:
+    request = RequestFactory().get(path)
+    request.visitor = visitor
+    request.session = mock.Mock(session_key="")
+    return request
+
+
+@pytest.mark.django_db
+class TestGetWeight:
+    def test_no_policy(self, policies, visitor: Visitor) -> None:
+        assert sampling.get_weight(request(visitor), visitor) == 1
+
+    def test_any_scope(self, policies, visitor: Visitor) -> None:
+        policies["*"] = sampling.SamplingPolicy(rate=5)
+        policies["bar"] = sampling.SamplingPolicy(rate=10)
+        with mock.patch("visitors.sampling.random.randrange", return_value=0):
+            assert sampling.get_weight(request(visitor), visitor) == 5
+
+    @pytest.mark.parametrize("randrange,weight", ((0, 10), (1, 0), (9, 0)))
+    def test_rate(self, policies, visitor: Visitor, randrange, weight) -> None:
+        policies["foo"] = sampling.SamplingPolicy(rate=10)
+        with mock.patch("visitors.sampling.random.randrange", return_value=randrange):
+            assert sampling.get_weight(request(visitor), visitor) == weight
+
+    @mock.patch("visitors.sampling.time.time")
+    def test_limit(self, mock_time, policies, visitor: Visitor) -> None:
+        policies["foo"] = sampling.SamplingPolicy(limit=2, period=60)
+        mock_time.return_value = 600
+        weights = [sampling.get_weight(request(visitor), visitor) for _ in range(5)]
+        assert weights == [1, 1, 0, 0, 0]
+        # limits are per URI
+        assert sampling.get_weight(request(visitor, "/bar"), visitor) == 1
+        # the next period carries the visits dropped in the last one
+        mock_time.return_value = 660
+        weights = [sampling.get_weight(request(visitor), visitor) for _ in range(3)]
+        assert weights == [4, 1, 0]
+        # ...but only from the period immediately before
+        mock_time.return_value = 780
+        assert sampling.get_weight(request(visitor), visitor) == 1
+
+    @mock.patch("visitors.sampling.time.time", return_value=600)
+    def test_rate_and_limit(self, mock_time, policies, visitor: Visitor) -> None:
+        policies["foo"] = sampling.SamplingPolicy(rate=10, limit=1)
+        with mock.patch("visitors.sampling.random.randrange", return_value=0):
+            weights = [sampling.get_weight(request(visitor), visitor) for _ in range(3)]
+        assert weights == [10, 0, 0]
+
+    @mock.patch("visitors.sampling.time.time", return_value=600)
+    def test_aget_weight(self, mock_time, policies, visitor: Visitor) -> None:
+        policies["foo"] = sampling.SamplingPolicy(limit=1)
+        aget_weight = async_to_sync(sampling.aget_weight)
+        assert aget_weight(request(visitor), visitor) == 1
+        assert aget_weight(request(visitor), visitor) == 0
+
+    @mock.patch("visitors.sampling.time.time", return_value=600)
+    def test_decorator(self, mock_time, policies, visitor: Visitor) -> None:
+        policies["foo"] = sampling.SamplingPolicy(limit=1)
+
+        @user_is_visitor(scope="foo")
+        def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("OK")
+
+        for _ in range(3):
+            assert view(request(visitor)).status_code == 200
+        assert VisitorLog.objects.get().sample_weight == 1
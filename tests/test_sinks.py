@@ -0,0 +1,187 @@
+import json
+import logging
+from unittest import mock
+
+import pytest
+from django.db.models.signals import post_save
+
+from visitors import sinks, writers
+from visitors.models import UserAgent, Visitor, VisitorLog, VisitorLogRollup
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    def _configure(*configs):
+        monkeypatch.setattr(sinks, "_sinks", [sinks.create_sink(c) for c in configs])
+        return sinks._sinks
+
+    return _configure
+
+
+def log(visitor: Visitor, **kwargs) -> VisitorLog:
+    return VisitorLog(visitor=visitor, request_uri="/", status_code=200, **kwargs)
+
+
+def test_to_dict() -> None:
+    visitor = Visitor(scope="foo")
+    data = sinks.to_dict(log(visitor, sample_weight=2))
+    assert data["visitor"] == str(visitor.uuid)
+    assert data["scope"] == "foo"
+    assert data["request_uri"] == "/"
+    assert data["sample_weight"] == 2
+    assert "id" not in data
+
+
+@pytest.mark.parametrize(
+    "config,sink_class",
+    (
+        ({"class": "database"}, sinks.DatabaseSink),
+        ({"class": "logging"}, sinks.LoggingSink),
+        ({"class": "jsonl", "path": "visits.jsonl"}, sinks.JSONLinesFileSink),
+        ({"class": "rollup"}, sinks.RollupSink),
+        ({"class": "counts"}, sinks.VisitCountSink),
+        ({"class": "visitors.sinks.DatabaseSink"}, sinks.DatabaseSink),
+    ),
+)
+def test_create_sink(config: dict, sink_class: type) -> None:
+    assert type(sinks.create_sink(config)) == sink_class
+
+
+@pytest.mark.django_db
+class TestSinks:
+    def test_database(self, configure, visitor: Visitor) -> None:
+        configure({"class": "database"})
+        sinks.write([log(visitor), log(visitor)])
+        assert VisitorLog.objects.count() == 2
+
+    def test_database__single_log_signals(self, configure, visitor: Visitor) -> None:
+        configure({"class": "database"})
+        receiver = mock.Mock()
+        post_save.connect(receiver, sender=VisitorLog)
+        try:
+            sinks.write([log(visitor)])
+        finally:
+            post_save.disconnect(receiver, sender=VisitorLog)
+        assert receiver.call_count == 1
+        assert receiver.call_args.kwargs["created"] is True
+
+    def test_database__normalize(self, configure, visitor: Visitor) -> None:
+        configure({"class": "database", "normalize": True})
+        logs = [log(visitor, http_user_agent="Mozilla/5.0") for _ in range(2)]
+        sinks.write(logs)
+        assert logs[0].http_user_agent == "Mozilla/5.0"
+        assert UserAgent.objects.get().value == "Mozilla/5.0"
+        # SQLite only returns bulk_create pks from Django 4.0
+        user_agent = UserAgent.objects.get()
+        saved_logs = VisitorLog.objects.filter(http_user_agent_ref=user_agent)
+        assert saved_logs.count() == 2
+        saved = saved_logs.first()
+        assert saved.http_user_agent == ""
+        assert sinks.to_dict(saved)["http_user_agent"] == "Mozilla/5.0"
+        assert "http_user_agent_ref_id" not in sinks.to_dict(saved)
+
+    def test_counts(self, configure, visitor: Visitor) -> None:
+        configure({"class": "counts"})
+        logs = [log(visitor), log(visitor, sample_weight=3)]
+        sinks.write(logs)
+        visitor.refresh_from_db()
+        assert visitor.visit_count == 4
+        assert visitor.last_visited_at == max(log.timestamp for log in logs)
+
+    def test_counts__interval(self, configure, visitor: Visitor) -> None:
+        (sink,) = configure({"class": "counts", "interval": 60})
+        sinks.write([log(visitor)])
+        sinks.write([log(visitor)])
+        visitor.refresh_from_db()
+        assert visitor.visit_count == 0
+        sinks.close()
+        visitor.refresh_from_db()
+        assert visitor.visit_count == 2
+
+    def test_scopes(self, configure, visitor: Visitor) -> None:
+        configure({"class": "database", "scopes": ["bar"]})
+        bar = Visitor.objects.create(email="fred@example.com", scope="bar")
+        sinks.write([log(visitor), log(bar)])
+        assert VisitorLog.objects.get().visitor == bar
+
+    def test_logging(self, configure, visitor: Visitor, caplog) -> None:
+        configure({"class": "logging"})
+        with caplog.at_level(logging.INFO, logger="visitors.visits"):
+            sinks.write([log(visitor)])
+        assert json.loads(caplog.records[0].message)["scope"] == "foo"
+        assert caplog.records[0].visit["request_uri"] == "/"
+
+    def test_composed(self, configure, visitor: Visitor, caplog, tmp_path) -> None:
+        configure(
+            {"class": "jsonl", "path": str(tmp_path / "visits.jsonl")},
+            {"class": "logging"},
+        )
+        with caplog.at_level(logging.INFO, logger="visitors.visits"):
+            sinks.write([log(visitor)])
+        sinks.close()
+        assert VisitorLog.objects.count() == 0
+        assert len(caplog.records) == 1
+        assert (tmp_path / "visits.jsonl").read_text().count("\n") == 1
+
+    def test_error(self, configure, visitor: Visitor, caplog) -> None:
+        database, logging_sink = configure({"class": "database"}, {"class": "logging"})
+        with mock.patch.object(database, "write_logs", side_effect=Exception("boom")):
+            with caplog.at_level(logging.INFO, logger="visitors.visits"):
+                with pytest.raises(Exception, match="boom"):
+                    sinks.write([log(visitor)])
+        # the other sinks are still written to
+        assert len(caplog.records) == 1
+
+    def test_writer(self, configure, visitor: Visitor, caplog) -> None:
+        configure({"class": "logging"})
+        with caplog.at_level(logging.INFO, logger="visitors.visits"):
+            writers.LogWriter().write(log(visitor))
+        assert VisitorLog.objects.count() == 0
+        assert len(caplog.records) == 1
+
+
+class TestJSONLinesFileSink:
+    def test_write(self, tmp_path) -> None:
+        sink = sinks.JSONLinesFileSink(str(tmp_path / "visits-{pid}.jsonl"))
+        visitor = Visitor(scope="foo")
+        sink.write([log(visitor), log(visitor)])
+        sink.close()
+        lines = open(sink.filename).readlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0])["visitor"] == str(visitor.uuid)
+
+    def test_rotate__size(self, tmp_path) -> None:
+        path = tmp_path / "visits.jsonl"
+        sink = sinks.JSONLinesFileSink(str(path), max_bytes=1, buffer_size=1)
+        visitor = Visitor(scope="foo")
+        sink.write([log(visitor)])
+        sink.write([log(visitor)])
+        sink.close()
+        assert len(list(tmp_path.glob("visits.jsonl.*"))) == 1
+        assert path.read_text().count("\n") == 1
+
+    @mock.patch("visitors.sinks.time.time")
+    def test_rotate__interval(self, mock_time, tmp_path) -> None:
+        path = tmp_path / "visits.jsonl"
+        sink = sinks.JSONLinesFileSink(str(path), interval=60, backup_count=2)
+        visitor = Visitor(scope="foo")
+        for i in range(5):
+            mock_time.return_value = 1600000000 + i * 60
+            sink.write([log(visitor)])
+        sink.close()
+        # only the most recent backups are kept
+        assert len(list(tmp_path.glob("visits.jsonl.*"))) == 2
+        assert path.read_text().count("\n") == 1
+
+
+@pytest.mark.django_db
+def test_rollup(configure, visitor: Visitor) -> None:
+    configure({"class": "rollup", "interval": 60})
+    sinks.write([log(visitor), log(visitor, sample_weight=2)])
+    assert VisitorLog.objects.count() == 0
+    assert VisitorLogRollup.objects.get().hits == 3
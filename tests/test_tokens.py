@@ -0,0 +1,103 @@
+import datetime
+from urllib.parse import urlencode
+
+import pytest
+from django.core import signing
+from django.utils.timezone import now as tz_now
+
+from visitors import tokens
+from visitors.middleware import VisitorMiddleware
+from visitors.models import InvalidVisitorPass, Visitor
+from visitors.settings import VISITOR_SESSION_KEY
+
+from .test_middleware import TestVisitorMiddlewareBase
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+@pytest.mark.django_db
+class TestSignedTokens:
+    def test_dumps_loads(self, visitor: Visitor) -> None:
+        claims = tokens.loads(tokens.dumps(visitor))
+        assert claims["i"] == visitor.id
+        assert claims["u"] == visitor.uuid.hex
+        assert claims["s"] == visitor.scope
+        assert claims["e"] == visitor.expires_at.replace(microsecond=0)
+
+    def test_loads__tampered(self, visitor: Visitor) -> None:
+        token = tokens.dumps(visitor)
+        with pytest.raises(signing.BadSignature):
+            tokens.loads(token[:-1])
+
+    def test_is_signed(self, visitor: Visitor) -> None:
+        assert tokens.is_signed(tokens.dumps(visitor))
+        assert not tokens.is_signed(str(visitor.uuid))
+
+    def test_tokenise(self, visitor: Visitor) -> None:
+        url = visitor.tokenise("/", signed=True)
+        assert url == "/?" + urlencode({"vuid": tokens.dumps(visitor)})
+
+    def test_from_signed_token(
+        self, visitor: Visitor, django_assert_num_queries
+    ) -> None:
+        token = tokens.dumps(visitor)
+        with django_assert_num_queries(0):
+            signed = Visitor.objects.from_signed_token(token)
+            assert signed.id == visitor.id
+            assert signed.uuid == visitor.uuid
+            assert signed.scope == visitor.scope
+            assert signed.is_valid
+            assert signed.session_data == token
+        # remaining fields are loaded on demand
+        with django_assert_num_queries(1):
+            assert signed.email == visitor.email
+
+    def test_from_signed_token__invalid(self) -> None:
+        with pytest.raises(InvalidVisitorPass):
+            Visitor.objects.from_signed_token("foo:bar")
+
+
+@pytest.mark.django_db
+class TestSignedTokenMiddleware(TestVisitorMiddlewareBase):
+    def resolve(self, request):
+        VisitorMiddleware(lambda r: bool(r.visitor))(request)
+        return request.visitor
+
+    def test_valid(self, visitor: Visitor, django_assert_num_queries) -> None:
+        request = self.request(visitor.tokenise("/", signed=True))
+        # one query for the revocation check (no pass cache)
+        with django_assert_num_queries(1):
+            assert self.resolve(request) == visitor
+        assert request.session[VISITOR_SESSION_KEY] == tokens.dumps(visitor)
+
+    def test_session(self, visitor: Visitor) -> None:
+        request = self.request("/")
+        request.session[VISITOR_SESSION_KEY] = tokens.dumps(visitor)
+        assert self.resolve(request) == visitor
+
+    def test_expired(self, visitor: Visitor, django_assert_num_queries) -> None:
+        visitor.expires_at = tz_now() - datetime.timedelta(seconds=1)
+        request = self.request(visitor.tokenise("/", signed=True))
+        with django_assert_num_queries(0):
+            assert not self.resolve(request)
+
+    def test_tampered(self, visitor: Visitor, django_assert_num_queries) -> None:
+        visitor.scope = "bar"
+        token = tokens.dumps(visitor)
+        payload, _, signature = token.partition(":")
+        request = self.request(f"/?vuid={payload}:{signature[1:]}")
+        with django_assert_num_queries(0):
+            assert not self.resolve(request)
+
+    def test_revoked(self, visitor: Visitor) -> None:
+        url = visitor.tokenise("/", signed=True)
+        visitor.deactivate()
+        assert not self.resolve(self.request(url))
+
+    def test_deleted(self, visitor: Visitor) -> None:
+        url = visitor.tokenise("/", signed=True)
+        visitor.delete()
+        assert not self.resolve(self.request(url))
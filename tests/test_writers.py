@@ -0,0 +1,260 @@
+import signal
+from unittest import mock
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.test import RequestFactory
+
+from visitors import writers
+from visitors.models import Visitor, VisitorLog
+
+
+@pytest.fixture
+def visitor() -> Visitor:
+    return Visitor.objects.create(email="fred@example.com", scope="foo")
+
+
+@pytest.fixture
+def buffered(monkeypatch) -> writers.BufferedLogWriter:
+    writer = writers.BufferedLogWriter(batch_size=3, flush_interval=5)
+    monkeypatch.setattr(writers, "_writer", writer)
+    return writer
+
+
+def log(visitor: Visitor) -> VisitorLog:
+    return VisitorLog(visitor=visitor, request_uri="/", status_code=200)
+
+
+@pytest.mark.parametrize(
+    "name,writer_class",
+    (
+        ("direct", writers.LogWriter),
+        ("buffered", writers.BufferedLogWriter),
+        ("background", writers.BackgroundLogWriter),
+        ("visitors.writers.BufferedLogWriter", writers.BufferedLogWriter),
+    ),
+)
+def test_create_writer(name: str, writer_class: type) -> None:
+    assert type(writers.create_writer(name)) == writer_class
+
+
+@pytest.mark.django_db
+class TestBufferedLogWriter:
+    def test_batch_size(self, buffered, visitor, django_assert_num_queries) -> None:
+        with django_assert_num_queries(0):
+            buffered.write(log(visitor))
+            buffered.write(log(visitor))
+        assert len(buffered) == 2
+        with django_assert_num_queries(1):
+            buffered.write(log(visitor))
+        assert len(buffered) == 0
+        assert VisitorLog.objects.count() == 3
+
+    @mock.patch("visitors.writers.time.monotonic")
+    def test_flush_interval(self, mock_monotonic, buffered, visitor) -> None:
+        mock_monotonic.return_value = 100
+        buffered.write(log(visitor))
+        writers.flush_due()
+        assert len(buffered) == 1
+        mock_monotonic.return_value = 105
+        writers.flush_due()
+        assert len(buffered) == 0
+        assert VisitorLog.objects.count() == 1
+
+    @mock.patch("visitors.writers.time.monotonic")
+    def test_request_finished(self, mock_monotonic, buffered, visitor) -> None:
+        mock_monotonic.return_value = 100
+        buffered.write(log(visitor))
+        mock_monotonic.return_value = 105
+        request_finished.send(sender=None)
+        assert VisitorLog.objects.count() == 1
+
+    def test_close(self, buffered, visitor) -> None:
+        buffered.write(log(visitor))
+        buffered.close()
+        assert VisitorLog.objects.count() == 1
+
+    def test_save__error(self, buffered, visitor, caplog) -> None:
+        buffered.write(VisitorLog(visitor_id=-1))
+        buffered.write(VisitorLog(visitor_id=-1))
+        with mock.patch.object(
+            VisitorLog.objects, "bulk_create", side_effect=Exception("boom")
+        ):
+            buffered.flush()
+        assert "Unable to write 2 visitor logs" in caplog.text
+        assert len(buffered) == 0
+
+    def test_awrite(self, buffered, visitor) -> None:
+        for _ in range(3):
+            async_to_sync(buffered.awrite)(log(visitor))
+        assert VisitorLog.objects.count() == 3
+
+    def test_write_log(self, buffered, visitor) -> None:
+        request = RequestFactory().get("/", HTTP_USER_AGENT="test")
+        request.visitor = visitor
+        request.session = mock.Mock(session_key="foo")
+        writers.write_log(request, HttpResponse())
+        assert VisitorLog.objects.count() == 0
+        buffered.flush()
+        log = VisitorLog.objects.get()
+        assert log.visitor == visitor
+        assert log.http_user_agent == "test"
+
+
+def background(**kwargs) -> writers.BackgroundLogWriter:
+    options = dict(
+        batch_size=2,
+        flush_interval=5,
+        queue_size=4,
+        overflow="drop_newest",
+        sample_rate=2,
+    )
+    options.update(kwargs)
+    return writers.BackgroundLogWriter(**options)
+
+
+class TestBackgroundLogWriter:
+    def test_invalid_overflow(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            background(overflow="foo")
+
+    @pytest.mark.parametrize(
+        "overflow,queued,dropped",
+        (
+            ("drop_newest", [0, 1, 2, 3], 2),
+            ("drop_oldest", [2, 3, 4, 5], 2),
+            # from half full (2) only every other log is kept
+            ("sample", [0, 1, 3, 5], 2),
+        ),
+    )
+    def test_overflow(self, overflow: str, queued: list, dropped: int) -> None:
+        writer = background(overflow=overflow)
+        logs = [VisitorLog(status_code=i) for i in range(6)]
+        with mock.patch.object(writer, "_start"):
+            for log in logs:
+                writer.write(log)
+        assert [log.status_code for log in writer._queue] == queued
+        stats = writer.get_stats()
+        assert stats["depth"] == 4
+        assert stats["dropped"] == dropped
+
+    def test_overflow__sample_weight(self) -> None:
+        writer = background(overflow="sample")
+        logs = [VisitorLog(status_code=i) for i in range(6)]
+        with mock.patch.object(writer, "_start"):
+            for log in logs:
+                writer.write(log)
+        # logs kept past the high-water mark stand in for those dropped
+        assert [log.sample_weight for log in writer._queue] == [1, 1, 2, 2]
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.parametrize("overflow", writers.OVERFLOW_POLICIES)
+    def test_write(self, overflow: str, visitor: Visitor) -> None:
+        writer = background(overflow=overflow, queue_size=100)
+        for _ in range(5):
+            writer.write(log(visitor))
+        assert writer.is_running
+        writer.flush()
+        assert VisitorLog.objects.count() == 5
+        stats = writer.get_stats()
+        assert stats["depth"] == 0
+        assert stats["written"] == 5
+        assert stats["batches"] == 3
+        assert stats["max_flush_latency"] > 0
+        writer.close()
+        assert not writer.is_running
+
+    @pytest.mark.django_db(transaction=True)
+    def test_block(self, visitor: Visitor) -> None:
+        writer = background(overflow="block", queue_size=2, batch_size=1)
+        for _ in range(10):
+            writer.write(log(visitor))
+        writer.close()
+        assert VisitorLog.objects.count() == 10
+        assert writer.get_stats()["dropped"] == 0
+
+    @pytest.mark.django_db(transaction=True)
+    def test_awrite(self, visitor: Visitor) -> None:
+        writer = background(overflow="block", queue_size=2, batch_size=1)
+        for _ in range(5):
+            async_to_sync(writer.awrite)(log(visitor))
+        writer.close()
+        assert VisitorLog.objects.count() == 5
+
+    @pytest.mark.django_db
+    def test_close__not_started(self, visitor: Visitor) -> None:
+        writer = background()
+        with mock.patch.object(writer, "_start"):
+            writer.write(log(visitor))
+        writer.close()
+        assert VisitorLog.objects.count() == 1
+        # writes after close are written inline
+        writer.write(log(visitor))
+        assert VisitorLog.objects.count() == 2
+
+
+def test_exit_on_sigterm() -> None:
+    previous = signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        writers.exit_on_sigterm()
+        handler = signal.getsignal(signal.SIGTERM)
+        assert handler == writers._sigterm
+        with pytest.raises(SystemExit):
+            handler(signal.SIGTERM, None)
+        # existing handlers are left alone
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        writers.exit_on_sigterm()
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_IGN
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+@pytest.mark.django_db
+class TestWriteLog:
+    def request(self, visitor: Visitor) -> HttpRequest:
+        request = RequestFactory().get("/")
+        request.visitor = visitor
+        request.session = mock.Mock(session_key="")
+        return request
+
+    def test_write_log(self, visitor: Visitor) -> None:
+        writers.write_log(self.request(visitor), HttpResponse(), 2)
+        assert VisitorLog.objects.get().sample_weight == 2
+
+    def test_after_response(self, monkeypatch, visitor: Visitor) -> None:
+        monkeypatch.setattr(writers, "VISITOR_LOG_AFTER_RESPONSE", True)
+        response = HttpResponse()
+        writers.write_log(self.request(visitor), response)
+        assert VisitorLog.objects.count() == 0
+        response.close()
+        assert VisitorLog.objects.count() == 1
+
+    def test_after_response__error(self, monkeypatch, visitor: Visitor, caplog):
+        monkeypatch.setattr(writers, "VISITOR_LOG_AFTER_RESPONSE", True)
+        response = HttpResponse()
+        writers.write_log(self.request(visitor), response)
+        with mock.patch.object(writers.sinks, "write", side_effect=Exception("boom")):
+            response.close()
+        assert "Unable to write visitor log" in caplog.text
+
+    def test_atomic_requests(
+        self, monkeypatch, visitor: Visitor, django_capture_on_commit_callbacks
+    ) -> None:
+        monkeypatch.setitem(connection.settings_dict, "ATOMIC_REQUESTS", True)
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            writers.write_log(self.request(visitor), HttpResponse())
+            assert VisitorLog.objects.count() == 0
+        assert len(callbacks) == 1
+        assert VisitorLog.objects.count() == 1
+
+    def test_awrite_log__after_response(self, monkeypatch, visitor: Visitor) -> None:
+        monkeypatch.setattr(writers, "VISITOR_LOG_AFTER_RESPONSE", True)
+        response = HttpResponse()
+        async_to_sync(writers.awrite_log)(self.request(visitor), response)
+        assert VisitorLog.objects.count() == 0
+        response.close()
+        assert VisitorLog.objects.count() == 1
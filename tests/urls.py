@@ -8,4 +8,5 @@ admin.autodiscover()
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("foo/", views.foo),
+    path("landing/", views.landing),
 ]
@@ -6,3 +6,7 @@ from visitors.decorators import user_is_visitor
 @user_is_visitor(scope="foo")
 def foo(request: HttpRequest) -> HttpResponse:
     return HttpResponse("OK")
+
+
+def landing(request: HttpRequest) -> HttpResponse:
+    return HttpResponse("OK")
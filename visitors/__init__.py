@@ -0,0 +1,5 @@
+import django
+
+# AppConfig subclasses are only discovered automatically from Django 3.2
+if django.VERSION < (3, 2):
+    default_app_config = "visitors.apps.VisitorsConfig"
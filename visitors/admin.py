@@ -1,14 +1,33 @@
 from __future__ import annotations
 
+import datetime
 import json
-from typing import Optional
+import re
+import uuid
+from typing import Any, Dict, Optional, Tuple, Type
 
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.http import HttpResponseRedirect
 from django.http.request import HttpRequest
+from django.http.response import HttpResponse
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
+from django.utils.timezone import localtime, make_aware
 
-from .models import Visitor, VisitorLog
+from .models import Visitor, VisitorLog, VisitorLogRollup
+
+# Rows counted before the paginator falls back to an estimate.
+MAX_COUNT = 10000
+
+# "2024-01-31", or "2024-01-01..2024-01-31" (inclusive)
+DATE_RANGE = re.compile(r"^(\d{4}-\d{2}-\d{2})(?:\.\.(\d{4}-\d{2}-\d{2}))?$")
+
+SCOPE_PREFIX = "scope:"
 
 
 def pretty_print(data: Optional[dict]) -> str:
@@ -20,15 +39,63 @@ def pretty_print(data: Optional[dict]) -> str:
     return mark_safe("<pre><code>%s</code></pre>" % html)
 
 
+def _date_range(term: str) -> Optional[Q]:
+    if not (match := DATE_RANGE.match(term)):
+        return None
+    try:
+        start = datetime.date.fromisoformat(match.group(1))
+        end = datetime.date.fromisoformat(match.group(2) or match.group(1))
+    except ValueError:
+        return None
+    return Q(
+        created_at__gte=make_aware(datetime.datetime.combine(start, datetime.time())),
+        created_at__lt=make_aware(
+            datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time())
+        ),
+    )
+
+
+def search_filter(term: str) -> Q:
+    """
+    Return the filter for a Visitor search term, according to its shape.
+
+    Each shape is matched using an index:
+
+        68201321-9dd2-4fb3-92b1-24367f38a7d6    uuid
+        fred@example.com                        email (exact)
+        fred*                                   email (prefix)
+        scope:foo                               scope
+        2024-01-31, 2024-01-01..2024-01-31      created_at (date range)
+
+    Anything else matches first or last name (every word), which is indexed
+    on PostgreSQL only - by trigram indexes on UPPER(name), as icontains uses.
+
+    """
+    try:
+        return Q(uuid=uuid.UUID(term))
+    except ValueError:
+        pass
+    if term.startswith(SCOPE_PREFIX):
+        return Q(scope=term.split(":", 1)[1].strip())
+    if (date_range := _date_range(term)) is not None:
+        return date_range
+    if term.endswith("*"):
+        return Q(email__startswith=term[:-1])
+    if "@" in term:
+        return Q(email=term)
+    query = Q()
+    for word in term.split():
+        query &= Q(first_name__icontains=word) | Q(last_name__icontains=word)
+    return query
+
+
 @admin.register(Visitor)
 class VisitorsAdmin(admin.ModelAdmin):
     """Admin model for Visitor objects."""
 
     def deactivate(self, request: HttpRequest, queryset: QuerySet) -> None:
-        """Call deactivate on all selected Visitor objects."""
-        count = queryset.count()
-        for obj in queryset:
-            obj.deactivate()
+        """Deactivate all selected Visitor objects."""
+        count = queryset.deactivate()
         self.message_user(
             request, f"{count} passes have been disabled.", messages.SUCCESS
         )
@@ -37,9 +104,7 @@ class VisitorsAdmin(admin.ModelAdmin):
 
     def reactivate(self, request: HttpRequest, queryset: QuerySet) -> None:
         """Reactivate all selected Visitor objects."""
-        count = queryset.count()
-        for obj in queryset:
-            obj.reactivate()
+        count = queryset.reactivate()
         self.message_user(
             request, f"{count} passes have been activated.", messages.SUCCESS
         )
@@ -47,7 +112,7 @@ class VisitorsAdmin(admin.ModelAdmin):
     reactivate.short_description = "Reactivate selected Visitor passes"  # type: ignore
 
     actions = (deactivate, reactivate)
-    list_filter = ("scope",)
+    list_filter = ("scope", "is_active")
     list_display = (
         "scope",
         "email",
@@ -55,6 +120,8 @@ class VisitorsAdmin(admin.ModelAdmin):
         "expires_at",
         "is_active",
         "_is_valid",
+        "visit_count",
+        "last_visited_at",
     )
     readonly_fields = (
         "uuid",
@@ -63,15 +130,31 @@ class VisitorsAdmin(admin.ModelAdmin):
         "_context",
         "is_active",
         "expires_at",
+        "visit_count",
+        "last_visited_at",
     )
-    search_fields = (
-        "first_name",
-        "last_name",
-        "email",
-        "scope",
-        "created_at",
+    # NB see get_search_results - these are only used for free text
+    search_fields = ("first_name", "last_name")
+    search_help_text = (
+        "Search by uuid, email (or prefix*), scope:<scope>, date "
+        "(YYYY-MM-DD[..YYYY-MM-DD]) or name."
     )
 
+    def get_search_results(
+        self, request: HttpRequest, queryset: QuerySet, search_term: str
+    ) -> Tuple[QuerySet, bool]:
+        if not (term := search_term.strip()):
+            return queryset, False
+        return queryset.filter(search_filter(term)), False
+
+    def save_model(
+        self, request: HttpRequest, obj: Visitor, form: Any, change: bool
+    ) -> None:
+        if not change:
+            return super().save_model(request, obj, form, change)
+        # don't overwrite the counters, updated by the "counts" sink meanwhile
+        obj.save(update_fields=obj.get_update_fields())
+
     def _is_valid(self, obj: Visitor) -> bool:
         return obj.is_valid
 
@@ -83,15 +166,103 @@ class VisitorsAdmin(admin.ModelAdmin):
     _context.short_description = "Context (prettified)"  # type: ignore
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that does not COUNT(*) large tables.
+
+    Up to MAX_COUNT rows are counted - beyond that, the count is the query
+    planner's estimate on PostgreSQL, and MAX_COUNT elsewhere (so pages past
+    that are not linked to).
+
+    """
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list.order_by()
+        if (count := queryset[: MAX_COUNT + 1].count()) <= MAX_COUNT:
+            return count
+        if connections[queryset.db].vendor != "postgresql":
+            return MAX_COUNT
+        plan = json.loads(queryset.explain(format="json"))
+        return max(int(plan[0]["Plan"]["Plan Rows"]), count)
+
+
+class VisitorLogChangeList(ChangeList):
+    """Changelist that loads only the columns that are displayed."""
+
+    def get_queryset(self, request: HttpRequest, *args: Any, **kwargs: Any) -> QuerySet:
+        return (
+            super()
+            .get_queryset(request, *args, **kwargs)
+            .only(*self.model_admin.list_only)
+        )
+
+
 @admin.register(VisitorLog)
 class VisitorLogAdmin(admin.ModelAdmin):
+    """
+    Admin model for VisitorLog objects - which may run to very many rows.
+
+    The changelist is limited to the current month by default (see
+    changelist_view), as the date hierarchy would otherwise have to find every
+    distinct year in the table, and is paginated using estimated counts.
+
+    """
+
     list_display = (
         "visitor",
         "session_key",
+        "_remote_addr",
+        "request_uri",
+        "status_code",
+        "timestamp",
+    )
+    # the fields required to display the list_display columns
+    list_only = (
+        "visitor__email",
+        "visitor__scope",
+        "session_key",
         "remote_addr",
+        "remote_addr_ref__value",
         "request_uri",
         "status_code",
         "timestamp",
     )
+    list_select_related = ("visitor", "remote_addr_ref")
+    date_hierarchy = "timestamp"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = [f.name for f in VisitorLog._meta.fields]
-    pass
+
+    def get_changelist(self, request: HttpRequest, **kwargs: Any) -> Type[ChangeList]:
+        return VisitorLogChangeList
+
+    def changelist_view(
+        self, request: HttpRequest, extra_context: Optional[Dict[str, Any]] = None
+    ) -> HttpResponse:
+        if not request.GET:
+            today = localtime()
+            return HttpResponseRedirect(
+                f"{request.path}?timestamp__year={today.year}"
+                f"&timestamp__month={today.month}"
+            )
+        return super().changelist_view(request, extra_context)
+
+    def _remote_addr(self, obj: VisitorLog) -> str:
+        return obj.get_value("remote_addr")
+
+    _remote_addr.short_description = "Remote addr"  # type: ignore
+
+
+@admin.register(VisitorLogRollup)
+class VisitorLogRollupAdmin(admin.ModelAdmin):
+    list_display = (
+        "visitor",
+        "request_uri",
+        "status_code",
+        "bucket",
+        "hits",
+        "first_seen_at",
+        "last_seen_at",
+    )
+    readonly_fields = [f.name for f in VisitorLogRollup._meta.fields]
@@ -5,3 +5,10 @@ class VisitorsConfig(AppConfig):
     name = "visitors"
     verbose_name = "Visitors"
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self) -> None:
+        from . import signals, writers  # noqa: F401
+
+        # created up front so that any SIGTERM handler is installed from the
+        # main thread - see writers.exit_on_sigterm
+        writers.get_writer()
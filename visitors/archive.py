@@ -0,0 +1,191 @@
+"""
+Streaming export of VisitorLog records to compressed files.
+
+Records older than a cutoff are read in batches using keyset pagination on
+the primary key (with the cutoff as a filter) - so each batch is a B-tree
+index range scan, however far through the table it is - and written to
+gzipped JSON lines (or CSV) files, one per day (UTC). Only one batch is held
+at a time, so memory use does not depend on the number of records.
+
+Ids only roughly follow timestamps (e.g. logs queued by the buffered writers),
+so a day's file is kept open until logs two days later are read - any logs
+for a day after its file is closed go in another "part" file for that day.
+
+A manifest (manifest.json) lists each file with its row count, time range and
+SHA-256 checksum, and the id range of each batch - so that exactly the logs
+exported can then be deleted (see `purge.purge_exported`).
+
+"""
+
+from __future__ import annotations
+
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import os
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+
+from .models import VisitorLog
+from .sinks import to_dict
+
+FORMATS = ("jsonl", "csv")
+
+MANIFEST = "manifest.json"
+
+# fields written to CSV files, in order
+CSV_FIELDS = [
+    "visitor",
+    "scope",
+    "timestamp",
+    "session_key",
+    "http_method",
+    "request_uri",
+    "query_string",
+    "remote_addr",
+    "http_user_agent",
+    "http_referer",
+    "status_code",
+    "sample_weight",
+]
+
+
+def iter_batches(
+    cutoff: datetime.datetime, batch_size: int
+) -> Iterator[List[VisitorLog]]:
+    """Yield batches of the logs older than cutoff, in id order."""
+    # stop at the last log older than cutoff, rather than scanning all the
+    # later logs for more
+    ids = VisitorLog.objects.filter(timestamp__lt=cutoff).aggregate(Max("id"))
+    if (max_id := ids["id__max"]) is None:
+        return
+    queryset = (
+        VisitorLog.objects.with_dimensions()
+        .filter(timestamp__lt=cutoff, id__lte=max_id)
+        .select_related("visitor")
+        .only(
+            "visitor__uuid",
+            "visitor__scope",
+            *CSV_FIELDS[2:],
+            *(f"{ref}__value" for ref in VisitorLog.DIMENSIONS.values()),
+        )
+        .order_by("id")
+    )
+    batch = list(queryset[:batch_size])
+    while batch:
+        yield batch
+        batch = list(queryset.filter(id__gt=batch[-1].id)[:batch_size])
+
+
+def iter_logs(cutoff: datetime.datetime, batch_size: int) -> Iterator[VisitorLog]:
+    """Yield logs older than cutoff in id order, a batch at a time."""
+    for batch in iter_batches(cutoff, batch_size):
+        yield from batch
+
+
+def checksum(path: str) -> str:
+    """Return the SHA-256 of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ArchiveFile:
+    """A gzipped file of logs for a single day."""
+
+    def __init__(
+        self, directory: str, day: datetime.date, fmt: str, part: int = 0
+    ) -> None:
+        self.day = day
+        self.format = fmt
+        name = f"visitorlog-{day.isoformat()}" + (f".{part}" if part else "")
+        self.path = os.path.join(directory, f"{name}.{fmt}.gz")
+        self.rows = 0
+        self.max_id = 0
+        self.first: Optional[datetime.datetime] = None
+        self.last: Optional[datetime.datetime] = None
+        self._file: IO[str] = gzip.open(self.path, "wt", encoding="utf-8", newline="")
+        if fmt == "csv":
+            self._writer = csv.DictWriter(self._file, CSV_FIELDS)
+            self._writer.writeheader()
+
+    def write(self, log: VisitorLog) -> None:
+        data = to_dict(log)
+        if self.format == "csv":
+            self._writer.writerow(data)
+        else:
+            self._file.write(json.dumps(data, cls=DjangoJSONEncoder) + "\n")
+        self.rows += 1
+        self.max_id = max(self.max_id, log.id)
+        self.first = min(self.first or log.timestamp, log.timestamp)
+        self.last = max(self.last or log.timestamp, log.timestamp)
+
+    def close(self) -> Dict[str, Any]:
+        """Close the file, and return its manifest entry."""
+        self._file.close()
+        return {
+            "file": os.path.basename(self.path),
+            "date": self.day.isoformat(),
+            "rows": self.rows,
+            "first_timestamp": self.first,
+            "last_timestamp": self.last,
+            "max_id": self.max_id,
+            "sha256": checksum(self.path),
+        }
+
+
+def load_manifest(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+
+def export(
+    cutoff: datetime.datetime, directory: str, fmt: str, batch_size: int
+) -> Iterator[Dict[str, Any]]:
+    """
+    Export logs older than cutoff to daily files, and write the manifest.
+
+    Yields the manifest entry for each file as it is completed - the manifest
+    itself is written once the export is complete. Its `id_ranges` are the
+    (first id, last id, rows) of each batch exported, so that the exported
+    logs can then be deleted using `purge.purge_exported(cutoff, id_ranges)`.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    files: List[Dict[str, Any]] = []
+    id_ranges: List[Tuple[int, int, int]] = []
+    current: Dict[datetime.date, ArchiveFile] = {}
+    parts: Dict[datetime.date, int] = {}
+    latest: Optional[datetime.date] = None
+    for batch in iter_batches(cutoff, batch_size):
+        for log in batch:
+            day = log.timestamp.astimezone(datetime.timezone.utc).date()
+            if day not in current:
+                current[day] = ArchiveFile(directory, day, fmt, parts.get(day, 0))
+                parts[day] = parts.get(day, 0) + 1
+            current[day].write(log)
+            if latest is None or day > latest:
+                latest = day
+                for closed in sorted(d for d in current if (latest - d).days > 1):
+                    files.append(current.pop(closed).close())
+                    yield files[-1]
+        id_ranges.append((batch[0].id, batch[-1].id, len(batch)))
+    for day in sorted(current):
+        files.append(current[day].close())
+        yield files[-1]
+    manifest = {
+        "cutoff": cutoff,
+        "format": fmt,
+        "rows": sum(f["rows"] for f in files),
+        "max_id": max((f["max_id"] for f in files), default=0),
+        "files": files,
+        "id_ranges": id_ranges,
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, cls=DjangoJSONEncoder, indent=2)
@@ -0,0 +1,264 @@
+"""
+Shared cache of resolved visitor passes.
+
+Passes are cached against their uuid as a compact record of the model field
+values, so that resolving `request.visitor` does not require a database query.
+Entries are written through on save (see `visitors.signals`), and unknown uuids
+are cached as a negative marker so that requests carrying bogus tokens do not
+all end up in the database.
+
+The shared cache is disabled unless VISITOR_CACHE_ALIAS is set. In front of it
+sits an optional per-process LRU (VISITOR_LOCAL_CACHE_SIZE), which saves the
+network round trip at the cost of changes made in other processes taking up
+to VISITOR_LOCAL_CACHE_TTL seconds to be seen.
+
+"""
+
+from __future__ import annotations
+
+import copy
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+from django.core.cache import BaseCache, caches
+from django.db.models import Model
+from django.utils.timezone import now as tz_now
+
+from .compat import acall
+from .settings import (
+    VISITOR_CACHE_ALIAS,
+    VISITOR_CACHE_NEGATIVE_TIMEOUT,
+    VISITOR_CACHE_TIMEOUT,
+    VISITOR_LOCAL_CACHE_SIZE,
+    VISITOR_LOCAL_CACHE_TTL,
+)
+
+KEY_PREFIX = "visitors:pass:"
+
+# Stored in place of a record for uuids that do not match a pass.
+DOES_NOT_EXIST = "does-not-exist"
+
+# Field values of a Visitor, keyed on attname.
+PassRecord = Dict[str, Any]
+CacheEntry = Union[PassRecord, str]
+
+
+class CacheStats:
+    """Thread-safe hit / miss counters for the current process."""
+
+    FIELDS = ("hits", "negative_hits", "misses")
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def reset(self) -> None:
+        with self._lock:
+            for name in self.FIELDS:
+                setattr(self, name, 0)
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+
+class LocalPassCache:
+    """Bounded, thread-safe, in-process LRU cache with per-entry expiry."""
+
+    def __init__(self, max_entries: int, ttl: int) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: OrderedDict[str, Tuple[float, CacheEntry]] = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        if not self.max_entries:
+            return None
+        with self._lock:
+            try:
+                expires, entry = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        # records are shared between threads, so protect the mutable
+        # contents (e.g. Visitor.context) from the caller.
+        return copy.deepcopy(entry)
+
+    def set(self, key: str, entry: CacheEntry, timeout: int) -> None:
+        if not self.max_entries:
+            return
+        expires = time.monotonic() + min(timeout, self.ttl)
+        # records share mutable values with the instance they came from, so
+        # keep a copy that later changes to the instance cannot reach.
+        entry = copy.deepcopy(entry)
+        with self._lock:
+            self._data[key] = (expires, entry)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys: Iterable[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+stats = CacheStats()
+local = LocalPassCache(VISITOR_LOCAL_CACHE_SIZE, VISITOR_LOCAL_CACHE_TTL)
+
+
+def get_cache() -> Optional[BaseCache]:
+    """Return the configured pass cache, or None if caching is disabled."""
+    if not VISITOR_CACHE_ALIAS:
+        return None
+    return caches[VISITOR_CACHE_ALIAS]
+
+
+def get_stats() -> Dict[str, int]:
+    """Return the shared cache hit / miss counters for this process."""
+    return stats.as_dict()
+
+
+def get_local_stats() -> Dict[str, int]:
+    """Return size, hit, miss and eviction counters for the local cache."""
+    return local.get_stats()
+
+
+def cache_key(visitor_uuid: Any) -> str:
+    return f"{KEY_PREFIX}{visitor_uuid}"
+
+
+def pass_timeout(expires_at: Optional[datetime.datetime]) -> int:
+    """Return the cache timeout for a pass - capped by its expiry."""
+    if not expires_at:
+        return VISITOR_CACHE_TIMEOUT
+    remaining = int((expires_at - tz_now()).total_seconds())
+    if remaining <= 0:
+        # expired passes are unlikely to change, but treat them as
+        # negative entries rather than keep them indefinitely.
+        return VISITOR_CACHE_NEGATIVE_TIMEOUT
+    return min(remaining, VISITOR_CACHE_TIMEOUT)
+
+
+def entry_timeout(entry: CacheEntry) -> int:
+    if isinstance(entry, dict):
+        return pass_timeout(entry["expires_at"])
+    return VISITOR_CACHE_NEGATIVE_TIMEOUT
+
+
+def to_record(visitor: Model) -> PassRecord:
+    """Return the compact (cacheable) record for a Visitor."""
+    return {
+        f.attname: getattr(visitor, f.attname) for f in visitor._meta.concrete_fields
+    }
+
+
+def _fetched(key: str, entry: Optional[CacheEntry]) -> Optional[CacheEntry]:
+    """Count an entry fetched from the shared cache, and keep it locally."""
+    if entry is None:
+        stats.incr("misses")
+        return None
+    if entry == DOES_NOT_EXIST:
+        stats.incr("negative_hits")
+    else:
+        stats.incr("hits")
+    local.set(key, entry, entry_timeout(entry))
+    return entry
+
+
+def get_entry(visitor_uuid: Any) -> Optional[CacheEntry]:
+    """
+    Return cached entry for the uuid.
+
+    Returns a PassRecord for known passes, DOES_NOT_EXIST for unknown
+    uuids, and None if the uuid is not cached (or caching is disabled).
+    The local cache is checked first, and populated from the shared cache.
+
+    """
+    key = cache_key(visitor_uuid)
+    if (entry := local.get(key)) is not None:
+        return entry
+    if (cache := get_cache()) is None:
+        return None
+    return _fetched(key, cache.get(key))
+
+
+async def aget_entry(visitor_uuid: Any) -> Optional[CacheEntry]:
+    """Async version of get_entry."""
+    key = cache_key(visitor_uuid)
+    if (entry := local.get(key)) is not None:
+        return entry
+    if (cache := get_cache()) is None:
+        return None
+    return _fetched(key, await acall(cache, "get", key))
+
+
+def set_entry(visitor_uuid: Any, entry: CacheEntry) -> None:
+    """Cache a pass record (until the pass expires), or DOES_NOT_EXIST."""
+    key = cache_key(visitor_uuid)
+    timeout = entry_timeout(entry)
+    local.set(key, entry, timeout)
+    if (cache := get_cache()) is None:
+        return
+    cache.set(key, entry, timeout=timeout)
+
+
+async def aset_entry(visitor_uuid: Any, entry: CacheEntry) -> None:
+    """Async version of set_entry."""
+    key = cache_key(visitor_uuid)
+    timeout = entry_timeout(entry)
+    local.set(key, entry, timeout)
+    if (cache := get_cache()) is None:
+        return
+    await acall(cache, "set", key, entry, timeout=timeout)
+
+
+def set_record(record: PassRecord) -> None:
+    """Cache a pass record until the pass expires (or timeout)."""
+    set_entry(record["uuid"], record)
+
+
+def set_missing(visitor_uuid: Any) -> None:
+    """Cache the fact that a uuid does not match any pass."""
+    set_entry(visitor_uuid, DOES_NOT_EXIST)
+
+
+def delete(visitor_uuids: Iterable[Any]) -> None:
+    """Remove cached entries for the given uuids."""
+    keys = [cache_key(u) for u in visitor_uuids]
+    local.delete(keys)
+    if (cache := get_cache()) is None:
+        return
+    cache.delete_many(keys)
@@ -0,0 +1,31 @@
+"""Compatibility shims for older versions of dependencies."""
+
+import asyncio
+from typing import Any
+
+from asgiref.sync import sync_to_async
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction  # type: ignore[assignment]
+
+    def markcoroutinefunction(func: Any) -> Any:
+        func._is_coroutine = asyncio.coroutines._is_coroutine  # type: ignore
+        return func
+
+
+async def acall(obj: Any, name: str, *args: Any, **kwargs: Any) -> Any:
+    """
+    Await `obj.a<name>(...)`, or call `obj.<name>(...)` in a thread.
+
+    Django added async methods to the cache in 4.0, and to the ORM in 4.1 -
+    older versions fall back to the sync method.
+
+    """
+    if (method := getattr(obj, f"a{name}", None)) is not None:
+        return await method(*args, **kwargs)
+    return await sync_to_async(getattr(obj, name))(*args, **kwargs)
+
+
+__all__ = ["acall", "iscoroutinefunction", "markcoroutinefunction"]
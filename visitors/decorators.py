@@ -9,7 +9,10 @@ from django.core.exceptions import PermissionDenied
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import gettext as _
 
-from .models import VisitorLog
+from . import sampling
+from .compat import iscoroutinefunction
+from .models import Visitor
+from .writers import awrite_log, write_log
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +48,24 @@ def _get_request_arg(*args: Any) -> Optional[HttpRequest]:
     return None
 
 
+def _check_scope(visitor: Optional[Visitor], scope: str) -> Visitor:
+    """Raise PermissionDenied if there is no visitor, or it has the wrong scope."""
+    if not visitor:
+        raise PermissionDenied(_("Visitor access denied"))
+    # Check the function scope matches (or is "*")
+    if scope not in (SCOPE_ANY, visitor.scope):
+        raise PermissionDenied(_("Visitor access denied (invalid scope)."))
+    return visitor
+
+
+async def _aget_visitor(request: HttpRequest) -> Optional[Visitor]:
+    # request.avisitor is set by VisitorMiddleware - fall back to the
+    # sync request.visitor if it has been set by other means.
+    if avisitor := getattr(request, "avisitor", None):
+        return await avisitor()
+    return request.visitor
+
+
 def user_is_visitor(  # noqa: C901
     view_func: Optional[Callable] = None,
     # scope must be a kwarg as view_func is one, but we want to disallow
@@ -65,7 +86,12 @@ def user_is_visitor(  # noqa: C901
     scope allowed).
 
     The 'log_visit' arg can be used to override the default logging - if this
-    is too noisy, for instance.
+    is too noisy, for instance. Visits are logged using the VISITOR_LOG_WRITER
+    (see visitors.writers), and can be sampled or rate-limited per scope (see
+    visitors.sampling).
+
+    Coroutine (async) views are supported - the visitor is resolved and the
+    visit logged using the async APIs.
 
     """
     if not scope:
@@ -76,6 +102,9 @@ def user_is_visitor(  # noqa: C901
             user_is_visitor, scope=scope, bypass_func=bypass_func, log_visit=log_visit
         )
 
+    if iscoroutinefunction(view_func):
+        return _async_user_is_visitor(view_func, scope, bypass_func, log_visit)
+
     @functools.wraps(view_func)
     def inner(*args: Any, **kwargs: Any) -> HttpResponse:
         # should never happen, but keeps mypy happy as it _could_
@@ -94,18 +123,38 @@ def user_is_visitor(  # noqa: C901
         if bypass_func and bypass_func(request):
             return view_func(*args, **kwargs)
 
-        # Do we have a visitor?
-        if not request.user.is_visitor:
-            raise PermissionDenied(_("Visitor access denied"))
+        # Do we have a visitor with the right scope? (NB not is_visitor on
+        # request.user, which would force the evaluation of the lazy user.)
+        _check_scope(request.visitor, scope)
+        response = view_func(*args, **kwargs)
+        if log_visit and (weight := sampling.get_weight(request, request.visitor)):
+            write_log(request, response, weight)
+        return response
 
-        # Check the function scope matches (or is "*")
-        if scope in (SCOPE_ANY, request.visitor.scope):
-            response = view_func(*args, **kwargs)
-            if log_visit:
-                VisitorLog.objects.create_log(request, response.status_code)
-            return response
+    return inner
 
-        # We have a visitor with the wrong scope
-        raise PermissionDenied(_("Visitor access denied (invalid scope)."))
+
+def _async_user_is_visitor(
+    view_func: Callable,
+    scope: str,
+    bypass_func: Optional[Callable[[HttpRequest], bool]],
+    log_visit: bool,
+) -> Callable:
+    """Decorate coroutine view functions - see user_is_visitor."""
+
+    @functools.wraps(view_func)
+    async def inner(*args: Any, **kwargs: Any) -> HttpResponse:
+        request = _get_request_arg(*args)
+        if not request:
+            raise ValueError("Request argument missing.")
+
+        if bypass_func and bypass_func(request):
+            return await view_func(*args, **kwargs)
+
+        visitor = _check_scope(await _aget_visitor(request), scope)
+        response = await view_func(*args, **kwargs)
+        if log_visit and (weight := await sampling.aget_weight(request, visitor)):
+            await awrite_log(request, response, weight)
+        return response
 
     return inner
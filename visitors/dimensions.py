@@ -0,0 +1,98 @@
+"""
+Interning of repetitive VisitorLog values.
+
+The user agent, referer, querystring and client address of each log are
+highly repetitive - a handful of user agents account for most visits. When
+logs are written with {"class": "database", "normalize": True} these values
+are stored once each, in dimension tables (see LogDimension), and each log
+references them by id.
+
+Dimension ids are memoized in each process, so once a value has been seen
+normalizing a log costs no queries at all. New values are inserted in bulk,
+once per batch of logs.
+
+"""
+
+from __future__ import annotations
+
+import copy
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+from .models import LogDimension, VisitorLog
+
+# Maximum number of dimension ids memoized in each process.
+MEMO_SIZE = 10000
+
+MemoKey = Tuple[Type[LogDimension], str]
+
+
+class Memo:
+    """Bounded, thread-safe, LRU map of (dimension, hash) to id."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: OrderedDict[MemoKey, int] = OrderedDict()
+
+    def get(self, key: MemoKey) -> Optional[int]:
+        with self._lock:
+            if (value := self._data.get(key)) is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: MemoKey, value: int) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+memo = Memo(MEMO_SIZE)
+
+
+def get_ids(model: Type[LogDimension], values: Iterable[str]) -> Dict[str, int]:
+    """Return the dimension id of each (non-empty) value, creating as required."""
+    ids: Dict[str, int] = {}
+    missing: Dict[str, str] = {}
+    for value in set(values):
+        if not value:
+            continue
+        value_hash = model.get_hash(value)
+        if (value_id := memo.get((model, value_hash))) is not None:
+            ids[value] = value_id
+        else:
+            missing[value_hash] = value
+    if not missing:
+        return ids
+    found = dict(model.objects.filter(hash__in=missing).values_list("hash", "id"))
+    if new := [model(hash=h, value=v) for h, v in missing.items() if h not in found]:
+        # NB ignore_conflicts means ids are not returned, hence the re-select
+        model.objects.bulk_create(new, ignore_conflicts=True)
+        found.update(
+            model.objects.filter(hash__in=[d.hash for d in new]).values_list(
+                "hash", "id"
+            )
+        )
+    for value_hash, value_id in found.items():
+        memo.set((model, value_hash), value_id)
+        ids[missing[value_hash]] = value_id
+    return ids
+
+
+def normalize(logs: List[VisitorLog]) -> List[VisitorLog]:
+    """Return copies of the logs with their text values replaced by ids."""
+    copies = [copy.copy(log) for log in logs]
+    for name, ref in VisitorLog.DIMENSIONS.items():
+        model = VisitorLog._meta.get_field(ref).related_model
+        ids = get_ids(model, [getattr(log, name) for log in copies])
+        for log in copies:
+            setattr(log, f"{ref}_id", ids.get(getattr(log, name)))
+            setattr(log, name, "")
+    return copies
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from typing import Any, Optional, Type
+
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.backends.ddl_references import Statement
+from django.db.models import Index, Model
+
+
+class BlockRangeIndex(Index):
+    """
+    BRIN index on PostgreSQL, and a regular (B-tree) index elsewhere.
+
+    A BRIN index stores the range of values in each block of the table, so
+    it is tiny, and cheap to maintain, for columns that grow with insertion
+    order - such as VisitorLog.timestamp. It serves range filters, but not
+    ORDER BY.
+
+    """
+
+    def create_sql(
+        self,
+        model: Type[Model],
+        schema_editor: BaseDatabaseSchemaEditor,
+        using: str = "",
+        **kwargs: Any,
+    ) -> Optional[Statement]:
+        if schema_editor.connection.vendor == "postgresql":
+            using = " USING brin"
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
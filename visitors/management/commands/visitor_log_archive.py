@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import datetime
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.utils.timezone import now as tz_now
+
+from visitors import archive, purge
+from visitors.settings import VISITOR_LOG_RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = (
+        "Export VisitorLog records older than the retention period to gzipped "
+        "daily files (with a manifest), and optionally delete them."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("output", help="Directory to write the files to.")
+        parser.add_argument(
+            "--log-retention-days",
+            type=int,
+            default=VISITOR_LOG_RETENTION_DAYS,
+            help="Export logs older than this (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--format",
+            choices=archive.FORMATS,
+            default="jsonl",
+            help="File format (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of logs read, and deleted, at a time (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the exported logs once exported.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to sleep between deleted batches (default: %(default)s).",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if (days := options["log_retention_days"]) is None:
+            raise CommandError(
+                "No retention period set - see VISITOR_LOG_RETENTION_DAYS."
+            )
+        cutoff = tz_now() - datetime.timedelta(days=days)
+        rows = 0
+        for entry in archive.export(
+            cutoff, options["output"], options["format"], options["batch_size"]
+        ):
+            rows += entry["rows"]
+            self.stdout.write(f"{entry['file']}: {entry['rows']} rows")
+        self.stdout.write(
+            self.style.SUCCESS(f"Exported {rows} rows older than {cutoff}.")
+        )
+        if not (options["delete"] and rows):
+            return
+        # only the id ranges exported, as recorded in the manifest
+        id_ranges = archive.load_manifest(options["output"])["id_ranges"]
+        total = 0
+        for progress in purge.purge_exported(cutoff, id_ranges):
+            total += progress.deleted
+            time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} rows."))
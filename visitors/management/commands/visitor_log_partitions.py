@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import datetime
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections, router, transaction
+from django.utils.timezone import now as tz_now
+
+from visitors.models import VisitorLog
+from visitors.partitions import INTERVALS, LogPartitions
+from visitors.settings import (
+    VISITOR_LOG_PARTITION_INTERVAL,
+    VISITOR_LOG_PARTITIONS_AHEAD,
+    VISITOR_LOG_RETENTION_DAYS,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create VisitorLog partitions ahead of time, and drop expired ones "
+        "(PostgreSQL only)."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--setup",
+            action="store_true",
+            help="Convert the VisitorLog table to a partitioned table (run once).",
+        )
+        parser.add_argument(
+            "--interval",
+            choices=INTERVALS,
+            default=VISITOR_LOG_PARTITION_INTERVAL,
+            help="Partition interval (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            default=VISITOR_LOG_PARTITIONS_AHEAD,
+            help="Number of future partitions to create (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=VISITOR_LOG_RETENTION_DAYS,
+            help="Drop partitions that ended more than this many days ago.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Print the SQL rather than run it.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        connection = connections[router.db_for_write(VisitorLog)]
+        if connection.vendor != "postgresql":
+            self.stdout.write("VisitorLog partitioning requires PostgreSQL - skipping.")
+            return
+        partitions = LogPartitions(connection, options["interval"])
+        now = tz_now()
+        prepare: List[str] = []
+        sql: List[str] = []
+        if not partitions.is_partitioned():
+            if not options["setup"]:
+                raise CommandError(
+                    "VisitorLog table is not partitioned - run with --setup first."
+                )
+            prepare += partitions.prepare_sql(now)
+            sql += partitions.setup_sql(now)
+            # the legacy partition holds everything up to the end of the
+            # current interval
+            after = partitions.setup_end(now)
+        else:
+            after = max(
+                (upper for _, upper in partitions.get_partitions() if upper),
+                default=None,
+            )
+        sql += partitions.create_sql(now, options["ahead"], after=after)
+        if (days := options["retention_days"]) is not None:
+            sql += partitions.drop_sql(now - datetime.timedelta(days=days))
+        self.execute_sql(connection, prepare, sql, options["dry_run"])
+
+    def execute_sql(
+        self, connection: Any, prepare: List[str], sql: List[str], dry_run: bool
+    ) -> None:
+        for statement in prepare + sql:
+            self.stdout.write(f"{statement};")
+        if dry_run:
+            return
+        # each committed as it runs - CREATE INDEX CONCURRENTLY can't be run
+        # in a transaction, and the validation must not hold its lock until
+        # the end of the setup
+        with connection.cursor() as cursor:
+            for statement in prepare:
+                cursor.execute(statement)
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for statement in sql:
+                    cursor.execute(statement)
+        count = len(prepare) + len(sql)
+        self.stdout.write(self.style.SUCCESS(f"Executed {count} statements."))
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import datetime
+import time
+from typing import Any, Callable, Iterator, Optional
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db.models import QuerySet
+from django.utils.timezone import now as tz_now
+
+from visitors import purge
+from visitors.settings import VISITOR_LOG_RETENTION_DAYS, VISITOR_RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete VisitorLog records, and expired or inactive Visitor passes, "
+        "older than their retention period - in chunks."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--log-retention-days",
+            type=int,
+            default=VISITOR_LOG_RETENTION_DAYS,
+            help="Delete logs older than this (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--visitor-retention-days",
+            type=int,
+            default=VISITOR_RETENTION_DAYS,
+            help=(
+                "Delete passes that expired, or were deactivated, more than this "
+                "many days ago (default: %(default)s)."
+            ),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Number of ids deleted at a time (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0.1,
+            help="Seconds to sleep between chunks (default: %(default)s).",
+        )
+        parser.add_argument(
+            "--log-start-id",
+            type=int,
+            help="Resume deleting logs from this id.",
+        )
+        parser.add_argument(
+            "--visitor-start-id",
+            type=int,
+            help="Resume deleting passes from this id.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the rows that would be deleted, but do not delete them.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        log_days = options["log_retention_days"]
+        visitor_days = options["visitor_retention_days"]
+        if log_days is None and visitor_days is None:
+            raise CommandError(
+                "No retention period set - see VISITOR_LOG_RETENTION_DAYS and "
+                "VISITOR_RETENTION_DAYS."
+            )
+        if log_days is not None:
+            self.purge(
+                "VisitorLog",
+                self.cutoff(log_days),
+                purge.expired_logs,
+                purge.purge_logs,
+                options["log_start_id"],
+                **options,
+            )
+        if visitor_days is not None:
+            self.purge(
+                "Visitor",
+                self.cutoff(visitor_days),
+                purge.expired_visitors,
+                purge.purge_visitors,
+                options["visitor_start_id"],
+                **options,
+            )
+
+    def cutoff(self, days: int) -> datetime.datetime:
+        return tz_now() - datetime.timedelta(days=days)
+
+    def purge(
+        self,
+        name: str,
+        cutoff: datetime.datetime,
+        expired: Callable[[datetime.datetime], QuerySet],
+        delete: Callable[..., Iterator[purge.Progress]],
+        start_id: Optional[int],
+        **options: Any,
+    ) -> None:
+        if options["dry_run"]:
+            count = expired(cutoff).count()
+            self.stdout.write(f"{name}: {count} rows older than {cutoff} to delete.")
+            return
+        total = 0
+        for progress in delete(cutoff, options["chunk_size"], start_id):
+            total += progress.deleted
+            self.stdout.write(
+                f"{name}: deleted {progress.deleted} rows "
+                f"(total {total}, next id {progress.next_id} of {progress.max_id})"
+            )
+            time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"{name}: deleted {total} rows."))
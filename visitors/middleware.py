@@ -1,104 +1,295 @@
 from __future__ import annotations
 
 import logging
-from typing import Callable
+from typing import Any, Awaitable, Callable, Optional, Union
 
 from django.conf import settings
 from django.core.exceptions import MiddlewareNotUsed
 from django.http.request import HttpRequest
 from django.http.response import HttpResponse
+from django.utils.functional import LazyObject, SimpleLazyObject, empty
 
-from . import session
+from . import revocation, session, tokens
+from .compat import iscoroutinefunction, markcoroutinefunction
 from .models import InvalidVisitorPass, Visitor
 from .settings import VISITOR_QUERYSTRING_KEY
 
 logger = logging.getLogger(__name__)
 
 
-class VisitorRequestMiddleware:
-    """Extract visitor token from incoming request."""
+def annotate_user(request: HttpRequest) -> None:
+    """
+    Set request.user.is_visitor lazily, from request.visitor.
+
+    The request.user set by AuthenticationMiddleware is itself lazy, and
+    evaluating it costs a session load and a user query - so rather than
+    set the attribute directly we wrap the user so that it is set only if
+    (and when) the user is accessed. The same applies to request.auser,
+    the async equivalent.
+
+    """
+    if (user := getattr(request, "user", None)) is not None:
+
+        def _get_user() -> Any:
+            user.is_visitor = bool(request.visitor)
+            return user
+
+        request.user = SimpleLazyObject(_get_user)
+
+    if (auser := getattr(request, "auser", None)) is not None:
+
+        async def _auser() -> Any:
+            user = await auser()
+            user.is_visitor = bool(await request.avisitor())
+            return user
+
+        request.auser = _auser
+
+
+def is_resolved(visitor: Any) -> bool:
+    """Return True if request.visitor is not lazy, or has already been resolved."""
+    return not (isinstance(visitor, LazyObject) and visitor._wrapped is empty)
+
+
+def has_token(request: HttpRequest) -> bool:
+    """Return True if the request querystring includes a visitor token."""
+    return bool(request.GET.get(VISITOR_QUERYSTRING_KEY))
+
+
+class SyncAndAsyncMiddleware:
+    """
+    Base class for middleware that supports both sync and async requests.
+
+    Subclasses implement `call` and `acall` - the latter is used when the
+    middleware chain is async, so that ASGI requests do not incur a thread
+    switch in order to pass through the middleware.
+
+    """
+
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response: Callable):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
-    def __call__(self, request: HttpRequest) -> HttpResponse:
-        request.visitor = None
-        request.user.is_visitor = False
-        visitor_uuid = request.GET.get(VISITOR_QUERYSTRING_KEY)
-        if not visitor_uuid:
-            return self.get_response(request)
+    def __call__(
+        self, request: HttpRequest
+    ) -> Union[HttpResponse, Awaitable[HttpResponse]]:
+        if self.async_mode:
+            return self.acall(request)
+        return self.call(request)
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        raise NotImplementedError
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        raise NotImplementedError
+
+
+class VisitorMiddleware(SyncAndAsyncMiddleware):
+    """
+    Resolve request.visitor from the querystring token or session.
+
+    request.visitor is set to a lazy object, so nothing is looked up (and
+    the session is not read) until it is first accessed - by the decorator,
+    the context processor, or view code. Async code should use the
+    coroutine `request.avisitor()` instead, which resolves the visitor
+    using the async cache, session and ORM APIs. The exception is a request
+    with a querystring token, which is resolved (if nothing has done so) once
+    the response is returned, so that it is stashed in the session.
+
+    The visitor token is taken from the querystring if there is one (and it
+    is valid), else from the session. Plain (uuid) tokens are looked up once (via the pass
+    cache, if enabled) and validated; signed tokens are validated without a
+    lookup, and only checked for revocation. The same rules apply whichever
+    way the visitor arrived, so expired or inactive passes are rejected. A
+    visitor resolved from a token is stashed in the session once the
+    response is returned, so that subsequent requests do not need it.
+
+    """
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        self.set_visitor(request)
+        response = self.get_response(request)
+        self.update_session(request)
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        self.set_visitor(request)
+        response = await self.get_response(request)
+        await self.aupdate_session(request)
+        return response
+
+    def set_visitor(self, request: HttpRequest) -> None:
+        """Set the lazy request.visitor, and request.avisitor()."""
+
+        async def avisitor() -> Optional[Visitor]:
+            if not is_resolved(request.visitor):
+                request.visitor = await self.aget_visitor(request)
+            return request.visitor
+
+        request.visitor = SimpleLazyObject(lambda: self.get_visitor(request))
+        request.avisitor = avisitor
+        annotate_user(request)
+
+    def get_visitor(self, request: HttpRequest) -> Optional[Visitor]:
+        """Return the valid Visitor for the request, if any."""
+        # a token that is no longer valid falls back to the session
+        if token := request.GET.get(VISITOR_QUERYSTRING_KEY):
+            if visitor := self.get_valid_visitor(token):
+                return visitor
+        if not (token := session.get_visitor_uuid(request)):
+            return None
+        if visitor := self.get_valid_visitor(token):
+            return visitor
+        session.clear_visitor_uuid(request)
+        return None
+
+    async def aget_visitor(self, request: HttpRequest) -> Optional[Visitor]:
+        """Async version of get_visitor."""
+        if token := request.GET.get(VISITOR_QUERYSTRING_KEY):
+            if visitor := await self.aget_valid_visitor(token):
+                return visitor
+        if not (token := await session.aget_visitor_uuid(request)):
+            return None
+        if visitor := await self.aget_valid_visitor(token):
+            return visitor
+        await session.aclear_visitor_uuid(request)
+        return None
+
+    def get_valid_visitor(self, token: str) -> Optional[Visitor]:
+        """Return the valid Visitor matching the token (uuid or signed), or None."""
+        if tokens.is_signed(token):
+            return self.get_signed_visitor(token)
         try:
-            visitor = Visitor.objects.get(uuid=visitor_uuid)
-            visitor.validate()
+            visitor = Visitor.objects.get_by_uuid(token)
         except Visitor.DoesNotExist:
-            logger.debug("Visitor pass does not exist: %s", visitor_uuid)
-            return self.get_response(request)
+            logger.debug("Visitor pass does not exist: %s", token)
+            return None
+        return self.validate(visitor)
+
+    async def aget_valid_visitor(self, token: str) -> Optional[Visitor]:
+        """Async version of get_valid_visitor."""
+        if tokens.is_signed(token):
+            return await self.aget_signed_visitor(token)
+        try:
+            visitor = await Visitor.objects.aget_by_uuid(token)
+        except Visitor.DoesNotExist:
+            logger.debug("Visitor pass does not exist: %s", token)
+            return None
+        return self.validate(visitor)
+
+    def get_signed_visitor(self, token: str) -> Optional[Visitor]:
+        """Return the valid Visitor from a signed token, or None."""
+        if not (visitor := self.validate_signed(token)):
+            return None
+        if revocation.is_revoked(visitor.uuid):
+            logger.debug("Visitor pass has been revoked: %s", visitor.uuid)
+            return None
+        return visitor
+
+    async def aget_signed_visitor(self, token: str) -> Optional[Visitor]:
+        """Async version of get_signed_visitor."""
+        if not (visitor := self.validate_signed(token)):
+            return None
+        if await revocation.ais_revoked(visitor.uuid):
+            logger.debug("Visitor pass has been revoked: %s", visitor.uuid)
+            return None
+        return visitor
+
+    def validate_signed(self, token: str) -> Optional[Visitor]:
+        """Check the signature and expiry of a signed token - no I/O."""
+        try:
+            visitor = Visitor.objects.from_signed_token(token)
         except InvalidVisitorPass as ex:
             logger.debug("Invalid access request: %s", ex)
-            return self.get_response(request)
+            return None
+        return self.validate(visitor)
+
+    def validate(self, visitor: Visitor) -> Optional[Visitor]:
+        try:
+            visitor.validate()
+        except InvalidVisitorPass as ex:
+            logger.debug("Invalid access request: %s", ex)
+            return None
+        return visitor
+
+    def update_session(self, request: HttpRequest) -> None:
+        """Stash a newly-arrived visitor in the session."""
+        # a visitor from the session alone need not be resolved just to
+        # stash it again, but one arriving with a token must be
+        if not is_resolved(request.visitor) and not has_token(request):
+            return
+        if not request.visitor:
+            return
+        if session.get_visitor_uuid(request) != request.visitor.session_data:
+            session.stash_visitor_uuid(request)
+
+    async def aupdate_session(self, request: HttpRequest) -> None:
+        """Async version of update_session."""
+        if is_resolved(request.visitor):
+            visitor = request.visitor
+        elif has_token(request):
+            visitor = await request.avisitor()
         else:
-            request.visitor = visitor
-            request.user.is_visitor = True
-        return self.get_response(request)
+            return
+        if not visitor:
+            return
+        if await session.aget_visitor_uuid(request) != visitor.session_data:
+            await session.astash_visitor_uuid(request)
 
 
-class VisitorSessionMiddleware:
-    """Extract visitor info from session and update request user."""
+class VisitorRequestMiddleware(VisitorMiddleware):
+    """Deprecated - use VisitorMiddleware, which handles token and session."""
 
-    def __init__(self, get_response: Callable):
-        self.get_response = get_response
 
-    def __call__(self, request: HttpRequest) -> HttpResponse:
-        """
-        Update request.user if any visitor vars are found in session.
-
-        This middleware should run after the VisitorRequestMiddleware. If
-        a request comes in without a visitor token in the querystring, we
-        need to check the request.session to see if any visitor data was
-        stashed previously.
-
-        The first time this middleware runs after a new session is created
-        this will push the `request.visitor` info into the session.
-        Subsequent requests will then get the data out of the session.
-
-        """
-        # This will only be true directly after VisitorRequestMiddleware
-        # has set the values. All subsequent requests in the session will
-        # start with is_visitor=False and pick up the visitor info from
-        # the session.
-        if request.visitor:
-            session.stash_visitor_uuid(request)
-            return self.get_response(request)
+class VisitorSessionMiddleware(VisitorMiddleware):
+    """
+    Deprecated - use VisitorMiddleware, which handles token and session.
 
-        # We don't have a visitor object, but there may be one in the session
-        if not (visitor_uuid := session.get_visitor_uuid(request)):
-            return self.get_response(request)
+    When used alongside VisitorRequestMiddleware (or VisitorMiddleware) the
+    visitor is already being handled, and this is a no-op. If request.visitor
+    has been set to a Visitor by other means it is stashed in the session.
 
-        try:
-            visitor = Visitor.objects.get(
-                uuid=visitor_uuid,
-                is_active=True,
-            )
-        except Visitor.DoesNotExist:
-            session.clear_visitor_uuid(request)
+    """
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        visitor = getattr(request, "visitor", None)
+        if isinstance(visitor, LazyObject):
             return self.get_response(request)
-        else:
-            request.visitor = visitor
-            request.user.is_visitor = True
+        if not visitor:
+            return super().call(request)
+        response = self.get_response(request)
+        self.update_session(request)
+        return response
 
-        return self.get_response(request)
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        visitor = getattr(request, "visitor", None)
+        if isinstance(visitor, LazyObject):
+            return await self.get_response(request)
+        if not visitor:
+            return await super().acall(request)
+        response = await self.get_response(request)
+        await self.aupdate_session(request)
+        return response
 
 
-class VisitorDebugMiddleware:
+class VisitorDebugMiddleware(SyncAndAsyncMiddleware):
     """Print out visitor info - DEBUG only."""
 
     def __init__(self, get_response: Callable):
         if not settings.DEBUG:
             raise MiddlewareNotUsed("VisitorDebugMiddleware disabled")
-        self.get_response = get_response
+        super().__init__(get_response)
 
-    def __call__(self, request: HttpRequest) -> HttpResponse:
-        logger.debug("request.user.is_visitor: %s", request.user.is_visitor)
-        if request.user.is_visitor:
-            logger.debug("request.visitor: %s", request.visitor)
+    def call(self, request: HttpRequest) -> HttpResponse:
+        # NB this forces the (lazy) request.visitor to be resolved
+        logger.debug("request.visitor: %s", request.visitor)
         return self.get_response(request)
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        logger.debug("request.visitor: %s", await request.avisitor())
+        return await self.get_response(request)
@@ -0,0 +1,103 @@
+"""
+Add a unique index on Visitor.uuid.
+
+Every request carrying a visitor token (or a stashed visitor session) looks up
+the pass by uuid, so this index is on the hot path. On PostgreSQL the index is
+built CONCURRENTLY (hence the non-atomic migration) so that it can be applied
+to a large, live table without blocking writes, and it INCLUDEs the columns
+required to validate a pass so that lookups can be satisfied by an index-only
+scan. Other backends fall back to Django's standard unique constraint.
+
+Duplicate uuids in legacy data would cause the index build to fail part way
+through, so they are checked for up front.
+
+"""
+
+import uuid
+
+from django.db import migrations, models
+from django.db.models import Count
+
+INDEX_NAME = "visitors_visitor_uuid_uniq"
+INCLUDE_COLUMNS = ("is_active", "expires_at", "scope")
+
+
+def check_duplicate_uuids(apps, schema_editor):
+    """Fail fast if existing Visitor rows share a uuid."""
+    Visitor = apps.get_model("visitors", "Visitor")
+    duplicates = list(
+        Visitor.objects.using(schema_editor.connection.alias)
+        .values("uuid")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .order_by()
+        .values_list("uuid", flat=True)[:10]
+    )
+    if duplicates:
+        raise RuntimeError(
+            "Unable to add unique index to Visitor.uuid - duplicate values found "
+            "(showing first 10): %s. Remove or regenerate the duplicate passes "
+            "and run the migration again." % ", ".join(str(u) for u in duplicates)
+        )
+
+
+class AlterVisitorUUIDUnique(migrations.AlterField):
+    """AlterField that builds the unique index concurrently on PostgreSQL."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_forwards(
+                app_label, schema_editor, from_state, to_state
+            )
+        model = to_state.apps.get_model(app_label, self.model_name)
+        table = schema_editor.quote_name(model._meta.db_table)
+        index = schema_editor.quote_name(INDEX_NAME)
+        include = ", ".join(schema_editor.quote_name(c) for c in INCLUDE_COLUMNS)
+        with schema_editor.connection.cursor() as cursor:
+            # a failed concurrent build leaves an INVALID index behind, which
+            # would be silently skipped by IF NOT EXISTS - so clear it first.
+            cursor.execute(
+                "SELECT NOT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+                [INDEX_NAME],
+            )
+            row = cursor.fetchone()
+        if row and row[0]:
+            schema_editor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index}")
+        schema_editor.execute(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {index} "
+            f'ON {table} ("uuid") INCLUDE ({include})'
+        )
+        # promoting the index to a constraint is a catalog-only change, and
+        # keeps the schema recognisable to Django's introspection.
+        schema_editor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {index} UNIQUE USING INDEX {index}"
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_backwards(
+                app_label, schema_editor, from_state, to_state
+            )
+        model = from_state.apps.get_model(app_label, self.model_name)
+        table = schema_editor.quote_name(model._meta.db_table)
+        index = schema_editor.quote_name(INDEX_NAME)
+        schema_editor.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {index}")
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("visitors", "0005_visitorlog_status_code"),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_uuids, migrations.RunPython.noop),
+        AlterVisitorUUIDUnique(
+            model_name="visitor",
+            name="uuid",
+            field=models.UUIDField(default=uuid.uuid4, unique=True),
+        ),
+    ]
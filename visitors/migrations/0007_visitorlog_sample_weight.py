@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("visitors", "0006_visitor_uuid_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="visitorlog",
+            name="sample_weight",
+            field=models.PositiveIntegerField(
+                default=1,
+                help_text="The number of visits this log represents, if logs are sampled.",
+            ),
+        ),
+    ]
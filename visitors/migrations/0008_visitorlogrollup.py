@@ -0,0 +1,60 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("visitors", "0007_visitorlog_sample_weight"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VisitorLogRollup",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("request_uri", models.URLField()),
+                (
+                    "status_code",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="HTTP Response"
+                    ),
+                ),
+                ("bucket", models.DateTimeField(help_text="Start of the time bucket.")),
+                (
+                    "hits",
+                    models.PositiveIntegerField(
+                        default=0,
+                        help_text="Number of visits (the sum of the log sample weights).",
+                    ),
+                ),
+                ("first_seen_at", models.DateTimeField()),
+                ("last_seen_at", models.DateTimeField()),
+                (
+                    "visitor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="visit_rollups",
+                        to="visitors.visitor",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="visitorlogrollup",
+            constraint=models.UniqueConstraint(
+                fields=("visitor", "request_uri", "status_code", "bucket"),
+                name="visitors_visitorlogrollup_uniq",
+            ),
+        ),
+    ]
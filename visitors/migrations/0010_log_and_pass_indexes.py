@@ -0,0 +1,64 @@
+"""
+Add indexes for the VisitorLog and Visitor access patterns.
+
+On PostgreSQL the indexes are built CONCURRENTLY (hence the non-atomic
+migration), so that they can be added to large, live tables without blocking
+writes. The VisitorLog timestamp index is BRIN there (see BlockRangeIndex),
+which serves date range filters, but not ORDER BY.
+
+"""
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import visitors.indexes
+from visitors.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("visitors", "0009_visitorlog_dimensions"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="visitor",
+            index=models.Index(
+                condition=models.Q(("is_active", True)),
+                fields=["scope", "expires_at"],
+                name="visitors_visitor_active_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="visitorlog",
+            index=models.Index(
+                fields=["visitor", "timestamp"], name="visitors_log_visitor_ts_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="visitorlog",
+            index=visitors.indexes.BlockRangeIndex(
+                fields=["timestamp"], name="visitors_log_timestamp_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="visitorlog",
+            index=models.Index(
+                fields=["status_code"], name="visitors_log_status_code_idx"
+            ),
+        ),
+        # the (visitor, timestamp) index replaces the FK index
+        migrations.AlterField(
+            model_name="visitorlog",
+            name="visitor",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="visits",
+                to="visitors.visitor",
+            ),
+        ),
+    ]
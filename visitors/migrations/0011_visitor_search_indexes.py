@@ -0,0 +1,80 @@
+"""
+Add indexes for the admin search of Visitor passes.
+
+Searches are routed by their shape (see VisitorsAdmin.get_search_results) -
+scope and date searches use the scope and created_at indexes, and free text
+is matched against first and last names with icontains. On PostgreSQL the
+names get trigram (pg_trgm) GIN indexes on UPPER(name::text) - the expression
+Django compiles icontains to, so that they serve it - which are not part of
+the model state, as other backends have no equivalent. All the indexes are
+built CONCURRENTLY on PostgreSQL (hence the non-atomic migration). Creating
+the pg_trgm extension may require elevated privileges - if so, create it
+beforehand.
+
+"""
+
+from django.db import migrations, models
+
+from visitors.operations import AddIndexConcurrently
+
+TRIGRAM_INDEXES = {
+    "visitors_visitor_first_name_upper_trgm": "first_name",
+    "visitors_visitor_last_name_upper_trgm": "last_name",
+}
+
+# indexes on the bare columns, which icontains can't use
+OLD_TRIGRAM_INDEXES = (
+    "visitors_visitor_first_name_trgm",
+    "visitors_visitor_last_name_trgm",
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    table = schema_editor.quote_name(
+        apps.get_model("visitors", "Visitor")._meta.db_table
+    )
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name in OLD_TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {schema_editor.quote_name(name)}"
+        )
+    for name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {schema_editor.quote_name(name)} "
+            f"ON {table} USING gin "
+            f"(UPPER({schema_editor.quote_name(column)}::text) gin_trgm_ops)"
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {schema_editor.quote_name(name)}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("visitors", "0010_log_and_pass_indexes"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="visitor",
+            index=models.Index(fields=["scope"], name="visitors_visitor_scope_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="visitor",
+            index=models.Index(
+                fields=["created_at"], name="visitors_visitor_created_idx"
+            ),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
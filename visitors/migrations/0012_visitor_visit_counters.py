@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("visitors", "0011_visitor_search_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="visitor",
+            name="last_visited_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="visitor",
+            name="visit_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
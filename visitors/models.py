@@ -1,29 +1,159 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
 import uuid
-from typing import Any
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, Union
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
-from django.db import models
+from django.core import signing
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import ExpressionWrapper, F, Q, Value
 from django.db.models.deletion import CASCADE
+from django.db.models.functions import Coalesce, Greatest, Least, Now
+from django.dispatch import Signal
 from django.http.request import HttpRequest
 from django.utils.timezone import now as tz_now
 from django.utils.translation import gettext_lazy as _lazy
 
-from .settings import VISITOR_QUERYSTRING_KEY, VISITOR_TOKEN_EXPIRY
+from . import cache, tokens
+from .compat import acall
+from .indexes import BlockRangeIndex
+from .settings import (
+    VISITOR_QUERYSTRING_KEY,
+    VISITOR_SIGNED_TOKENS,
+    VISITOR_TOKEN_EXPIRY,
+)
 
 
 class InvalidVisitorPass(Exception):
     pass
 
 
+# Sent by VisitorQuerySet.deactivate / reactivate, which update passes without
+# saving them (so post_save is not sent), with the `uuids` of the passes that
+# were updated, and their new `is_active`.
+passes_updated = Signal()
+
+
+class VisitorQuerySet(models.QuerySet):
+    def _update_passes(self, **values: Any) -> int:
+        """Update the passes in one query, and send passes_updated."""
+        with transaction.atomic(using=self.db):
+            uuids = list(self.values_list("uuid", flat=True))
+            if not uuids:
+                return 0
+            count = self.update(last_updated_at=Now(), **values)
+            passes_updated.send(
+                sender=self.model, uuids=uuids, is_active=values["is_active"]
+            )
+        return count
+
+    def deactivate(self) -> int:
+        """Deactivate the (active) passes, and return the number deactivated."""
+        return self.filter(is_active=True)._update_passes(is_active=False)
+
+    def record_visits(self, visits: Dict[int, Tuple[int, datetime.datetime]]) -> None:
+        """
+        Add to the visit counters of passes - `visits` is {id: (count, time)}.
+
+        Each pass is updated using F() expressions, so concurrent updates are
+        not lost, and in id order, so that concurrent batches do not deadlock.
+
+        """
+        for visitor_id, (count, visited_at) in sorted(visits.items()):
+            self.filter(id=visitor_id).update(
+                visit_count=F("visit_count") + count,
+                last_visited_at=Greatest(
+                    Coalesce("last_visited_at", Value(visited_at)), Value(visited_at)
+                ),
+            )
+
+    def reactivate(self) -> int:
+        """Reactivate the passes, resetting their expiry, and return the number."""
+        expires_at = ExpressionWrapper(
+            Now()
+            + Value(
+                self.model.DEFAULT_TOKEN_EXPIRY, output_field=models.DurationField()
+            ),
+            output_field=models.DateTimeField(),
+        )
+        return self._update_passes(is_active=True, expires_at=expires_at)
+
+
+class VisitorManager(models.Manager.from_queryset(VisitorQuerySet)):  # type: ignore
+    def _cache_key(self, visitor_uuid: Union[str, uuid.UUID]) -> str:
+        try:
+            return str(uuid.UUID(str(visitor_uuid)))
+        except ValueError:
+            raise self.model.DoesNotExist("Malformed visitor uuid.")
+
+    def _from_entry(self, entry: cache.CacheEntry) -> Visitor:
+        if not isinstance(entry, dict):
+            raise self.model.DoesNotExist("Visitor matching query does not exist.")
+        return self.model.from_db(self.db, list(entry), list(entry.values()))
+
+    def get_by_uuid(self, visitor_uuid: Union[str, uuid.UUID]) -> Visitor:
+        """
+        Return the Visitor matching the uuid - from the pass cache if enabled.
+
+        Raises Visitor.DoesNotExist if the uuid is malformed or unknown.
+
+        """
+        key = self._cache_key(visitor_uuid)
+        if entry := cache.get_entry(key):
+            return self._from_entry(entry)
+        try:
+            visitor = self.get(uuid=key)
+        except self.model.DoesNotExist:
+            cache.set_entry(key, cache.DOES_NOT_EXIST)
+            raise
+        cache.set_entry(key, cache.to_record(visitor))
+        return visitor
+
+    async def aget_by_uuid(self, visitor_uuid: Union[str, uuid.UUID]) -> Visitor:
+        """Async version of get_by_uuid."""
+        key = self._cache_key(visitor_uuid)
+        if entry := await cache.aget_entry(key):
+            return self._from_entry(entry)
+        try:
+            visitor = await acall(self, "get", uuid=key)
+        except self.model.DoesNotExist:
+            await cache.aset_entry(key, cache.DOES_NOT_EXIST)
+            raise
+        await cache.aset_entry(key, cache.to_record(visitor))
+        return visitor
+
+    def from_signed_token(self, token: str) -> Visitor:
+        """
+        Return a Visitor from a signed token, without a database lookup.
+
+        Only the fields carried by the token are loaded - accessing any other
+        field (e.g. email) loads it from the database. The pass is assumed to
+        be active, and is not validated - see visitors.revocation.
+
+        Raises InvalidVisitorPass if the token signature is invalid.
+
+        """
+        try:
+            claims = tokens.loads(token)
+        except signing.BadSignature:
+            raise InvalidVisitorPass("Visitor token signature is invalid")
+        visitor = self.model.from_db(
+            self.db,
+            ["id", "uuid", "scope", "expires_at", "is_active"],
+            [claims["i"], uuid.UUID(claims["u"]), claims["s"], claims["e"], True],
+        )
+        visitor.signed_token = token
+        return visitor
+
+
 class Visitor(models.Model):
     """A temporary visitor (betwixt anonymous and authenticated)."""
 
     DEFAULT_TOKEN_EXPIRY = datetime.timedelta(seconds=VISITOR_TOKEN_EXPIRY)
 
-    uuid = models.UUIDField(default=uuid.uuid4)
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True)
     first_name = models.CharField(max_length=150, blank=True)
     last_name = models.CharField(max_length=150, blank=True)
     email = models.EmailField(db_index=True)
@@ -52,9 +182,32 @@ class Visitor(models.Model):
         ),
     )
 
+    # maintained by the "counts" log sink - see VisitCountSink
+    visit_count = models.PositiveIntegerField(default=0, editable=False)
+    last_visited_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    objects = VisitorManager()
+
+    # updated using F() expressions - so left out of saves that change a pass
+    # (e.g. in the admin), as the loaded values may be stale
+    COUNTER_FIELDS = ("visit_count", "last_visited_at")
+
     class Meta:
         verbose_name = "Visitor pass"
         verbose_name_plural = "Visitor passes"
+        indexes = [
+            # passes that can still be used - partial, as most passes end up
+            # expired (and the predicate cannot include now()).
+            models.Index(
+                fields=["scope", "expires_at"],
+                condition=Q(is_active=True),
+                name="visitors_visitor_active_idx",
+            ),
+            # admin search (see VisitorsAdmin.get_search_results) - names have
+            # trigram indexes on PostgreSQL, see migration 0011.
+            models.Index(fields=["scope"], name="visitors_visitor_scope_idx"),
+            models.Index(fields=["created_at"], name="visitors_visitor_created_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"Visitor pass for {self.email} ({self.scope})"
@@ -67,16 +220,30 @@ class Visitor(models.Model):
 
     def __init__(self, *args: Any, **kwargs: Any):
         super().__init__(*args, **kwargs)
+        # NB checking a deferred expires_at (e.g. when loaded using only())
+        # would trigger a query, so leave it alone.
+        if "expires_at" in self.get_deferred_fields():
+            return
         if not self.expires_at:
             self.expires_at = self.created_at + self.DEFAULT_TOKEN_EXPIRY
 
+    def get_update_fields(self) -> List[str]:
+        """Return the fields to save when changing a pass - not the counters."""
+        return [
+            f.attname
+            for f in self._meta.concrete_fields
+            if not f.primary_key and f.attname not in self.COUNTER_FIELDS
+        ]
+
     @property
     def full_name(self) -> str:
         return f"{self.first_name} {self.last_name}"
 
     @property
     def session_data(self) -> str:
-        return str(self.uuid)
+        # passes resolved from a signed token stash the token, so that they
+        # can be validated on subsequent requests without a lookup.
+        return getattr(self, "signed_token", "") or str(self.uuid)
 
     @property
     def has_expired(self) -> bool:
@@ -114,31 +281,58 @@ class Visitor(models.Model):
             "context": self.context,
         }
 
-    def tokenise(self, url: str) -> str:
-        """Combine url with querystring token."""
+    def tokenise(self, url: str, signed: Optional[bool] = None) -> str:
+        """
+        Combine url with querystring token.
+
+        The token is the pass uuid, or a signed token (see visitors.tokens) if
+        `signed` is True - defaults to the VISITOR_SIGNED_TOKENS setting.
+
+        """
+        if signed is None:
+            signed = VISITOR_SIGNED_TOKENS
+        token = tokens.dumps(self) if signed else self.uuid
         # from https://stackoverflow.com/a/2506477/45698
         parts = list(urlparse(url))
-        query = parse_qs(parts[4])
-        query.update({VISITOR_QUERYSTRING_KEY: self.uuid})
+        query: dict = parse_qs(parts[4])
+        query.update({VISITOR_QUERYSTRING_KEY: token})
         parts[4] = urlencode(query)
         return urlunparse(parts)
 
     def deactivate(self) -> None:
         """Deactivate the token so it can no longer be used."""
         self.is_active = False
-        self.save()
+        self.save(update_fields=["is_active", "last_updated_at"])
 
     def reactivate(self) -> None:
         """Reactivate the token so it can be reused."""
         self.is_active = True
         self.expires_at = tz_now() + self.DEFAULT_TOKEN_EXPIRY
-        self.save()
+        self.save(update_fields=["is_active", "expires_at", "last_updated_at"])
+
+
+class DeletedVisitor(models.Model):
+    """
+    Tombstone of a pass deleted before it expired - see visitors.revocation.
+
+    Signed tokens for the pass remain valid until they expire, so the pass
+    must stay on the revocation list, which is rebuilt from these (as well as
+    from inactive passes) until then.
+
+    """
+
+    uuid = models.UUIDField(unique=True)
+    expires_at = models.DateTimeField(blank=True, null=True)
+    deleted_at = models.DateTimeField(default=tz_now)
+
+    def __str__(self) -> str:
+        return f"Deleted visitor pass {self.uuid}"
 
 
 class VisitorLogManager(models.Manager):
-    def create_log(self, request: HttpRequest, status_code: int) -> VisitorLog:
-        """Extract values from HttpRequest and store locally."""
-        return self.create(
+    def log_kwargs(self, request: HttpRequest, status_code: int) -> dict:
+        """Extract VisitorLog field values from HttpRequest."""
+        return dict(
             visitor=request.visitor,
             session_key=request.session.session_key or "",
             http_method=request.method,
@@ -158,11 +352,87 @@ class VisitorLogManager(models.Manager):
             status_code=status_code,
         )
 
+    def create_log(self, request: HttpRequest, status_code: int) -> VisitorLog:
+        """Extract values from HttpRequest and store locally."""
+        return self.create(**self.log_kwargs(request, status_code))
+
+    async def acreate_log(self, request: HttpRequest, status_code: int) -> VisitorLog:
+        """Async version of create_log."""
+        return await acall(self, "create", **self.log_kwargs(request, status_code))
+
+    def with_dimensions(self) -> models.QuerySet:
+        """Return logs with their interned values (see VisitorLog.get_value)."""
+        return self.select_related(*self.model.DIMENSIONS.values())
+
+
+class LogDimension(models.Model):
+    """
+    Abstract base for an interned VisitorLog value - see visitors.dimensions.
+
+    Each distinct value is stored once, and looked up by a hash of the value,
+    which (unlike the value itself) can be indexed whatever its length.
+
+    """
+
+    hash = models.CharField(max_length=32, unique=True)
+    value = models.TextField()
+
+    class Meta:
+        abstract = True
+
+    def __str__(self) -> str:
+        return self.value
+
+    @staticmethod
+    def get_hash(value: str) -> str:
+        return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+class UserAgent(LogDimension):
+    """Interned User-Agent header."""
+
+
+class Referer(LogDimension):
+    """Interned Referer header."""
+
+
+class QueryString(LogDimension):
+    """Interned request querystring."""
+
+
+class RemoteAddr(LogDimension):
+    """Interned client address."""
+
+
+def dimension_field(model: Type[LogDimension]) -> models.ForeignKey:
+    # Dimension rows are never deleted, and are only ever looked up by id,
+    # so there is no constraint or index to maintain on each insert.
+    return models.ForeignKey(
+        model,
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name="+",
+    )
+
 
 class VisitorLog(models.Model):
     """Log visitors."""
 
-    visitor = models.ForeignKey(Visitor, related_name="visits", on_delete=CASCADE)
+    # text fields that can be interned, and the dimension field for each
+    DIMENSIONS = {
+        "http_user_agent": "http_user_agent_ref",
+        "http_referer": "http_referer_ref",
+        "query_string": "query_string_ref",
+        "remote_addr": "remote_addr_ref",
+    }
+
+    # NB indexed by (visitor, timestamp) - see Meta.indexes
+    visitor = models.ForeignKey(
+        Visitor, related_name="visits", on_delete=CASCADE, db_index=False
+    )
     session_key = models.CharField(blank=True, max_length=40)
     http_method = models.CharField(max_length=10)
     request_uri = models.URLField()
@@ -172,5 +442,185 @@ class VisitorLog(models.Model):
     http_referer = models.TextField()
     status_code = models.PositiveIntegerField("HTTP Response", default=0)
     timestamp = models.DateTimeField(default=tz_now)
+    sample_weight = models.PositiveIntegerField(
+        default=1,
+        help_text=_lazy(
+            "The number of visits this log represents, if logs are sampled."
+        ),
+    )
+    # used in place of the text fields above if logs are normalized - see
+    # DatabaseSink, and visitors.dimensions
+    http_user_agent_ref = dimension_field(UserAgent)
+    http_referer_ref = dimension_field(Referer)
+    query_string_ref = dimension_field(QueryString)
+    remote_addr_ref = dimension_field(RemoteAddr)
 
     objects = VisitorLogManager()
+
+    class Meta:
+        indexes = [
+            # per-visitor timeline
+            models.Index(
+                fields=["visitor", "timestamp"], name="visitors_log_visitor_ts_idx"
+            ),
+            # date ranges (admin, retention)
+            BlockRangeIndex(fields=["timestamp"], name="visitors_log_timestamp_idx"),
+            models.Index(fields=["status_code"], name="visitors_log_status_code_idx"),
+        ]
+
+    def get_value(self, name: str) -> str:
+        """Return a text field value - from its dimension, if interned."""
+        ref = self.DIMENSIONS[name]
+        if not getattr(self, name) and getattr(self, f"{ref}_id"):
+            return getattr(self, ref).value
+        return getattr(self, name)
+
+
+class VisitorLogRollupManager(models.Manager):
+    # rows per upsert - 7 parameters each, well under the bind parameter
+    # limits of SQLite (999 before 3.32) and PostgreSQL (65535)
+    upsert_batch_size = 500
+
+    def _upsert_sql(self, rows: int) -> str:
+        """Return INSERT ... ON CONFLICT that adds to existing rollups."""
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        columns = ", ".join(qn(c) for c in self.model.UPSERT_COLUMNS)
+        values = ", ".join(
+            ["(%s)" % ", ".join(["%s"] * len(self.model.UPSERT_COLUMNS))] * rows
+        )
+        unique = ", ".join(qn(c) for c in self.model.UNIQUE_COLUMNS)
+        least, greatest = (
+            ("LEAST", "GREATEST")
+            if connection.vendor == "postgresql"
+            else ("MIN", "MAX")
+        )
+        # only quoted identifiers and placeholders are interpolated, the values
+        # themselves are passed as parameters
+        return (
+            f"INSERT INTO {table} ({columns}) VALUES {values} "  # noqa: S608
+            f"ON CONFLICT ({unique}) DO UPDATE SET "
+            f"hits = {table}.hits + excluded.hits, "
+            f"first_seen_at = {least}({table}.first_seen_at, excluded.first_seen_at), "
+            f"last_seen_at = {greatest}({table}.last_seen_at, excluded.last_seen_at)"
+        )
+
+    def _upsert(self, rollups: List[VisitorLogRollup]) -> None:
+        connection = connections[self.db]
+        fields = [self.model._meta.get_field(c) for c in self.model.UPSERT_COLUMNS]
+        batch_size = min(
+            self.upsert_batch_size, connection.ops.bulk_batch_size(fields, rollups)
+        )
+        with connection.cursor() as cursor:
+            for start in range(0, len(rollups), batch_size):
+                end = start + batch_size
+                batch = rollups[start:end]
+                params = [
+                    f.get_db_prep_save(getattr(rollup, f.attname), connection)
+                    for rollup in batch
+                    for f in fields
+                ]
+                cursor.execute(self._upsert_sql(len(batch)), params)
+
+    def _update_or_create(self, rollup: VisitorLogRollup) -> None:
+        key = {c: getattr(rollup, c) for c in self.model.UNIQUE_COLUMNS}
+        update = dict(
+            hits=F("hits") + rollup.hits,
+            first_seen_at=Least("first_seen_at", Value(rollup.first_seen_at)),
+            last_seen_at=Greatest("last_seen_at", Value(rollup.last_seen_at)),
+        )
+        if self.filter(**key).update(**update):
+            return
+        try:
+            with transaction.atomic(using=self.db):
+                rollup.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            # created by another process since the update
+            self.filter(**key).update(**update)
+
+    def record(self, logs: Iterable[VisitorLog], interval: int) -> None:
+        """
+        Add the logs to their rollups, creating them as required.
+
+        Logs are first combined in memory, so each rollup is written once. On
+        PostgreSQL and SQLite the rollups are upserted in batches of
+        `upsert_batch_size` (INSERT ... ON CONFLICT), elsewhere each one is
+        updated (with F() expressions) or created.
+
+        """
+        rollups: Dict[tuple, VisitorLogRollup] = {}
+        for log in logs:
+            bucket = VisitorLogRollup.get_bucket(log.timestamp, interval)
+            key = (log.visitor_id, log.request_uri, log.status_code, bucket)
+            if rollup := rollups.get(key):
+                rollup.add(log)
+            else:
+                rollups[key] = VisitorLogRollup.from_log(log, bucket)
+        # consistent ordering avoids deadlocks between concurrent writers
+        ordered = [rollups[key] for key in sorted(rollups)]
+        if not ordered:
+            return
+        connection = connections[self.db]
+        if connection.vendor in ("postgresql", "sqlite") and getattr(
+            connection.features, "supports_update_conflicts_with_target", False
+        ):
+            self._upsert(ordered)
+            return
+        for rollup in ordered:
+            self._update_or_create(rollup)
+
+
+class VisitorLogRollup(models.Model):
+    """Visits counted per visitor, URI, response status and time bucket."""
+
+    UNIQUE_COLUMNS = ("visitor_id", "request_uri", "status_code", "bucket")
+    UPSERT_COLUMNS = UNIQUE_COLUMNS + ("hits", "first_seen_at", "last_seen_at")
+
+    visitor = models.ForeignKey(
+        Visitor, related_name="visit_rollups", on_delete=CASCADE
+    )
+    request_uri = models.URLField()
+    status_code = models.PositiveIntegerField("HTTP Response", default=0)
+    bucket = models.DateTimeField(help_text=_lazy("Start of the time bucket."))
+    hits = models.PositiveIntegerField(
+        default=0,
+        help_text=_lazy("Number of visits (the sum of the log sample weights)."),
+    )
+    first_seen_at = models.DateTimeField()
+    last_seen_at = models.DateTimeField()
+
+    objects = VisitorLogRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["visitor", "request_uri", "status_code", "bucket"],
+                name="visitors_visitorlogrollup_uniq",
+            )
+        ]
+
+    @staticmethod
+    def get_bucket(timestamp: datetime.datetime, interval: int) -> datetime.datetime:
+        """Return the start of the `interval` second bucket containing timestamp."""
+        epoch = int(timestamp.timestamp())
+        return datetime.datetime.fromtimestamp(
+            epoch - epoch % interval, tz=datetime.timezone.utc
+        )
+
+    @classmethod
+    def from_log(cls, log: VisitorLog, bucket: datetime.datetime) -> VisitorLogRollup:
+        return cls(
+            visitor_id=log.visitor_id,
+            request_uri=log.request_uri,
+            status_code=log.status_code,
+            bucket=bucket,
+            hits=log.sample_weight,
+            first_seen_at=log.timestamp,
+            last_seen_at=log.timestamp,
+        )
+
+    def add(self, log: VisitorLog) -> None:
+        self.hits += log.sample_weight
+        self.first_seen_at = min(self.first_seen_at, log.timestamp)
+        self.last_seen_at = max(self.last_seen_at, log.timestamp)
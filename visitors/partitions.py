@@ -0,0 +1,236 @@
+"""
+Range partitioning of the VisitorLog table by timestamp (PostgreSQL only).
+
+The table is converted to a partitioned table once (see `setup_sql`) - the
+existing table becomes the first partition, holding everything before the
+current interval, and a default partition catches any rows outside the
+partitions created ahead of time. From then on partitions are created ahead
+of time, and dropped once they are older than the retention period, using the
+`visitor_log_partitions` management command - which should be run regularly
+(e.g. daily).
+
+Dropping a partition is a metadata operation, unlike deleting the rows, but
+it drops the whole interval - the first (legacy) partition is dropped only
+once everything in it has expired.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import re
+from typing import List, Optional, Tuple
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+from .models import Visitor, VisitorLog
+
+INTERVALS = ("month", "week")
+
+# upper bound of a partition, from pg_get_expr(relpartbound)
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+Range = Tuple[datetime.datetime, datetime.datetime]
+
+
+def interval_start(timestamp: datetime.datetime, interval: str) -> datetime.datetime:
+    """Return the start (midnight UTC) of the interval containing timestamp."""
+    date = timestamp.astimezone(datetime.timezone.utc).date()
+    if interval == "month":
+        date = date.replace(day=1)
+    else:
+        date -= datetime.timedelta(days=date.weekday())
+    return datetime.datetime.combine(date, datetime.time(), datetime.timezone.utc)
+
+
+def next_start(start: datetime.datetime, interval: str) -> datetime.datetime:
+    """Return the start of the interval following the one starting at start."""
+    if interval == "week":
+        return start + datetime.timedelta(weeks=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def get_ranges(start: datetime.datetime, count: int, interval: str) -> List[Range]:
+    """Return `count` consecutive (start, end) ranges from start."""
+    ranges = []
+    for _ in range(count):
+        end = next_start(start, interval)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def parse_bound(value: str) -> datetime.datetime:
+    """Parse a timestamptz partition bound - e.g. '2021-02-01 00:00:00+00'."""
+    if re.search(r"[+-]\d\d$", value):
+        value += ":00"
+    return datetime.datetime.fromisoformat(value)
+
+
+class LogPartitions:
+    """Generate (and introspect) the SQL used to manage VisitorLog partitions."""
+
+    def __init__(self, connection: BaseDatabaseWrapper, interval: str) -> None:
+        self.connection = connection
+        self.interval = interval
+        self.table = VisitorLog._meta.db_table
+
+    def qn(self, name: str) -> str:
+        return self.connection.ops.quote_name(name)
+
+    def partition_name(self, start: datetime.datetime) -> str:
+        return f"{self.table}_p{start:%Y%m%d}"
+
+    @property
+    def legacy_table(self) -> str:
+        return f"{self.table}_legacy"
+
+    @property
+    def default_table(self) -> str:
+        return f"{self.table}_default"
+
+    def is_partitioned(self) -> bool:
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_partitioned_table p "
+                "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+                [self.table],
+            )
+            return cursor.fetchone() is not None
+
+    def get_partitions(self) -> List[Tuple[str, Optional[datetime.datetime]]]:
+        """Return (name, upper bound) of each partition - None if unbounded."""
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [self.table],
+            )
+            rows = cursor.fetchall()
+        partitions = []
+        for name, bound in rows:
+            match = UPPER_BOUND.search(bound)
+            partitions.append((name, parse_bound(match.group(1)) if match else None))
+        return partitions
+
+    @property
+    def legacy_check(self) -> str:
+        return f"{self.table}_legacy_timestamp_check"
+
+    @property
+    def legacy_key(self) -> str:
+        return f"{self.table}_legacy_id_timestamp_key"
+
+    def setup_end(self, now: datetime.datetime) -> datetime.datetime:
+        """Return the upper bound of the legacy partition."""
+        return next_start(interval_start(now, self.interval), self.interval)
+
+    def prepare_sql(self, now: datetime.datetime) -> List[str]:
+        """
+        Return SQL to prepare the table for `setup_sql`, run outside a transaction.
+
+        ATTACH PARTITION scans the table to check the partition bound, and
+        builds any parent indexes the table lacks, all under an exclusive lock.
+        Instead the bound is added as a CHECK constraint, validated without
+        blocking writes, and the (id, timestamp) unique index for the primary
+        key is built concurrently - so that the attach is catalog-only.
+
+        """
+        table = self.qn(self.table)
+        check, key = self.qn(self.legacy_check), self.qn(self.legacy_key)
+        end = self.setup_end(now)
+        return [
+            # in case an earlier attempt failed part way
+            f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}",
+            f"DROP INDEX CONCURRENTLY IF EXISTS {key}",
+            f"ALTER TABLE {table} ADD CONSTRAINT {check} "
+            f"CHECK (\"timestamp\" < '{end.isoformat()}') NOT VALID",
+            f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}",
+            f'CREATE UNIQUE INDEX CONCURRENTLY {key} ON {table} ("id", "timestamp")',
+        ]
+
+    def setup_sql(self, now: datetime.datetime) -> List[str]:
+        """
+        Return SQL to convert the table into a partitioned table.
+
+        The existing table becomes the partition for everything up to the end
+        of the current interval (as it will already hold some of it). Every
+        statement only changes the catalog, given `prepare_sql` has been run,
+        so they can be run in a single transaction without holding locks for
+        long.
+
+        """
+        table, legacy = self.qn(self.table), self.qn(self.legacy_table)
+        end = self.setup_end(now)
+        return [
+            f"ALTER TABLE {table} RENAME TO {legacy}",
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS "
+            "INCLUDING IDENTITY INCLUDING CONSTRAINTS) "
+            'PARTITION BY RANGE ("timestamp")',
+            # copied from the legacy table, but only applies to that
+            f"ALTER TABLE {table} DROP CONSTRAINT {self.qn(self.legacy_check)}",
+            # the partition key must be part of the primary key - attached to
+            # the legacy unique constraint, which must be a constraint to match
+            f'ALTER TABLE {table} ADD PRIMARY KEY ("id", "timestamp")',
+            f"ALTER TABLE {legacy} ADD CONSTRAINT {self.qn(self.legacy_key)} "
+            f"UNIQUE USING INDEX {self.qn(self.legacy_key)}",
+            f'ALTER TABLE {table} ADD FOREIGN KEY ("visitor_id") '
+            f'REFERENCES {self.qn(Visitor._meta.db_table)} ("id") '
+            "DEFERRABLE INITIALLY DEFERRED",
+            # the VisitorLog.Meta indexes - unnamed, as the legacy partition
+            # keeps the names (and its indexes are attached to these).
+            f'CREATE INDEX ON {table} ("visitor_id", "timestamp")',
+            f'CREATE INDEX ON {table} USING brin ("timestamp")',
+            f'CREATE INDEX ON {table} ("status_code")',
+            # carry on the id sequence - the new table has either a new identity
+            # sequence (Django 4.1+), or shares the legacy serial sequence, which
+            # must not be dropped along with the legacy partition. Only quoted
+            # identifiers are interpolated.
+            "DO $$ DECLARE "  # noqa: S608
+            f"seq text := pg_get_serial_sequence('{table}', 'id'); "
+            "BEGIN IF seq IS NULL THEN EXECUTE format("
+            f"'ALTER SEQUENCE %s OWNED BY {table}.\"id\"', "
+            f"pg_get_serial_sequence('{legacy}', 'id')); "
+            f'ELSE PERFORM setval(seq, (SELECT COALESCE(MAX("id"), 0) + 1 '
+            f"FROM {legacy}), false); END IF; END $$",
+            f'ALTER TABLE {legacy} ALTER COLUMN "id" DROP IDENTITY IF EXISTS',
+            f'ALTER TABLE {legacy} ALTER COLUMN "id" DROP DEFAULT',
+            # no scan - the validated CHECK constraint implies the bound
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{end.isoformat()}')",
+            f"ALTER TABLE {legacy} DROP CONSTRAINT {self.qn(self.legacy_check)}",
+            f"CREATE TABLE {self.qn(self.default_table)} PARTITION OF {table} DEFAULT",
+        ]
+
+    def create_sql(
+        self,
+        now: datetime.datetime,
+        ahead: int,
+        after: Optional[datetime.datetime] = None,
+    ) -> List[str]:
+        """
+        Return SQL to create the current and next `ahead` partitions.
+
+        Partitions starting before `after` (the end of the latest existing
+        partition) are skipped, as they would overlap.
+
+        """
+        start = interval_start(now, self.interval)
+        return [
+            f"CREATE TABLE IF NOT EXISTS {self.qn(self.partition_name(start))} "
+            f"PARTITION OF {self.qn(self.table)} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            for start, end in get_ranges(start, ahead + 1, self.interval)
+            if after is None or start >= after
+        ]
+
+    def drop_sql(self, cutoff: datetime.datetime) -> List[str]:
+        """Return SQL to drop the partitions that end on or before cutoff."""
+        return [
+            f"DROP TABLE {self.qn(name)}"
+            for name, upper in sorted(self.get_partitions())
+            if upper is not None and upper <= cutoff
+        ]
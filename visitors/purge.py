@@ -0,0 +1,202 @@
+"""
+Chunked deletion of old VisitorLog records and Visitor passes.
+
+Deleting with the ORM loads every row into the deletion collector (to send
+signals and cascade), and a single large DELETE holds locks for as long as it
+takes. Instead rows are deleted in primary key ranges of `chunk_size`, each
+with a raw DELETE in its own transaction. Each function yields the progress
+after every chunk, so that the caller can report (or sleep between chunks),
+and can resume from the last id reported.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+from typing import Any, Iterator, List, NamedTuple, Optional, Sequence, Type
+
+from django.db import connections, models, router, transaction
+from django.db.models import Max, Min, Q, QuerySet
+from django.utils.timezone import now as tz_now
+
+from . import cache, revocation
+from .models import DeletedVisitor, Visitor, VisitorLog, VisitorLogRollup
+
+
+class Progress(NamedTuple):
+    """Rows deleted from a chunk - `next_id` is where to resume from."""
+
+    deleted: int
+    next_id: int
+    max_id: int
+
+
+def expired_logs(cutoff: datetime.datetime) -> QuerySet:
+    return VisitorLog.objects.filter(timestamp__lt=cutoff)
+
+
+def expired_visitors(cutoff: datetime.datetime) -> QuerySet:
+    """Return passes that expired, or were deactivated, before cutoff."""
+    return Visitor.objects.filter(
+        Q(expires_at__lt=cutoff) | Q(is_active=False, last_updated_at__lt=cutoff)
+    )
+
+
+def _id_range(queryset: QuerySet, start_id: Optional[int]) -> Optional[range]:
+    ids = queryset.aggregate(min_id=Min("id"), max_id=Max("id"))
+    if ids["max_id"] is None:
+        return None
+    return range(max(ids["min_id"], start_id or 0), ids["max_id"] + 1)
+
+
+def _log_range_sql(connection: Any) -> str:
+    """Return a DELETE of the logs in an id range [lower, upper) before cutoff."""
+    qn = connection.ops.quote_name
+    timestamp = VisitorLog._meta.get_field("timestamp")
+    # only quoted identifiers are interpolated
+    return (
+        f"DELETE FROM {qn(VisitorLog._meta.db_table)} "  # noqa: S608
+        f"WHERE {qn('id')} >= %s AND {qn('id')} < %s "
+        f"AND {qn(timestamp.column)} < %s"
+    )
+
+
+def _cutoff_value(cutoff: datetime.datetime, connection: Any) -> Any:
+    timestamp = VisitorLog._meta.get_field("timestamp")
+    return timestamp.get_db_prep_value(cutoff, connection)
+
+
+def purge_logs(
+    cutoff: datetime.datetime, chunk_size: int, start_id: Optional[int] = None
+) -> Iterator[Progress]:
+    """Delete VisitorLog records older than cutoff."""
+    if not (ids := _id_range(expired_logs(cutoff), start_id)):
+        return
+    using = router.db_for_write(VisitorLog)
+    connection = connections[using]
+    sql = _log_range_sql(connection)
+    cutoff_value = _cutoff_value(cutoff, connection)
+    for lower in range(ids.start, ids.stop, chunk_size):
+        upper = min(lower + chunk_size, ids.stop)
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(sql, [lower, upper, cutoff_value])
+            deleted = cursor.rowcount
+        yield Progress(deleted, upper, ids.stop - 1)
+
+
+def purge_exported(
+    cutoff: datetime.datetime, id_ranges: Sequence[Sequence[int]]
+) -> Iterator[Progress]:
+    """
+    Delete exported VisitorLog records older than cutoff, by id range.
+
+    `id_ranges` are the (first id, last id, rows) of each batch exported (see
+    `archive.export`). A range now holding more rows than were exported - ie.
+    logs committed since, with an old timestamp - is left as it is, so that
+    only exported logs are deleted.
+
+    """
+    if not id_ranges:
+        return
+    using = router.db_for_write(VisitorLog)
+    connection = connections[using]
+    sql = _log_range_sql(connection)
+    cutoff_value = _cutoff_value(cutoff, connection)
+    max_id = max(last for _, last, _ in id_ranges)
+    for first, last, rows in id_ranges:
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(sql, [first, last + 1, cutoff_value])
+            deleted = cursor.rowcount
+            if deleted > rows:
+                transaction.set_rollback(True, using=using)
+                deleted = 0
+        yield Progress(deleted, last + 1, max_id)
+
+
+def _delete_ids(using: str, table: str, column: str, ids: List[int]) -> int:
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        # only quoted identifiers and placeholders are interpolated
+        cursor.execute(
+            f"DELETE FROM {qn(table)} "  # noqa: S608
+            f"WHERE {qn(column)} IN ({placeholders})",
+            ids,
+        )
+        return cursor.rowcount
+
+
+def _purge_related(
+    using: str, model: Type[models.Model], pks: List[int], chunk_size: int
+) -> None:
+    """Delete the rows of model for the passes, in id ranges of chunk_size rows."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(pks))
+    # only quoted identifiers and placeholders are interpolated
+    sql = (
+        f"DELETE FROM {qn(model._meta.db_table)} "  # noqa: S608
+        f"WHERE {qn('id')} >= %s AND {qn('id')} <= %s "
+        f"AND {qn('visitor_id')} IN ({placeholders})"
+    )
+    queryset = model.objects.using(using).filter(visitor_id__in=pks).order_by("id")
+    lower = 0
+    while ids := list(
+        queryset.filter(id__gte=lower).values_list("id", flat=True)[:chunk_size]
+    ):
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(sql, [ids[0], ids[-1], *pks])
+        lower = ids[-1] + 1
+
+
+def purge_visitors(
+    cutoff: datetime.datetime, chunk_size: int, start_id: Optional[int] = None
+) -> Iterator[Progress]:
+    """
+    Delete passes that expired, or were deactivated, before cutoff.
+
+    Their logs (and rollups) are deleted first, in id ranges of chunk_size
+    rows, then the passes (along with anything logged since). Deleting a pass
+    does not send post_delete, so the pass cache and revocation list are
+    updated here - inactive passes that have not yet expired must stay
+    revoked, so they are replaced by DeletedVisitor tombstones (and expired
+    tombstones removed).
+
+    """
+    queryset = expired_visitors(cutoff)
+    if not (ids := _id_range(queryset, start_id)):
+        return
+    using = router.db_for_write(Visitor)
+    revoked = False
+    for lower in range(ids.start, ids.stop, chunk_size):
+        upper = min(lower + chunk_size, ids.stop)
+        passes = list(
+            queryset.filter(id__gte=lower, id__lt=upper).values_list(
+                "id", "uuid", "expires_at"
+            )
+        )
+        deleted = 0
+        if passes:
+            pks = [pk for pk, _, _ in passes]
+            now = tz_now()
+            tombstones = [
+                DeletedVisitor(uuid=u, expires_at=e)
+                for _, u, e in passes
+                if not e or e > now
+            ]
+            for model in (VisitorLog, VisitorLogRollup):
+                _purge_related(using, model, pks, chunk_size)
+            with transaction.atomic(using=using):
+                for model in (VisitorLog, VisitorLogRollup):
+                    _delete_ids(using, model._meta.db_table, "visitor_id", pks)
+                DeletedVisitor.objects.using(using).bulk_create(
+                    tombstones, ignore_conflicts=True
+                )
+                deleted = _delete_ids(using, Visitor._meta.db_table, "id", pks)
+            cache.delete([u for _, u, _ in passes])
+            revoked = revoked or bool(tombstones)
+        yield Progress(deleted, upper, ids.stop - 1)
+    DeletedVisitor.objects.using(using).filter(expires_at__lt=tz_now()).delete()
+    if revoked:
+        revocation.publish()
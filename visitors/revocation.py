@@ -0,0 +1,261 @@
+"""
+Revocation of signed visitor tokens.
+
+Signed tokens (see visitors.tokens) carry everything required to validate a
+pass apart from whether it is still active - passes can be deactivated (or
+deleted) before they expire.
+
+The uuids of revoked (inactive or deleted, but unexpired) passes are published
+to the pass cache as a Bloom filter, and each process keeps a copy which it
+refreshes every VISITOR_REVOCATION_REFRESH seconds. Checking a token is then a
+handful of in-memory bit tests - only a uuid that is (probably) in the filter
+is confirmed against the pass store, bypassing the local cache. The filter is
+republished whenever a pass is deactivated or deleted, so a revocation takes at
+most VISITOR_REVOCATION_REFRESH seconds to reach every process.
+
+The filter is always built from the database - deleted passes leave a
+DeletedVisitor tombstone until they expire - so if the published filter is
+lost (evicted, or the cache flushed) it is simply rebuilt. Each filter
+records when it was built, and is not published over a newer one - so
+concurrent publishers can't leave an older snapshot in the cache.
+
+If the pass cache is disabled there is nowhere to publish the filter, and
+every check goes to the pass store (i.e. the database).
+
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import math
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterator, Optional
+
+from asgiref.sync import sync_to_async
+from django.core.cache import BaseCache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now as tz_now
+
+from . import cache
+from .compat import acall
+from .models import DeletedVisitor, Visitor
+from .settings import VISITOR_REVOCATION_ERROR_RATE, VISITOR_REVOCATION_REFRESH
+
+FILTER_KEY = "visitors:revoked:filter"
+
+# The published filter is rebuilt from scratch at least this often (seconds),
+# which drops passes that have since expired.
+FILTER_TIMEOUT = 3600
+
+# Smallest filter built, so that a handful of revocations do not each
+# require the filter to be resized.
+MIN_CAPACITY = 1000
+
+
+def _as_bytes(visitor_uuid: Any) -> bytes:
+    return uuid.UUID(str(visitor_uuid)).bytes
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter of uuids, using double hashing."""
+
+    def __init__(self, size: int, hashes: int, bits: Optional[bytes] = None) -> None:
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits or (size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float) -> BloomFilter:
+        """Return a filter sized to hold `capacity` items at `error_rate`."""
+        capacity = max(capacity, MIN_CAPACITY)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, visitor_uuid: Any) -> Iterator[int]:
+        digest = hashlib.blake2b(_as_bytes(visitor_uuid), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, visitor_uuid: Any) -> None:
+        for pos in self._positions(visitor_uuid):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, visitor_uuid: Any) -> bool:
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(visitor_uuid)
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "hashes": self.hashes,
+            "bits": base64.b64encode(bytes(self.bits)).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> BloomFilter:
+        return cls(data["size"], data["hashes"], base64.b64decode(data["bits"]))
+
+
+class RevocationList:
+    """This process's copy of the published revocation filter."""
+
+    def __init__(self, refresh: int) -> None:
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self.filter: Optional[BloomFilter] = None
+        self.expires = 0.0
+
+    @property
+    def is_stale(self) -> bool:
+        return self.expires <= time.monotonic()
+
+    def update(self, bloom: Optional[BloomFilter]) -> None:
+        with self._lock:
+            self.filter = bloom
+            self.expires = time.monotonic() + self.refresh
+
+    def clear(self) -> None:
+        with self._lock:
+            self.filter = None
+            self.expires = 0.0
+
+    def __contains__(self, visitor_uuid: Any) -> bool:
+        # no filter means nothing published (yet), so assume the worst
+        bloom = self.filter
+        return bloom is None or visitor_uuid in bloom
+
+
+revoked = RevocationList(VISITOR_REVOCATION_REFRESH)
+
+
+def get_revoked_uuids() -> Iterator[uuid.UUID]:
+    """Return uuids of passes that are inactive but not yet expired."""
+    return (
+        Visitor.objects.filter(is_active=False)
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=tz_now()))
+        .values_list("uuid", flat=True)
+        .iterator()
+    )
+
+
+def get_deleted_uuids() -> Iterator[uuid.UUID]:
+    """Return uuids of passes that were deleted before they expired."""
+    return (
+        DeletedVisitor.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=tz_now())
+        )
+        .values_list("uuid", flat=True)
+        .iterator()
+    )
+
+
+def publish() -> Optional[BloomFilter]:
+    """
+    Rebuild the revocation filter and publish it to the pass cache.
+
+    The filter is built from the database - inactive passes, and tombstones
+    (DeletedVisitor) of passes deleted before they expired - so it can
+    always be rebuilt if the published copy is lost. A filter built since
+    (by another process) is left in place. Returns the published filter, or
+    None if the pass cache is disabled.
+
+    """
+    if (shared := cache.get_cache()) is None:
+        return None
+    # taken before reading the database - a filter built later includes
+    # every revocation committed before this one was read
+    built_at = time.time()
+    uuids = list(get_revoked_uuids()) + list(get_deleted_uuids())
+    bloom = BloomFilter.for_capacity(len(uuids) * 2, VISITOR_REVOCATION_ERROR_RATE)
+    for visitor_uuid in uuids:
+        bloom.add(visitor_uuid)
+    # concurrent publishers must not replace a newer filter with this one
+    if (current := shared.get(FILTER_KEY)) and current.get("built_at", 0) > built_at:
+        bloom = BloomFilter.from_dict(current)
+    else:
+        data = dict(bloom.to_dict(), built_at=built_at)
+        shared.set(FILTER_KEY, data, timeout=FILTER_TIMEOUT)
+    revoked.update(bloom)
+    return bloom
+
+
+def publish_on_commit(using: Optional[str] = None) -> None:
+    """
+    Publish the filter once the current transaction is committed.
+
+    Each publish rebuilds the whole filter, so it is registered at most once
+    per transaction, however many passes the transaction revokes.
+
+    """
+    connection = transaction.get_connection(using)
+    # NB entries are (savepoint ids, func[, robust]), and are discarded on
+    # rollback, so a rolled back publish is registered again
+    if any(entry[1] is publish for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(publish, using=using)
+
+
+def refresh(shared: BaseCache) -> None:
+    """Fetch the published filter - rebuilding it if there is none."""
+    if data := shared.get(FILTER_KEY):
+        revoked.update(BloomFilter.from_dict(data))
+    else:
+        publish()
+
+
+async def arefresh(shared: BaseCache) -> None:
+    """Async version of refresh."""
+    if data := await acall(shared, "get", FILTER_KEY):
+        revoked.update(BloomFilter.from_dict(data))
+    else:
+        await sync_to_async(publish)()
+
+
+def _confirm(visitor_uuid: Any) -> bool:
+    """Return True if the pass store confirms that the pass is revoked."""
+    # the local cache may be up to VISITOR_LOCAL_CACHE_TTL out of date
+    cache.local.delete([cache.cache_key(visitor_uuid)])
+    try:
+        return not Visitor.objects.get_by_uuid(visitor_uuid).is_active
+    except Visitor.DoesNotExist:
+        return True
+
+
+async def _aconfirm(visitor_uuid: Any) -> bool:
+    """Async version of _confirm."""
+    cache.local.delete([cache.cache_key(visitor_uuid)])
+    try:
+        return not (await Visitor.objects.aget_by_uuid(visitor_uuid)).is_active
+    except Visitor.DoesNotExist:
+        return True
+
+
+def is_revoked(visitor_uuid: Any) -> bool:
+    """Return True if the pass has been deactivated or deleted."""
+    if (shared := cache.get_cache()) is None:
+        return _confirm(visitor_uuid)
+    if revoked.is_stale:
+        refresh(shared)
+    if visitor_uuid not in revoked:
+        return False
+    return _confirm(visitor_uuid)
+
+
+async def ais_revoked(visitor_uuid: Any) -> bool:
+    """Async version of is_revoked."""
+    if (shared := cache.get_cache()) is None:
+        return await _aconfirm(visitor_uuid)
+    if revoked.is_stale:
+        await arefresh(shared)
+    if visitor_uuid not in revoked:
+        return False
+    return await _aconfirm(visitor_uuid)
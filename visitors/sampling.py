@@ -0,0 +1,154 @@
+"""
+Sampling and rate-limiting of visitor logs.
+
+Policies are configured per scope (the Visitor.scope) using the
+VISITOR_LOG_SAMPLING setting - a dict of scope to policy options (see
+SamplingPolicy), with "*" matching any scope without its own policy:
+
+    VISITOR_LOG_SAMPLING = {
+        # log 1 in 10 visits, and at most one per visitor per URI per minute
+        "downloads": {"rate": 10, "limit": 1, "period": 60},
+    }
+
+Each log records its sample weight - the number of visits it stands for - so
+that totals can be estimated as the sum of the weights. Visits dropped by the
+rate limit are added to the weight of the first log in the following period,
+so totals are only short by visits in a visitor's last (rate-limited) period.
+
+Rate limits are counted in the pass cache (VISITOR_CACHE_ALIAS), or the
+default cache if that is not set.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import random
+import time
+from typing import Dict, Optional, Tuple
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, BaseCache, caches
+from django.http import HttpRequest
+
+from .compat import acall
+from .models import Visitor
+from .settings import VISITOR_CACHE_ALIAS, VISITOR_LOG_SAMPLING
+
+KEY_PREFIX = "visitors:log:"
+
+# policy used for any scope without its own
+ANY_SCOPE = "*"
+
+
+class SamplingPolicy:
+    """
+    How visits for a scope are logged.
+
+    rate: log 1 in `rate` visits (chosen at random).
+    limit: log at most `limit` visits per visitor per URI per `period`
+        seconds - 0 for no limit.
+
+    """
+
+    def __init__(self, rate: int = 1, limit: int = 0, period: int = 60) -> None:
+        self.rate = rate
+        self.limit = limit
+        self.period = period
+
+    def __repr__(self) -> str:
+        return (
+            f"<SamplingPolicy rate={self.rate} "
+            f"limit={self.limit} period={self.period}>"
+        )
+
+    def sample(self) -> bool:
+        """Return True if this visit is one of the 1 in `rate` logged."""
+        return self.rate <= 1 or random.randrange(self.rate) == 0
+
+    def keys(self, visitor: Visitor, path: str) -> Tuple[str, str]:
+        """Return the counter keys for the current and previous periods."""
+        digest = hashlib.blake2b(path.encode(), digest_size=16).hexdigest()
+        period = int(time.time() // self.period)
+        prefix = f"{KEY_PREFIX}{visitor.uuid}:{digest}"
+        return f"{prefix}:{period}", f"{prefix}:{period - 1}"
+
+
+policies: Dict[str, SamplingPolicy] = {
+    scope: SamplingPolicy(**options) for scope, options in VISITOR_LOG_SAMPLING.items()
+}
+
+
+def get_cache() -> BaseCache:
+    return caches[VISITOR_CACHE_ALIAS or DEFAULT_CACHE_ALIAS]
+
+
+def get_policy(scope: str) -> Optional[SamplingPolicy]:
+    return policies.get(scope) or policies.get(ANY_SCOPE)
+
+
+def _weight(policy: SamplingPolicy, count: int, previous: Optional[int]) -> int:
+    """Return the weight of the `count`th visit in the period."""
+    if count > policy.limit:
+        return 0
+    if count > 1:
+        return policy.rate
+    return policy.rate * (1 + max((previous or 0) - policy.limit, 0))
+
+
+def _incr(cache: BaseCache, key: str, timeout: int) -> int:
+    if cache.add(key, 1, timeout=timeout):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired between the add and the incr
+        cache.set(key, 1, timeout=timeout)
+        return 1
+
+
+async def _aincr(cache: BaseCache, key: str, timeout: int) -> int:
+    if await acall(cache, "add", key, 1, timeout=timeout):
+        return 1
+    try:
+        return await acall(cache, "incr", key)
+    except ValueError:
+        await acall(cache, "set", key, 1, timeout=timeout)
+        return 1
+
+
+def get_weight(request: HttpRequest, visitor: Visitor) -> int:
+    """
+    Return the sample weight for logging this visit - 0 if it is not logged.
+
+    With no policy for the visitor scope every visit is logged, with a
+    weight of 1.
+
+    """
+    if not (policy := get_policy(visitor.scope)):
+        return 1
+    if not policy.sample():
+        return 0
+    if not policy.limit:
+        return policy.rate
+    cache = get_cache()
+    key, previous_key = policy.keys(visitor, request.path)
+    # counters are kept for two periods, so that the next period can read
+    # how many visits were dropped.
+    count = _incr(cache, key, policy.period * 2)
+    previous = cache.get(previous_key) if count == 1 else None
+    return _weight(policy, count, previous)
+
+
+async def aget_weight(request: HttpRequest, visitor: Visitor) -> int:
+    """Async version of get_weight."""
+    if not (policy := get_policy(visitor.scope)):
+        return 1
+    if not policy.sample():
+        return 0
+    if not policy.limit:
+        return policy.rate
+    cache = get_cache()
+    key, previous_key = policy.keys(visitor, request.path)
+    count = await _aincr(cache, key, policy.period * 2)
+    previous = await acall(cache, "get", previous_key) if count == 1 else None
+    return _weight(policy, count, previous)
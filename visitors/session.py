@@ -1,20 +1,63 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional
+
+from asgiref.sync import sync_to_async
 from django.http.request import HttpRequest
 
 from visitors.settings import VISITOR_SESSION_EXPIRY, VISITOR_SESSION_KEY
 
+if TYPE_CHECKING:
+    from visitors.models import Visitor
+
 
-def stash_visitor_uuid(request: HttpRequest) -> None:
-    """Store request visitor data in session."""
-    request.session[VISITOR_SESSION_KEY] = request.visitor.session_data
+def _has_async_session(request: HttpRequest) -> bool:
+    # SessionBase async methods (and request.auser) were added in Django 5.0
+    return hasattr(request.session, "aget") and hasattr(request, "auser")
+
+
+def stash_visitor_uuid(request: HttpRequest, visitor: Optional[Visitor] = None) -> None:
+    """Store visitor (defaults to request.visitor) data in session."""
+    if visitor is None:
+        visitor = request.visitor
+    request.session[VISITOR_SESSION_KEY] = visitor.session_data
     if request.user.is_anonymous:
         request.session.set_expiry(VISITOR_SESSION_EXPIRY)
 
 
+async def astash_visitor_uuid(
+    request: HttpRequest, visitor: Optional[Visitor] = None
+) -> None:
+    """Async version of stash_visitor_uuid."""
+    if not _has_async_session(request):
+        return await sync_to_async(stash_visitor_uuid)(request, visitor)
+    if visitor is None:
+        visitor = request.visitor
+    await request.session.aset(VISITOR_SESSION_KEY, visitor.session_data)
+    user = await request.auser()
+    if user.is_anonymous:
+        await request.session.aset_expiry(VISITOR_SESSION_EXPIRY)
+
+
 def get_visitor_uuid(request: HttpRequest) -> str:
     """Return visitor data from session."""
     return request.session.get(VISITOR_SESSION_KEY, "")
 
 
+async def aget_visitor_uuid(request: HttpRequest) -> str:
+    """Async version of get_visitor_uuid."""
+    if not _has_async_session(request):
+        return await sync_to_async(get_visitor_uuid)(request)
+    return await request.session.aget(VISITOR_SESSION_KEY, "")
+
+
 def clear_visitor_uuid(request: HttpRequest) -> None:
     """Remove visitor data from session."""
     request.session.pop(VISITOR_SESSION_KEY, "")
+
+
+async def aclear_visitor_uuid(request: HttpRequest) -> None:
+    """Async version of clear_visitor_uuid."""
+    if not _has_async_session(request):
+        return await sync_to_async(clear_visitor_uuid)(request)
+    await request.session.apop(VISITOR_SESSION_KEY, "")
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 from django.conf import settings
 
@@ -33,3 +33,99 @@ VISITOR_SESSION_EXPIRY: Optional[int] = _setting("VISITOR_SESSION_EXPIRY", 0)
 # is stashed in the session the visitor will remain a visitor until the session
 # expires. This value is used by the VisitorRequestMiddleware.
 VISITOR_TOKEN_EXPIRY: int = _setting("VISITOR_TOKEN_EXPIRY", 300)
+
+# Alias of the Django cache (see settings.CACHES) used to store resolved visitor
+# passes, keyed by uuid. Defaults to None, which disables the cache and looks up
+# every pass in the database.
+VISITOR_CACHE_ALIAS: Optional[str] = _setting("VISITOR_CACHE_ALIAS", None)
+
+# Maximum time (in seconds) that a pass is cached for. Entries never outlive the
+# pass itself - the timeout is capped by `Visitor.expires_at`.
+VISITOR_CACHE_TIMEOUT: int = _setting("VISITOR_CACHE_TIMEOUT", 300)
+
+# Time (in seconds) for which unknown uuids are cached, so that requests with
+# bogus tokens do not all hit the database.
+VISITOR_CACHE_NEGATIVE_TIMEOUT: int = _setting("VISITOR_CACHE_NEGATIVE_TIMEOUT", 60)
+
+# Maximum number of passes held in the per-process (in-memory) LRU cache, which
+# sits in front of the shared cache and database. Defaults to 0 (disabled).
+VISITOR_LOCAL_CACHE_SIZE: int = _setting("VISITOR_LOCAL_CACHE_SIZE", 0)
+
+# Maximum time (in seconds) a pass is held in the per-process cache. Changes made
+# in other processes (e.g. deactivating a pass) can take this long to be seen.
+VISITOR_LOCAL_CACHE_TTL: int = _setting("VISITOR_LOCAL_CACHE_TTL", 5)
+
+# If True, `Visitor.tokenise` will (by default) add a signed token to the URL
+# rather than the bare uuid. Signed tokens carry the pass uuid, scope and expiry,
+# and can be validated without looking up the pass - only revocation is checked.
+VISITOR_SIGNED_TOKENS: bool = _setting("VISITOR_SIGNED_TOKENS", False)
+
+# Maximum time (in seconds) between each process fetching the published list of
+# revoked passes - i.e. how long it can take for deactivating a pass to stop its
+# signed tokens from being accepted. Requires VISITOR_CACHE_ALIAS - without it
+# every signed token is checked against the database.
+VISITOR_REVOCATION_REFRESH: int = _setting("VISITOR_REVOCATION_REFRESH", 10)
+
+# False positive rate of the (Bloom) filter of revoked passes. A false positive
+# costs a pass lookup, not a rejected visitor.
+VISITOR_REVOCATION_ERROR_RATE: float = _setting("VISITOR_REVOCATION_ERROR_RATE", 0.01)
+
+# How VisitorLog records are written - "direct" (an INSERT per visit, inside the
+# request), "buffered" (queued in memory and written in batches), "background"
+# (queued, and written in batches by a background thread), or the dotted path
+# to a visitors.writers.LogWriter subclass.
+VISITOR_LOG_WRITER: str = _setting("VISITOR_LOG_WRITER", "direct")
+
+# Maximum number of logs queued by the buffered writer before they are written,
+# and the number written at a time by the background writer.
+VISITOR_LOG_BATCH_SIZE: int = _setting("VISITOR_LOG_BATCH_SIZE", 100)
+
+# Maximum time (in seconds) a log is queued by the buffered writer - checked as
+# each request finishes, so an idle process holds logs until its next request.
+VISITOR_LOG_FLUSH_INTERVAL: int = _setting("VISITOR_LOG_FLUSH_INTERVAL", 5)
+
+# Maximum number of logs held in the background writer queue.
+VISITOR_LOG_QUEUE_SIZE: int = _setting("VISITOR_LOG_QUEUE_SIZE", 10000)
+
+# What the background writer does when its queue is full - one of "block",
+# "drop_newest", "drop_oldest" or "sample" (see visitors.writers).
+VISITOR_LOG_OVERFLOW: str = _setting("VISITOR_LOG_OVERFLOW", "drop_newest")
+
+# With the "sample" overflow policy, 1 in this many logs is kept once the
+# background writer queue is half full.
+VISITOR_LOG_OVERFLOW_SAMPLE_RATE: int = _setting("VISITOR_LOG_OVERFLOW_SAMPLE_RATE", 10)
+
+# Sampling and rate-limiting of visitor logs, per scope - a dict of scope ("*"
+# for any other scope) to options: "rate" (log 1 in N visits), "limit" (log at
+# most N visits per visitor per URI per period) and "period" (seconds). See
+# visitors.sampling. Defaults to {} - every visit is logged.
+VISITOR_LOG_SAMPLING: Dict[str, Dict[str, Any]] = _setting("VISITOR_LOG_SAMPLING", {})
+
+# Where visitor logs are written - a list of sinks, each a dict with a "class"
+# ("database", "jsonl", "logging", or the dotted path to a LogSink subclass), an
+# optional list of "scopes", and sink-specific options. See visitors.sinks.
+VISITOR_LOG_SINKS: List[Dict[str, Any]] = _setting(
+    "VISITOR_LOG_SINKS", [{"class": "database"}]
+)
+
+# If True, visits are logged once the response has been sent (when the server
+# closes the response), rather than before it is returned. Otherwise, if
+# ATOMIC_REQUESTS is on, visits are logged once the request transaction commits.
+VISITOR_LOG_AFTER_RESPONSE: bool = _setting("VISITOR_LOG_AFTER_RESPONSE", False)
+
+# Interval ("month" or "week") of the VisitorLog partitions created by the
+# visitor_log_partitions management command (PostgreSQL only).
+VISITOR_LOG_PARTITION_INTERVAL: str = _setting(
+    "VISITOR_LOG_PARTITION_INTERVAL", "month"
+)
+
+# Number of future VisitorLog partitions that visitor_log_partitions creates.
+VISITOR_LOG_PARTITIONS_AHEAD: int = _setting("VISITOR_LOG_PARTITIONS_AHEAD", 2)
+
+# Number of days that VisitorLog records are kept for - defaults to None (kept
+# indefinitely).
+VISITOR_LOG_RETENTION_DAYS: Optional[int] = _setting("VISITOR_LOG_RETENTION_DAYS", None)
+
+# Number of days after a pass expires (or is deactivated) that it is deleted by
+# the visitor_purge management command - defaults to None (kept indefinitely).
+VISITOR_RETENTION_DAYS: Optional[int] = _setting("VISITOR_RETENTION_DAYS", None)
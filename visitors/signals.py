@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+from typing import Any, List
+
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import cache, revocation, writers
+from .models import DeletedVisitor, Visitor, passes_updated
+
+
+@receiver(post_save, sender=Visitor)
+def update_cached_pass(sender: type, instance: Visitor, **kwargs: Any) -> None:
+    """
+    Write saved passes through to the pass cache once committed.
+
+    Deactivated passes are also added to the revocation list, so that their
+    signed tokens are rejected.
+
+    """
+    record = cache.to_record(instance)
+    transaction.on_commit(lambda: cache.set_record(record))
+    if not instance.is_active:
+        revocation.publish_on_commit()
+
+
+@receiver(passes_updated, sender=Visitor)
+def invalidate_cached_passes(
+    sender: type, uuids: List[Any], is_active: bool, **kwargs: Any
+) -> None:
+    """Remove bulk-updated passes from the pass cache, and republish revocations."""
+    transaction.on_commit(lambda: cache.delete(uuids))
+    revocation.publish_on_commit()
+
+
+@receiver(post_delete, sender=Visitor)
+def delete_cached_pass(sender: type, instance: Visitor, **kwargs: Any) -> None:
+    """Remove deleted passes from the pass cache, and revoke their tokens."""
+    uuids = [instance.uuid]
+    cache.delete(uuids)
+    # and again once committed, as the pass may have been read (and cached)
+    # by another request until then
+    transaction.on_commit(lambda: cache.delete(uuids))
+    if not instance.has_expired:
+        # written in the deleting transaction, so the revocation is durable
+        DeletedVisitor.objects.update_or_create(
+            uuid=instance.uuid, defaults={"expires_at": instance.expires_at}
+        )
+        revocation.publish_on_commit()
+
+
+@receiver(request_finished)
+def flush_visitor_logs(sender: type, **kwargs: Any) -> None:
+    """Write any queued visitor logs that are due."""
+    writers.flush_due()
@@ -0,0 +1,338 @@
+"""
+Sinks - where visitor logs end up.
+
+The writer (see visitors.writers) decides when logs are written, and hands
+each batch to every sink configured in VISITOR_LOG_SINKS - a list of dicts,
+each with a "class" (a key in SINKS, or the dotted path to a LogSink
+subclass) and the options for that sink:
+
+    VISITOR_LOG_SINKS = [
+        # only keep "admin" visits in the database
+        {"class": "database", "scopes": ["admin"], "normalize": True},
+        {"class": "jsonl", "path": "/var/log/visits-{pid}.jsonl"},
+    ]
+
+Every sink accepts a "scopes" option, which limits it to logs for visitors
+with those scopes.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+from . import dimensions
+from .models import Visitor, VisitorLog, VisitorLogRollup
+from .settings import VISITOR_LOG_SINKS
+
+logger = logging.getLogger(__name__)
+
+
+def to_dict(log: VisitorLog) -> Dict[str, Any]:
+    """Return the JSON-serializable representation of a log."""
+    exclude = {"id", "visitor_id", *(f"{ref}_id" for ref in log.DIMENSIONS.values())}
+    data = {
+        f.attname: getattr(log, f.attname)
+        for f in log._meta.concrete_fields
+        if f.attname not in exclude
+    }
+    data.update({name: log.get_value(name) for name in log.DIMENSIONS})
+    data.update(visitor=str(log.visitor.uuid), scope=log.visitor.scope)
+    return data
+
+
+class LogSink:
+    """Base class for sinks - subclasses implement `write_logs`."""
+
+    def __init__(self, scopes: Optional[Iterable[str]] = None) -> None:
+        self.scopes = set(scopes) if scopes else None
+
+    def write(self, logs: List[VisitorLog]) -> None:
+        """Write the logs for the scopes this sink accepts."""
+        if self.scopes is not None:
+            logs = [log for log in logs if log.visitor.scope in self.scopes]
+        if logs:
+            self.write_logs(logs)
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class DatabaseSink(LogSink):
+    """
+    Write logs to the VisitorLog table.
+
+    With `normalize`, the user agent, referer, querystring and client address
+    are stored once each in dimension tables, rather than on every log - see
+    visitors.dimensions.
+
+    Batches are written with `bulk_create`, which does not send the model
+    save signals; a single log is saved as normal.
+
+    """
+
+    def __init__(
+        self, scopes: Optional[Iterable[str]] = None, normalize: bool = False
+    ) -> None:
+        super().__init__(scopes)
+        self.normalize = normalize
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        # the logs themselves are left intact for any other sinks
+        rows = dimensions.normalize(logs) if self.normalize else logs
+        if len(rows) == 1:
+            # a single log (the "direct" writer) is saved, so that pre_save
+            # and post_save are sent, as they were before batching
+            rows[0].save()
+        else:
+            VisitorLog.objects.bulk_create(rows)
+        for log, saved in zip(logs, rows):
+            log.pk = saved.pk
+
+
+class RollupSink(LogSink):
+    """
+    Count visits in VisitorLogRollup, rather than storing each one.
+
+    Visits are counted per visitor, URI, response status and `interval`
+    second time bucket - add a "database" sink as well to keep the detail.
+
+    """
+
+    def __init__(
+        self, scopes: Optional[Iterable[str]] = None, interval: int = 60 * 60
+    ) -> None:
+        super().__init__(scopes)
+        self.interval = interval
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        VisitorLogRollup.objects.record(logs, self.interval)
+
+
+class VisitCountSink(LogSink):
+    """
+    Count visits on the pass itself - Visitor.visit_count and last_visited_at.
+
+    Logs are combined per visitor, so each pass is updated (using F()
+    expressions) once per batch. With `interval`, counts are also combined
+    across batches, and written at most every `interval` seconds (and on
+    close) - fewer writes to busy passes, at the cost of the counters lagging
+    behind, and of losing the pending counts if the process is killed.
+
+    """
+
+    def __init__(
+        self, scopes: Optional[Iterable[str]] = None, interval: int = 0
+    ) -> None:
+        super().__init__(scopes)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Tuple[int, datetime.datetime]] = {}
+        self._written_at = time.monotonic()
+
+    def _take_pending(self) -> Dict[int, Tuple[int, datetime.datetime]]:
+        pending, self._pending = self._pending, {}
+        self._written_at = time.monotonic()
+        return pending
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        with self._lock:
+            for log in logs:
+                count, visited_at = self._pending.get(
+                    log.visitor_id, (0, log.timestamp)
+                )
+                self._pending[log.visitor_id] = (
+                    count + log.sample_weight,
+                    max(visited_at, log.timestamp),
+                )
+            if time.monotonic() < self._written_at + self.interval:
+                return
+            pending = self._take_pending()
+        Visitor.objects.record_visits(pending)
+
+    def close(self) -> None:
+        with self._lock:
+            pending = self._take_pending()
+        if pending:
+            Visitor.objects.record_visits(pending)
+
+
+class LoggingSink(LogSink):
+    """
+    Write logs using the stdlib logging module - one record per visit.
+
+    The message is the log as JSON, and the log dict is also attached to the
+    record as `visit`, for the benefit of structured log handlers.
+
+    """
+
+    def __init__(
+        self,
+        scopes: Optional[Iterable[str]] = None,
+        logger: str = "visitors.visits",
+        level: int = logging.INFO,
+    ) -> None:
+        super().__init__(scopes)
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        for log in logs:
+            data = to_dict(log)
+            self.logger.log(
+                self.level,
+                json.dumps(data, cls=DjangoJSONEncoder),
+                extra={"visit": data},
+            )
+
+
+class JSONLinesFileSink(LogSink):
+    """
+    Append logs to a file, as one JSON object per line.
+
+    Writes are buffered (`buffer_size` bytes), and the file is rotated once it
+    is `max_bytes` in size, or `interval` seconds old - the current file is
+    renamed with the time it was opened as a suffix, and only the most recent
+    `backup_count` rotated files are kept. A `max_bytes`, `interval` or
+    `backup_count` of 0 disables that limit.
+
+    The path may include "{pid}", which is replaced with the process id, so
+    that each process writes (and rotates) its own file.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        scopes: Optional[Iterable[str]] = None,
+        max_bytes: int = 100 * 1024 * 1024,
+        interval: int = 24 * 60 * 60,
+        backup_count: int = 0,
+        buffer_size: int = 64 * 1024,
+    ) -> None:
+        super().__init__(scopes)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+        self._opened_at = 0.0
+
+    @property
+    def filename(self) -> str:
+        return self.path.format(pid=os.getpid())
+
+    def _open(self) -> IO[str]:
+        if self._file is None:
+            self._file = open(
+                self.filename, "a", buffering=self.buffer_size, encoding="utf-8"
+            )
+            self._opened_at = time.time()
+        return self._file
+
+    def should_rotate(self) -> bool:
+        if self._file is None:
+            return False
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            return True
+        return bool(self.interval) and time.time() >= self._opened_at + self.interval
+
+    def rotate(self) -> None:
+        """Rename the current file, and remove old files over backup_count."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        opened_at = datetime.datetime.fromtimestamp(self._opened_at)
+        os.replace(self.filename, f"{self.filename}.{opened_at:%Y%m%d%H%M%S}")
+        if self.backup_count:
+            backups = sorted(glob.glob(glob.escape(self.filename) + ".*"))
+            for backup in backups[: -self.backup_count]:
+                os.remove(backup)
+
+    def write_logs(self, logs: List[VisitorLog]) -> None:
+        lines = [json.dumps(to_dict(log), cls=DjangoJSONEncoder) + "\n" for log in logs]
+        with self._lock:
+            if self.should_rotate():
+                self.rotate()
+            self._open().writelines(lines)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+SINKS: Dict[str, Type[LogSink]] = {
+    "counts": VisitCountSink,
+    "database": DatabaseSink,
+    "jsonl": JSONLinesFileSink,
+    "logging": LoggingSink,
+    "rollup": RollupSink,
+}
+
+_sinks: Optional[List[LogSink]] = None
+_sinks_lock = threading.Lock()
+
+
+def create_sink(config: Dict[str, Any]) -> LogSink:
+    """Return a new sink from its config (see VISITOR_LOG_SINKS)."""
+    options = dict(config)
+    name = options.pop("class")
+    sink_class = SINKS.get(name) or import_string(name)
+    return sink_class(**options)
+
+
+def get_sinks() -> List[LogSink]:
+    """Return the VISITOR_LOG_SINKS for this process."""
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                _sinks = [create_sink(config) for config in VISITOR_LOG_SINKS]
+    return _sinks
+
+
+def write(logs: List[VisitorLog]) -> None:
+    """
+    Write logs to every sink.
+
+    A failing sink does not prevent the others from being written to - the
+    first error is raised once they all have been.
+
+    """
+    errors = []
+    for sink in get_sinks():
+        try:
+            sink.write(logs)
+        except Exception as ex:
+            logger.debug("Error writing to visitor log sink %r", sink)
+            errors.append(ex)
+    if errors:
+        raise errors[0]
+
+
+def close() -> None:
+    """Close all sinks (e.g. flushing any file buffers)."""
+    if _sinks is None:
+        return
+    for sink in _sinks:
+        sink.close()
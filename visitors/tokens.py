@@ -0,0 +1,53 @@
+"""
+Signed (stateless) visitor tokens.
+
+A signed token carries the pass id, uuid, scope and expiry, signed using
+`django.core.signing` (and so the SECRET_KEY), which means that it can be
+validated without a database lookup. Passes can still be deactivated - see
+`visitors.revocation`.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+from typing import Any, Dict, Optional
+
+from django.core import signing
+from django.db.models import Model
+
+SALT = "visitors.tokens"
+
+
+def is_signed(token: str) -> bool:
+    """Return True if the token is signed (as opposed to a bare uuid)."""
+    return ":" in token
+
+
+def dumps(visitor: Model) -> str:
+    """Return signed token for a Visitor."""
+    expires_at: Optional[datetime.datetime] = visitor.expires_at
+    claims = {
+        "i": visitor.id,
+        "u": visitor.uuid.hex,
+        "s": visitor.scope,
+        "e": int(expires_at.timestamp()) if expires_at else None,
+    }
+    # NB signing.dumps rather than Signer.sign_object, which needs Django 3.2
+    return signing.dumps(claims, salt=SALT, compress=True)
+
+
+def loads(token: str) -> Dict[str, Any]:
+    """
+    Return the claims from a signed token.
+
+    Raises django.core.signing.BadSignature if the token has been
+    tampered with (or is not a token at all).
+
+    """
+    claims = signing.loads(token, salt=SALT)
+    if claims["e"] is not None:
+        claims["e"] = datetime.datetime.fromtimestamp(
+            claims["e"], tz=datetime.timezone.utc
+        )
+    return claims
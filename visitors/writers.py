@@ -0,0 +1,462 @@
+"""
+Writers used to store VisitorLog records.
+
+Writers decide when logs are written - where they are written to is down to
+the sinks (see visitors.sinks), which default to the VisitorLog table.
+
+By default each visit is logged with an INSERT inside the request. Setting
+VISITOR_LOG_WRITER to "buffered" queues logs in memory instead, and writes
+them in batches - when VISITOR_LOG_BATCH_SIZE logs have been queued, when the
+oldest queued log is VISITOR_LOG_FLUSH_INTERVAL seconds old (checked as each
+request finishes), and when the process exits.
+
+Setting VISITOR_LOG_WRITER to "background" moves the writes out of the
+request altogether - logs are put on a bounded queue, which a background
+thread (one per process) drains in batches. See OVERFLOW_POLICIES for what
+happens when the queue is full.
+
+Queued logs are lost if the process is killed outright, and do not appear in
+the database until written. If there is no SIGTERM handler installed, one is
+added that exits the process normally, so that queued logs are written.
+
+"""
+
+from __future__ import annotations
+
+import atexit
+import functools
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Type
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connections, router, transaction
+from django.http import HttpRequest, HttpResponse
+from django.utils.module_loading import import_string
+
+from . import sinks
+from .models import VisitorLog
+from .settings import (
+    VISITOR_LOG_AFTER_RESPONSE,
+    VISITOR_LOG_BATCH_SIZE,
+    VISITOR_LOG_FLUSH_INTERVAL,
+    VISITOR_LOG_OVERFLOW,
+    VISITOR_LOG_OVERFLOW_SAMPLE_RATE,
+    VISITOR_LOG_QUEUE_SIZE,
+    VISITOR_LOG_WRITER,
+)
+
+logger = logging.getLogger(__name__)
+
+# What the background writer does with a log when its queue is full:
+# * "block" - wait for space (NB this blocks the request)
+# * "drop_newest" - discard the log
+# * "drop_oldest" - discard the oldest queued log to make space
+# * "sample" - as "drop_newest", but from half full keep every nth log
+OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest", "sample")
+
+# Maximum time (seconds) to wait for the background writer on shutdown.
+SHUTDOWN_TIMEOUT = 30
+
+
+class LogWriter:
+    """Write each log immediately."""
+
+    @classmethod
+    def from_settings(cls) -> LogWriter:
+        return cls()
+
+    def write(self, log: VisitorLog) -> None:
+        sinks.write([log])
+
+    async def awrite(self, log: VisitorLog) -> None:
+        await sync_to_async(sinks.write)([log])
+
+    def flush(self, force: bool = True) -> None:
+        """Write any queued logs - if `force` is False, only if they are due."""
+
+    def close(self) -> None:
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {}
+
+
+def save_batch(batch: List[VisitorLog]) -> bool:
+    """Write a batch of logs, returning False if the write failed."""
+    try:
+        sinks.write(batch)
+    except Exception:
+        # a failed write must not take down the request that triggered it
+        logger.exception("Unable to write %i visitor logs", len(batch))
+        return False
+    return True
+
+
+class BufferedLogWriter(LogWriter):
+    """Queue logs in memory, and write them in batches."""
+
+    def __init__(self, batch_size: int, flush_interval: float) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._queue: List[VisitorLog] = []
+        self._flush_at = 0.0
+
+    @classmethod
+    def from_settings(cls) -> LogWriter:
+        return cls(VISITOR_LOG_BATCH_SIZE, VISITOR_LOG_FLUSH_INTERVAL)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _enqueue(self, log: VisitorLog) -> bool:
+        """Queue the log, returning True if the queue is full."""
+        with self._lock:
+            if not self._queue:
+                self._flush_at = time.monotonic() + self.flush_interval
+            self._queue.append(log)
+            return len(self._queue) >= self.batch_size
+
+    def write(self, log: VisitorLog) -> None:
+        if self._enqueue(log):
+            self.flush()
+
+    async def awrite(self, log: VisitorLog) -> None:
+        if self._enqueue(log):
+            await sync_to_async(self.flush)()
+
+    def is_due(self) -> bool:
+        return bool(self._queue) and (
+            len(self._queue) >= self.batch_size or self._flush_at <= time.monotonic()
+        )
+
+    def flush(self, force: bool = True) -> None:
+        with self._lock:
+            if not (force or self.is_due()):
+                return
+            batch, self._queue = self._queue, []
+        if batch:
+            save_batch(batch)
+
+
+class BackgroundLogWriter(LogWriter):
+    """
+    Queue logs in memory, and write them in batches from a background thread.
+
+    The queue is bounded - when it is full, new logs are handled according to
+    the `overflow` policy (see OVERFLOW_POLICIES). The thread is started on
+    the first write, so that it is not lost when a server forks its workers.
+
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval: float,
+        queue_size: int,
+        overflow: str,
+        sample_rate: int,
+    ) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ImproperlyConfigured(
+                f"Invalid VISITOR_LOG_OVERFLOW '{overflow}' - must be one of "
+                f"{', '.join(OVERFLOW_POLICIES)}."
+            )
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # the child inherits a copy of the queue (which the parent will
+            # write) and locks that may be held, but not the thread itself.
+            os.register_at_fork(after_in_child=self._reset)
+
+    @classmethod
+    def from_settings(cls) -> LogWriter:
+        return cls(
+            VISITOR_LOG_BATCH_SIZE,
+            VISITOR_LOG_FLUSH_INTERVAL,
+            VISITOR_LOG_QUEUE_SIZE,
+            VISITOR_LOG_OVERFLOW,
+            VISITOR_LOG_OVERFLOW_SAMPLE_RATE,
+        )
+
+    def _reset(self) -> None:
+        self._cond = threading.Condition()
+        self._queue: Deque[VisitorLog] = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._in_flight = 0
+        self._flushing = 0
+        self._overflowed = 0
+        self.written = self.dropped = self.batches = self.errors = 0
+        self.flush_latency = self.max_flush_latency = 0.0
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self) -> None:
+        if self._stopping or self.is_running:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="visitors-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _admit(self, log: VisitorLog) -> bool:
+        """Apply the overflow policy - called with the lock held."""
+        if self.overflow == "block":
+            while len(self._queue) >= self.queue_size and self.is_running:
+                self._cond.wait()
+        elif self.overflow == "sample" and len(self._queue) >= self.queue_size // 2:
+            # past the high-water mark only every nth log is kept
+            self._overflowed += 1
+            if self._overflowed % self.sample_rate:
+                return False
+            # the kept log stands in for those dropped, so that totals
+            # estimated from sample_weight still add up
+            log.sample_weight *= self.sample_rate
+        if len(self._queue) < self.queue_size:
+            return True
+        if self.overflow != "drop_oldest":
+            return False
+        self._queue.popleft()
+        self.dropped += 1
+        return True
+
+    def write(self, log: VisitorLog) -> None:
+        with self._cond:
+            if self._stopping:
+                # the thread has gone, so write it here
+                self._save([log])
+                return
+            self._start()
+            if not self._admit(log):
+                self.dropped += 1
+                return
+            self._queue.append(log)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    async def awrite(self, log: VisitorLog) -> None:
+        # NB only blocking writes (a full queue) need to leave the event loop
+        if self.overflow == "block" and len(self._queue) >= self.queue_size:
+            await sync_to_async(self.write, thread_sensitive=False)(log)
+        else:
+            self.write(log)
+
+    def _next_batch(self) -> List[VisitorLog]:
+        with self._cond:
+            if len(self._queue) < self.batch_size and not (
+                self._stopping or self._flushing
+            ):
+                self._cond.wait(self.flush_interval)
+            count = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(count)]
+            self._in_flight = len(batch)
+            # wake any writers blocked on a full queue
+            self._cond.notify_all()
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            if batch := self._next_batch():
+                self._save(batch)
+            with self._cond:
+                self._in_flight = 0
+                self._cond.notify_all()
+                if self._stopping and not self._queue:
+                    break
+        connections.close_all()
+
+    def _save(self, batch: List[VisitorLog]) -> None:
+        close_old_connections()
+        start = time.perf_counter()
+        saved = save_batch(batch)
+        latency = time.perf_counter() - start
+        with self._cond:
+            self.batches += 1
+            if saved:
+                self.written += len(batch)
+            else:
+                self.errors += 1
+            self.flush_latency = latency
+            self.max_flush_latency = max(latency, self.max_flush_latency)
+
+    def flush(self, force: bool = True) -> None:
+        """Wait for all queued logs to be written - logs are written as due."""
+        if not force:
+            return
+        with self._cond:
+            if not self.is_running:
+                batch, self._queue = list(self._queue), deque()
+            else:
+                batch = []
+                self._flushing += 1
+                self._cond.notify_all()
+                while self._queue or self._in_flight:
+                    self._cond.wait()
+                self._flushing -= 1
+        if batch:
+            self._save(batch)
+
+    def close(self) -> None:
+        """Stop the thread once it has written all queued logs."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(SHUTDOWN_TIMEOUT)
+        if self.is_running:
+            logger.warning("Timed out writing %i visitor logs", len(self._queue))
+        elif self._queue:
+            self._save(list(self._queue))
+            self._queue.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "depth": len(self._queue),
+                "queue_size": self.queue_size,
+                "written": self.written,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "errors": self.errors,
+                "flush_latency": self.flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+            }
+
+
+WRITERS: Dict[str, Type[LogWriter]] = {
+    "direct": LogWriter,
+    "buffered": BufferedLogWriter,
+    "background": BackgroundLogWriter,
+}
+
+_writer: Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def create_writer(name: str) -> LogWriter:
+    """Return a new writer - `name` is a key in WRITERS, or a dotted path."""
+    writer_class = WRITERS.get(name) or import_string(name)
+    return writer_class.from_settings()
+
+
+def get_writer() -> LogWriter:
+    """Return the VISITOR_LOG_WRITER for this process."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = create_writer(VISITOR_LOG_WRITER)
+                atexit.register(close)
+                if type(_writer) is not LogWriter:
+                    exit_on_sigterm()
+    return _writer
+
+
+def close() -> None:
+    """Write any queued logs, and close the sinks - called at exit."""
+    if _writer is not None:
+        _writer.close()
+    sinks.close()
+
+
+def get_stats() -> Dict[str, Any]:
+    """Return queue depth, drop counts, flush latency etc. for the writer."""
+    return get_writer().get_stats()
+
+
+def _sigterm(signum: int, frame: Any) -> None:
+    raise SystemExit(128 + signum)
+
+
+def exit_on_sigterm() -> None:
+    """
+    Exit normally on SIGTERM, so that queued logs are written (by atexit).
+
+    Servers that handle SIGTERM themselves (e.g. gunicorn) already exit
+    normally, so the handler is only installed if there is none, and only
+    from the main thread (which is a requirement of `signal.signal`).
+
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _sigterm)
+
+
+def build_log(
+    request: HttpRequest, response: HttpResponse, sample_weight: int = 1
+) -> VisitorLog:
+    """Return the (unsaved) VisitorLog for a visit."""
+    return VisitorLog(
+        sample_weight=sample_weight,
+        **VisitorLog.objects.log_kwargs(request, response.status_code),
+    )
+
+
+def _write_later(log: VisitorLog) -> None:
+    """Write a log once the response is closed, or the transaction commits."""
+    # the response has been sent, so there is no one to report errors to
+    try:
+        get_writer().write(log)
+    except Exception:
+        logger.exception("Unable to write visitor log")
+
+
+def in_request_transaction() -> bool:
+    """Return True if inside the transaction set up by ATOMIC_REQUESTS."""
+    connection = transaction.get_connection(router.db_for_write(VisitorLog))
+    return connection.settings_dict["ATOMIC_REQUESTS"] and connection.in_atomic_block
+
+
+def write_log(
+    request: HttpRequest, response: HttpResponse, sample_weight: int = 1
+) -> None:
+    """
+    Log a visit using the configured writer.
+
+    If VISITOR_LOG_AFTER_RESPONSE is True the log is written once the response
+    has been sent (when the server closes it). Otherwise, if ATOMIC_REQUESTS is
+    on, it is written once the request transaction has been committed.
+
+    """
+    log = build_log(request, response, sample_weight)
+    if VISITOR_LOG_AFTER_RESPONSE:
+        response._resource_closers.append(functools.partial(_write_later, log))
+    elif in_request_transaction():
+        transaction.on_commit(functools.partial(_write_later, log))
+    else:
+        get_writer().write(log)
+
+
+async def awrite_log(
+    request: HttpRequest, response: HttpResponse, sample_weight: int = 1
+) -> None:
+    """Async version of write_log."""
+    log = build_log(request, response, sample_weight)
+    if VISITOR_LOG_AFTER_RESPONSE:
+        # NB closers are called from a thread by the ASGI handler
+        response._resource_closers.append(functools.partial(_write_later, log))
+    else:
+        await get_writer().awrite(log)
+
+
+def flush_due() -> None:
+    """Write queued logs if they are due - called as each request finishes."""
+    if _writer is not None:
+        _writer.flush(force=False)